@@ -0,0 +1,130 @@
+# A stand-in for the gcloud executable which answers commands from cassettes recorded by
+# tests/hermitcrab/gcloud_vcr.py (or written by benchmarks/run.py) so that hermit can be exercised
+# without network access.
+#
+# Configured via environment variables:
+#   HERMIT_FAKE_GCLOUD_CASSETTES: cassette filenames separated by os.pathsep. Earlier cassettes take precedence.
+#   HERMIT_FAKE_GCLOUD_LATENCY: seconds to wait before responding to each command (simulates API latency)
+#
+# Unlike playback in the tests, commands are looked up by their arguments rather than by their
+# position in the recording, so calls can arrive in any order.
+
+import json
+import os
+import signal
+import socket
+import sys
+import time
+
+SSH_BANNER = b"SSH-2.0-OpenSSH_hermit_fake_gcloud\r\n"
+
+
+def _normalize(args):
+    normalized = []
+    for arg in args:
+        if arg.startswith("--description="):
+            normalized.append("--description=MASKED")
+        elif arg.startswith("--metadata-from-file=user-data="):
+            normalized.append("--metadata-from-file=user-data=MASKED")
+        else:
+            normalized.append(arg)
+    return normalized
+
+
+def _command_words(args):
+    "The leading arguments which name the command (ie: ['compute', 'instances', 'list'])"
+    words = []
+    for arg in args:
+        if arg.startswith("-"):
+            break
+        words.append(arg)
+    return words
+
+
+def _filter(args):
+    return [arg for arg in args if arg.startswith("--filter=")]
+
+
+def read_cassettes(filenames):
+    recording = []
+    for filename in filenames:
+        with open(filename, "rt") as fd:
+            recording.extend(json.load(fd))
+    return recording
+
+
+def find_response(recording, args):
+    """Look for the most specific match: first identical arguments, then the same command and
+    filter, and finally any recorded command which is a prefix of this one (ie: a recording of
+    'compute ssh' matches 'compute ssh NAME ...')"""
+    args = _normalize(args)
+    candidates = [
+        lambda recorded: _normalize(recorded) == args,
+        lambda recorded: _command_words(recorded) == _command_words(args)
+        and _filter(recorded) == _filter(args),
+        lambda recorded: _command_words(args)[: len(_command_words(recorded))]
+        == _command_words(recorded),
+    ]
+    for matches in candidates:
+        for fn, params, result, *_ in recording:
+            if matches(params["args"][0]):
+                return fn, result
+    return None
+
+
+def _write_response(fn, result):
+    if "raised" in result:
+        sys.stderr.write(f"{result['raised']}\n")
+        return 1
+
+    value = result["returned"]
+    if fn == "gcloud_capturing_json_output":
+        sys.stdout.write(json.dumps(value))
+    elif fn == "gcloud_capturing_output":
+        stdout, stderr = value
+        sys.stdout.write(stdout)
+        sys.stderr.write(stderr)
+    return 0
+
+
+def _serve_tunnel(args):
+    "Pretend to be start-iap-tunnel: listen on the local port and greet each connection like sshd would"
+    local_host_port = [arg for arg in args if arg.startswith("--local-host-port=")][
+        0
+    ].split("=", 1)[1]
+    host, port = local_host_port.rsplit(":", 1)
+
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, int(port)))
+    server.listen(16)
+    print(f"Listening on port [{port}].", flush=True)
+    while True:
+        conn, _ = server.accept()
+        try:
+            conn.sendall(SSH_BANNER)
+        finally:
+            conn.close()
+
+
+def main(args):
+    time.sleep(float(os.environ.get("HERMIT_FAKE_GCLOUD_LATENCY", "0")))
+
+    if _command_words(args)[:2] == ["compute", "start-iap-tunnel"]:
+        _serve_tunnel(args)
+        return 0
+
+    cassettes = os.environ.get("HERMIT_FAKE_GCLOUD_CASSETTES", "")
+    recording = read_cassettes([x for x in cassettes.split(os.pathsep) if x != ""])
+    response = find_response(recording, args)
+    if response is None:
+        sys.stderr.write(f"fake gcloud: no recorded response for {args}\n")
+        return 1
+
+    return _write_response(*response)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,336 @@
+# Benchmarks for hermit's control-plane hot paths. Runs offline by putting benchmarks/fake_gcloud.py on
+# the PATH as "gcloud".
+#
+# Usage: python -m benchmarks.run --output results.json [--latency 0.2] [--repeat 5]
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+RECORDED_CASSETTES = [os.path.join(REPO_DIR, "cassettes", "test_end_to_end.json")]
+
+SERVICE_ACCOUNT = "hermit-bench@bench-project.iam.gserviceaccount.com"
+PROJECT = "bench-project"
+ZONE = "us-central1-a"
+
+READY_LOG = """Starting cloudinit bootcmd...
+Starting check filesystem /dev/disk/by-id/google-bench-pd
+Finished checking filesystem /dev/disk/by-id/google-bench-pd
+Mounting /dev/disk/by-id/google-bench-pd as /mnt/disks/bench-pd
+Status: Downloaded newer image for us-central1-docker.pkg.dev/bench/docker/image:v1
+Server listening on 0.0.0.0 port 3022.
+"""
+
+
+def _find_free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("localhost", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _recorded(fn, args, returned):
+    return [fn, {"args": [args], "kwargs": {}}, {"returned": returned}]
+
+
+def _scenario_cassette(status_by_name: Dict[str, str]):
+    "Responses for instances in the given states (a status of None means there is no instance)"
+    recording = []
+    for name, status in status_by_name.items():
+        instances = (
+            []
+            if status is None
+            else [
+                {
+                    "name": name,
+                    "status": status,
+                    "machineType": f"https://www.googleapis.com/compute/v1/projects/{PROJECT}/zones/{ZONE}/machineTypes/n2-standard-2",
+                }
+            ]
+        )
+        recording.append(
+            _recorded(
+                "gcloud_capturing_json_output",
+                [
+                    "compute",
+                    "instances",
+                    "list",
+                    f"--filter=name={name}",
+                    "--format=json",
+                    f"--zones={ZONE}",
+                    f"--project={PROJECT}",
+                ],
+                instances,
+            )
+        )
+    for command in ["create", "start", "resume"]:
+        recording.append(_recorded("gcloud", ["compute", "instances", command], None))
+    recording.append(
+        _recorded("gcloud_capturing_output", ["compute", "ssh"], [READY_LOG, ""])
+    )
+    return recording
+
+
+class Environment:
+    "A throw-away HOME, with the fake gcloud first on the PATH"
+
+    def __init__(self, latency: float):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.home = self.tmpdir.name
+        self.latency = latency
+        self.scenario_path = os.path.join(self.home, "scenario.json")
+
+        os.makedirs(os.path.join(self.home, ".ssh"))
+        with open(os.path.join(self.home, ".ssh", "id_rsa.pub"), "wt") as fd:
+            fd.write("ssh-rsa benchkey\n")
+
+        bin_dir = os.path.join(self.home, "bin")
+        os.makedirs(bin_dir)
+        gcloud_path = os.path.join(bin_dir, "gcloud")
+        with open(gcloud_path, "wt") as fd:
+            fd.write(
+                f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(BENCHMARK_DIR, "fake_gcloud.py")}" "$@"\n'
+            )
+        os.chmod(gcloud_path, 0o755)
+
+        self.environ = {
+            "HOME": self.home,
+            "PATH": bin_dir + os.pathsep + os.environ.get("PATH", ""),
+            "HERMIT_FAKE_GCLOUD_LATENCY": str(latency),
+            "HERMIT_FAKE_GCLOUD_CASSETTES": os.pathsep.join(
+                [self.scenario_path] + RECORDED_CASSETTES
+            ),
+        }
+
+    def set_scenario(self, status_by_name: Dict[str, str]):
+        with open(self.scenario_path, "wt") as fd:
+            json.dump(_scenario_cassette(status_by_name), fd)
+
+    def __enter__(self):
+        self.saved_environ = dict(os.environ)
+        os.environ.update(self.environ)
+
+        from hermitcrab import gcp, image_check
+
+        # these make http requests and look up the current user, neither of which we're interested in timing
+        self.saved_has_access = gcp.has_access_to_docker_image
+        self.saved_check_docker_image = image_check.check_docker_image
+        self.saved_getlogin = os.getlogin
+        gcp.has_access_to_docker_image = lambda service_account, docker_image: True
+        image_check.check_docker_image = (
+            lambda service_account, docker_image: gcp.DockerImageManifest(
+                gcp.parse_docker_image_name(docker_image), "", {}, "sha256:" + "0" * 64
+            )
+        )
+        os.getlogin = lambda: "bench"
+        return self
+
+    def __exit__(self, *args):
+        from hermitcrab import gcp, image_check
+
+        gcp.has_access_to_docker_image = self.saved_has_access
+        image_check.check_docker_image = self.saved_check_docker_image
+        os.getlogin = self.saved_getlogin
+        os.environ.clear()
+        os.environ.update(self.saved_environ)
+        self.tmpdir.cleanup()
+
+
+def _write_configs(names: List[str]):
+    from hermitcrab.config import InstanceConfig, write_instance_config
+
+    for name in names:
+        write_instance_config(
+            InstanceConfig(
+                name=name,
+                zone=ZONE,
+                project=PROJECT,
+                machine_type="n2-standard-2",
+                docker_image="us-central1-docker.pkg.dev/bench/docker/image:v1",
+                pd_name=f"{name}-pd",
+                local_port=_find_free_port(),
+                service_account=SERVICE_ACCOUNT,
+                boot_disk_size_in_gb=50,
+            )
+        )
+
+
+def measure(callback: Callable[[], object], repeat: int, setup=None, teardown=None):
+    runs = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            callback()
+            runs.append(time.perf_counter() - start)
+            if teardown:
+                teardown()
+    return {
+        "runs": runs,
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "mean": statistics.mean(runs),
+    }
+
+
+def bench_up(latency: float, repeat: int):
+    from hermitcrab.command import up
+    from hermitcrab import tunnel
+
+    results = {}
+    for path, status in [
+        ("create", None),
+        ("resume", "SUSPENDED"),
+        ("start", "TERMINATED"),
+        ("already_running", "RUNNING"),
+    ]:
+        with Environment(latency) as env:
+            _write_configs(["bench"])
+            env.set_scenario({"bench": status})
+            results[f"up_{path}"] = measure(
+                lambda: up.up("bench", False),
+                repeat,
+                teardown=lambda: tunnel.stop_tunnel("bench"),
+            )
+    return results
+
+
+def bench_status(latency: float, repeat: int, config_counts: List[int]):
+    from hermitcrab.command import status
+
+    results = {}
+    for count in config_counts:
+        with Environment(latency) as env:
+            names = [f"bench{i}" for i in range(count)]
+            _write_configs(names)
+            env.set_scenario({name: "RUNNING" for name in names})
+            results[f"status_{count}_configs"] = measure(
+                lambda: status.status(None), repeat
+            )
+    return results
+
+
+def bench_update_ssh_config(repeat: int, existing_hosts: int, config_count: int):
+    from hermitcrab import ssh, config
+
+    with Environment(0) as env:
+        ssh_config_path = ssh.get_ssh_config_path()
+        existing = "".join(
+            [
+                f"Host host{i}\n   Hostname host{i}.example.com\n   User someone\n\n"
+                for i in range(existing_hosts)
+            ]
+        )
+
+        def reset_ssh_config():
+            with open(ssh_config_path, "wt") as fd:
+                fd.write(existing)
+
+        _write_configs([f"bench{i}" for i in range(config_count)])
+        configs = config.get_instance_configs()
+
+        return {
+            f"update_ssh_config_{existing_hosts}_hosts": measure(
+                lambda: ssh.update_ssh_config(configs),
+                repeat,
+                setup=reset_ssh_config,
+            )
+        }
+
+
+def _make_large_log(fsck_progress_lines: int):
+    lines = [
+        "Starting cloudinit bootcmd...",
+        "Starting check filesystem /dev/disk/by-id/google-bench-pd",
+        "fsck from util-linux 2.38.1",
+    ]
+    for i in range(fsck_progress_lines):
+        lines.append(f"1 {i} {fsck_progress_lines} /dev/sdb")
+    lines.extend(["v1: Pulling from bench/image"])
+    for i in range(fsck_progress_lines // 10):
+        lines.append(f"{i:012x}: Pull complete")
+    return "\n".join(lines) + "\n"
+
+
+def bench_get_status_from_log(repeat: int, fsck_progress_lines: int):
+    from hermitcrab.command.up import get_status_from_log
+
+    log = _make_large_log(fsck_progress_lines)
+    return {
+        f"get_status_from_log_{len(log)}_bytes": measure(
+            lambda: get_status_from_log(log), repeat
+        )
+    }
+
+
+def bench_import_time(repeat: int):
+    def run():
+        subprocess.check_call(
+            [sys.executable, "-c", "import hermitcrab.main"], cwd=REPO_DIR
+        )
+
+    return {"cli_import": measure(run, repeat)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds the fake gcloud waits before responding to each command",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--status-config-counts", default="1,10,100", dest="status_config_counts"
+    )
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, REPO_DIR)
+    import hermitcrab
+
+    config_counts = [int(x) for x in args.status_config_counts.split(",")]
+
+    results = {}
+    for name, callback in [
+        ("up", lambda: bench_up(args.latency, args.repeat)),
+        ("status", lambda: bench_status(args.latency, args.repeat, config_counts)),
+        ("update_ssh_config", lambda: bench_update_ssh_config(args.repeat, 5000, 50)),
+        ("get_status_from_log", lambda: bench_get_status_from_log(args.repeat, 200000)),
+        ("import", lambda: bench_import_time(args.repeat)),
+    ]:
+        print(f"Running {name} benchmarks...")
+        results.update(callback())
+
+    report = {
+        "hermit_version": hermitcrab.__version__,
+        "python_version": sys.version,
+        "timestamp": time.time(),
+        "gcloud_latency": args.latency,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    with open(args.output, "wt") as fd:
+        fd.write(json.dumps(report, indent=2, sort_keys=True))
+
+    for name, result in sorted(results.items()):
+        print(f"{name}: median {result['median']:.3f}s (min {result['min']:.3f}s)")
+    print(f"Wrote results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
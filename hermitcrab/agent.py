@@ -0,0 +1,89 @@
+import json
+import tempfile
+import uuid
+from typing import Dict, Optional
+
+from . import gcp
+from .config import read_instance_state
+
+# Instances created by this version of hermit run hermit-agent (deploy_scripts/hermit_agent.py). Instead of
+# an ssh session for each thing hermit needs from the VM, hermit reads what the agent publishes as guest
+# attributes and hands it commands through the instance's metadata. Neither needs the VM to be reachable
+# over the network, or an ssh key.
+
+# (these must match deploy_scripts/hermit_agent.py)
+GUEST_ATTRIBUTE_NAMESPACE = "hermit"
+COMMAND_METADATA_KEY = "hermit-command"
+
+
+def has_agent(name: str) -> bool:
+    "Returns True if the instance was created with the agent (instances created by older versions of hermit don't have it)"
+    return read_instance_state(name).get("has_agent", False)
+
+
+def get_guest_attributes(name: str, zone: str, project: str) -> Dict[str, str]:
+    "Returns what the agent has published, or an empty dict if it hasn't published anything yet"
+    stdout, stderr = gcp.gcloud_capturing_output(
+        [
+            "compute",
+            "instances",
+            "get-guest-attributes",
+            name,
+            f"--query-path={GUEST_ATTRIBUTE_NAMESPACE}/",
+            f"--zone={zone}",
+            f"--project={project}",
+            "--format=json",
+        ],
+        ignore_error=True,
+        retries_on_timeout=10,
+    )
+    if stdout == "":
+        # the agent doesn't start until partway through booting
+        gcp.log_info(f"No guest attributes from the agent yet: {stderr}")
+        return {}
+    return {
+        attribute["key"]: attribute["value"]
+        for attribute in json.loads(stdout)
+        if attribute["namespace"] == GUEST_ATTRIBUTE_NAMESPACE
+    }
+
+
+def read_log(instance_config) -> Optional[str]:
+    "Returns the (end of) /var/log/hermit.log as published by the agent, or None if it hasn't been published yet"
+    return get_guest_attributes(
+        instance_config.name, instance_config.zone, instance_config.project
+    ).get("log")
+
+
+def get_metrics(attributes: Dict[str, str]) -> Optional[Dict[str, float]]:
+    if "metrics" not in attributes:
+        return None
+    return json.loads(attributes["metrics"])
+
+
+def describe_metrics(metrics: Dict[str, float]):
+    "Returns a description of the metrics published by the agent for 'hermit status'"
+    return f"load {metrics['load_average']:.2f}, {metrics['memory_used_percent']}% of memory used, idle for {metrics['idle_seconds'] // 60:.0f} minutes"
+
+
+def send_command(instance_config, action: str, **params) -> str:
+    "Asks the agent to carry out the action. Returns the command's ID, which identifies its progress in the log"
+    command_id = uuid.uuid4().hex[:8]
+    command = {"id": command_id, "action": action, **params}
+    with tempfile.NamedTemporaryFile("wt") as tmp:
+        # (from a file, because --metadata would split the JSON at its commas)
+        json.dump(command, tmp)
+        tmp.flush()
+        gcp.gcloud(
+            [
+                "compute",
+                "instances",
+                "add-metadata",
+                instance_config.name,
+                f"--metadata-from-file={COMMAND_METADATA_KEY}={tmp.name}",
+                f"--zone={instance_config.zone}",
+                f"--project={instance_config.project}",
+            ],
+            timeout=60,
+        )
+    return command_id
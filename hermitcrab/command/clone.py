@@ -0,0 +1,118 @@
+import dataclasses
+import time
+from typing import Optional
+
+from .. import gcp
+from ..config import (
+    get_instance_config,
+    get_instance_configs,
+    config_exists,
+    write_instance_config,
+)
+from ..ssh import update_ssh_config
+from .create import (
+    create_volume,
+    find_unused_port,
+    allocate_forwarded_ports,
+    assert_valid_gcp_name,
+)
+
+
+def clone(
+    src: str,
+    new_name: str,
+    snapshot: Optional[str],
+    pd_name: Optional[str],
+    local_port: Optional[int],
+):
+    src_config = get_instance_config(src)
+
+    assert_valid_gcp_name("instance name", new_name)
+    assert not config_exists(
+        new_name
+    ), f"{new_name} appears to already have a config stored"
+
+    if pd_name is None:
+        pd_name = f"{new_name}-pd"
+    assert_valid_gcp_name("persistent disk name", pd_name)
+
+    if local_port is None:
+        local_port = find_unused_port()
+
+    if snapshot is None:
+        status = gcp.get_instance_status(
+            src_config.name, src_config.zone, src_config.project, one_or_none=True
+        )
+        if status == "RUNNING":
+            print(
+                f"Warning: {src_config.name} is running, so the copy will only contain what has been flushed to disk. Run 'hermit down {src}' first for a consistent copy."
+            )
+        source_snapshot = None
+        source_disk = f"projects/{src_config.project}/zones/{src_config.zone}/disks/{src_config.pd_name}"
+        print(f"Cloning persistent disk {src_config.pd_name} to {pd_name}")
+    else:
+        source_snapshot = snapshot
+        source_disk = None
+        print(f"Creating persistent disk {pd_name} from snapshot {snapshot}")
+
+    start_time = time.time()
+    create_volume(
+        pd_name,
+        None,
+        # otherwise the copy would get the default type rather than the type of the source
+        src_config.disk_type,
+        new_name,
+        src_config.service_account,
+        src_config.zone,
+        src_config.project,
+        src_config.machine_type,
+        source_snapshot=source_snapshot,
+        source_disk=source_disk,
+    )
+    print(f"Created {pd_name} in {time.time() - start_time:.1f} seconds")
+
+    write_instance_config(
+        dataclasses.replace(
+            src_config,
+            name=new_name,
+            pd_name=pd_name,
+            local_port=local_port,
+            # the source's local ports are taken
+            forwarded_ports=allocate_forwarded_ports(
+                [int(port) for port in src_config.forwarded_ports], local_port
+            ),
+        )
+    )
+    update_ssh_config(get_instance_configs())
+
+    print(
+        f"Created instance config {new_name}. Execute 'hermit up {new_name}' to start it"
+    )
+
+
+def add_command(subparser):
+    def _clone(args):
+        clone(args.src, args.new_name, args.snapshot, args.pd_name, args.local_port)
+
+    parser = subparser.add_parser(
+        "clone",
+        help="Create a new instance config with a copy of another instance's persistent disk",
+    )
+    parser.set_defaults(func=_clone)
+    parser.add_argument("src", help="The name of the instance config to copy")
+    parser.add_argument("new_name", help="The name of the new instance config")
+    parser.add_argument(
+        "--snapshot",
+        help="If set, create the disk from this snapshot (see 'hermit snapshot') instead of copying the current contents of the source's disk",
+    )
+    parser.add_argument(
+        "--pd-name",
+        dest="pd_name",
+        help='What to name the new persistent disk. ("NEW_NAME-pd" if not specified)',
+    )
+    parser.add_argument(
+        "--local-port",
+        dest="local_port",
+        type=int,
+        help="The port on localhost to use for the tunnel to the new instance. If not specified will pick a port not assigned to any other instances",
+    )
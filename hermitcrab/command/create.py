@@ -1,7 +1,9 @@
 import re
 import tempfile
+import time
 from .. import gcp
 import os
+from typing import List, Optional
 
 from ..config import (
     get_instance_config,
@@ -12,13 +14,25 @@ from ..config import (
     InstanceConfig,
     CONTAINER_SSHD_PORT,
     LONG_OPERATION_TIMEOUT,
+    SCRATCH_FILESYSTEMS,
+    CONNECTION_MODES,
     set_default_instance_config,
 )
 from ..ssh import update_ssh_config
+from ..steps import Step, run_steps
+from ..registry_cache import (
+    get_cached_docker_image,
+    ensure_registry_cache,
+    DEFAULT_REGISTRY_CACHE_NAME,
+)
+from .. import image_check
 from . import create_service_account
 from .. import __version__
 
 
+FORMAT_STRATEGIES = ["lazy", "vm"]
+
+
 def create_volume(
     pd_name,
     drive_size,
@@ -28,7 +42,15 @@ def create_volume(
     zone,
     project,
     machine_type,
+    format_strategy="lazy",
+    source_snapshot=None,
+    source_disk=None,
 ):
+    """Create the persistent disk for the home directory. If source_snapshot or source_disk is given, the
+    new disk is a copy of it (and therefore already has a filesystem). If drive_size is None, the new
+    disk is the same size as the source."""
+    assert format_strategy in FORMAT_STRATEGIES
+    assert source_snapshot is None or source_disk is None
     disk_status = gcp.gcloud_capturing_json_output(
         [
             "compute",
@@ -49,6 +71,17 @@ def create_volume(
 
     username = os.getlogin()
 
+    options = []
+    if drive_size is not None:
+        options.append(f"--size={drive_size}")
+    options.append(f"--zone={zone}")
+    if drive_type is not None:
+        options.append(f"--type={drive_type}")
+    if source_snapshot is not None:
+        options.append(f"--source-snapshot={source_snapshot}")
+    if source_disk is not None:
+        options.append(f"--source-disk={source_disk}")
+
     print(f"Creating persistent disk named {pd_name}")
     # gcloud compute disks create test-create-vol --size=50 --zone=us-central1-a --type=pd-standard
     gcp.gcloud(
@@ -58,14 +91,29 @@ def create_volume(
             "create",
             pd_name,
             f"--description=hermit v{__version__} VM started user {username}",
-            f"--size={drive_size}",
-            f"--zone={zone}",
-            f"--type={drive_type}",
-            f"--project={project}",
-        ],
+        ]
+        + options
+        + [f"--project={project}"],
         timeout=LONG_OPERATION_TIMEOUT,
     )
 
+    if source_snapshot is not None or source_disk is not None:
+        # copied from an existing hermit disk, so there's already a filesystem
+        pass
+    elif format_strategy == "vm":
+        format_volume_with_temp_vm(
+            pd_name, name, service_account, zone, project, machine_type
+        )
+    else:
+        # the bootcmd of the first 'up' will notice the disk is blank and create the filesystem
+        print(
+            f"Filesystem on {pd_name} will be created the first time the instance boots"
+        )
+
+
+def format_volume_with_temp_vm(
+    pd_name, name, service_account, zone, project, machine_type
+):
     with tempfile.NamedTemporaryFile("wt") as tmp:
         # write out cloudinit file
         tmp.write(
@@ -114,10 +162,77 @@ bootcmd:
     )
 
 
-def ensure_firewall_setup(project):
+# the rule which allows connections straight to sshd from the source ranges of instances with connection_mode "direct"
+DIRECT_FIREWALL_RULE = "allow-altssh-ingress-direct"
+
+
+def _ensure_direct_firewall_rule(project, direct_source_ranges: List[str]):
+    firewall_settings = gcp.gcloud_capturing_json_output(
+        [
+            "compute",
+            "firewall-rules",
+            "list",
+            f"--filter=name={DIRECT_FIREWALL_RULE}",
+            "--format=json",
+            f"--project={project}",
+        ],
+    )
+    if len(firewall_settings) == 0:
+        print(
+            f"Adding firewall rule to allow direct connections from {', '.join(direct_source_ranges)}"
+        )
+        gcp.gcloud(
+            [
+                "compute",
+                "firewall-rules",
+                "create",
+                DIRECT_FIREWALL_RULE,
+                "--direction=INGRESS",
+                "--action=allow",
+                f"--rules=tcp:{CONTAINER_SSHD_PORT}",
+                f"--source-ranges={','.join(direct_source_ranges)}",
+                f"--project={project}",
+            ]
+        )
+    else:
+        # the rule is shared by all instances in the project, so only ever add ranges to it
+        assert len(firewall_settings) == 1
+        existing_ranges = firewall_settings[0]["sourceRanges"]
+        missing_ranges = [r for r in direct_source_ranges if r not in existing_ranges]
+        if len(missing_ranges) > 0:
+            print(
+                f"Updating firewall rule to also allow direct connections from {', '.join(missing_ranges)}"
+            )
+            gcp.gcloud(
+                [
+                    "compute",
+                    "firewall-rules",
+                    "update",
+                    DIRECT_FIREWALL_RULE,
+                    f"--source-ranges={','.join(existing_ranges + missing_ranges)}",
+                    f"--project={project}",
+                ]
+            )
+
+
+def _get_allowed_tcp_ports(rule):
+    ports = []
+    for allowed in rule["allowed"]:
+        assert allowed["IPProtocol"] == "tcp"
+        ports.extend(allowed["ports"])
+    return ports
+
+
+def ensure_firewall_setup(
+    project,
+    direct_source_ranges: Optional[List[str]] = None,
+    forwarded_ports: Optional[List[int]] = None,
+):
     # Add rule to allow connections from IAP tunnel. See https://cloud.google.com/iap/docs/using-tcp-forwarding
     IAP_TUNNEL_IP_RANGE = "35.235.240.0/20"
 
+    ports = [str(CONTAINER_SSHD_PORT)] + [str(port) for port in forwarded_ports or []]
+
     firewall_settings = gcp.gcloud_capturing_json_output(
         [
             "compute",
@@ -139,7 +254,7 @@ def ensure_firewall_setup(project):
                 "allow-altssh-ingress-from-iap",
                 "--direction=INGRESS",
                 "--action=allow",
-                f"--rules=tcp:{CONTAINER_SSHD_PORT}",
+                f"--rules={','.join(f'tcp:{port}' for port in ports)}",
                 f"--source-ranges={IAP_TUNNEL_IP_RANGE}",
                 f"--project={project}",
             ]
@@ -148,32 +263,68 @@ def ensure_firewall_setup(project):
         # some simple santity checks to make sure it's set the way we want
         assert len(firewall_settings) == 1
         rule = firewall_settings[0]
-        assert rule["allowed"] == [
-            {"IPProtocol": "tcp", "ports": [str(CONTAINER_SSHD_PORT)]}
-        ]
+        allowed_ports = _get_allowed_tcp_ports(rule)
+        assert str(CONTAINER_SSHD_PORT) in allowed_ports
         assert rule["direction"] == "INGRESS"
         assert rule["disabled"] == False
         assert rule["sourceRanges"] == [
             IAP_TUNNEL_IP_RANGE
         ]  # , f"expected {IAP_TUNNEL_IP_RANGE} but got {rule['sourceRanges']}"
 
+        # the rule is shared by all instances in the project, so only ever add ports to it
+        missing_ports = [port for port in ports if port not in allowed_ports]
+        if len(missing_ports) > 0:
+            print(
+                f"Updating firewall rule to also allow connections from IAP to port(s) {', '.join(missing_ports)}"
+            )
+            gcp.gcloud(
+                [
+                    "compute",
+                    "firewall-rules",
+                    "update",
+                    "allow-altssh-ingress-from-iap",
+                    f"--rules={','.join(f'tcp:{port}' for port in allowed_ports + missing_ports)}",
+                    f"--project={project}",
+                ]
+            )
+
+    # IAP is still needed with direct connections, as the fallback
+    if direct_source_ranges:
+        _ensure_direct_firewall_rule(project, direct_source_ranges)
+
 
-def find_unused_port():
-    used_ports = []
+def find_unused_port(also_used: Optional[List[int]] = None):
+    "Pick a local port which isn't used by the tunnels of any instance, or in also_used"
+    used_ports = list(also_used or [])
     for name in get_instance_names():
         config = get_instance_config(name)
         used_ports.append(config.local_port)
+        used_ports.extend(config.forwarded_ports.values())
     if len(used_ports) > 0:
         return max(used_ports) + 1
     return 3022
 
 
+def allocate_forwarded_ports(remote_ports: List[int], local_port: int):
+    "Returns the forwarded_ports for a config, with a local port picked for each of remote_ports"
+    forwarded_ports = {}
+    for remote_port in remote_ports:
+        forwarded_ports[str(remote_port)] = find_unused_port(
+            [local_port] + list(forwarded_ports.values())
+        )
+    return forwarded_ports
+
+
+class DockerAccessDenied(Exception):
+    pass
+
+
 def create(
     name: str,
     drive_size: int,
     drive_type: str,
     machine_type: str,
-    service_account: str,
+    service_account: Optional[str],
     project: str,
     zone: str,
     docker_image: str,
@@ -182,31 +333,166 @@ def create(
     idle_timeout: int,
     boot_disk_size_in_gb: int,
     local_ssd_count: int,
+    format_strategy: str = "lazy",
+    provisioning_model: str = "STANDARD",
+    fallback_zones: Optional[List[str]] = None,
+    warm_standby: bool = False,
+    working_day_start: Optional[str] = None,
+    scratch_filesystem: str = "ext4",
+    docker_on_local_ssd: bool = False,
+    scratch_mounts: Optional[List[str]] = None,
+    max_concurrent_downloads: Optional[int] = None,
+    registry_mirrors: Optional[List[str]] = None,
+    containerd_snapshotter: bool = False,
+    registry_cache: Optional[str] = None,
+    connection_mode: str = "iap",
+    direct_source_ranges: Optional[List[str]] = None,
+    forwarded_ports: Optional[List[int]] = None,
 ):
+    """Set up everything the instance needs. The steps are run as a dependency graph so that slow,
+    independent steps (ie: waiting for a new service account's permissions to propagate and creating
+    the disk) overlap."""
     assert zone
     assert project
     assert pd_name
 
-    if not gcp.has_access_to_docker_image(service_account, docker_image):
-        print(gcp.get_grant_instructions(service_account, docker_image))
-        return 1
-
     assert not config_exists(name), f"{name} appears to already have a config stored"
 
-    ensure_firewall_setup(project)
+    scratch_mounts = scratch_mounts or []
+    assert local_ssd_count > 0 or (
+        not docker_on_local_ssd and len(scratch_mounts) == 0
+    ), "--docker-on-local-ssd and --scratch-mount require --local-ssd-count to be at least 1"
+    for path in scratch_mounts:
+        assert path.startswith("/") and path not in [
+            "/tmp",
+            "/home/ubuntu",
+        ], f"scratch mount {repr(path)} must be an absolute path other than /tmp and /home/ubuntu"
+
+    direct_source_ranges = direct_source_ranges or []
+    forwarded_ports = forwarded_ports or []
+    assert (
+        CONTAINER_SSHD_PORT not in forwarded_ports
+    ), f"port {CONTAINER_SSHD_PORT} is always forwarded (it's sshd)"
+    assert (
+        connection_mode in CONNECTION_MODES
+    ), f"connection mode must be one of {', '.join(CONNECTION_MODES)}"
+    assert connection_mode != "direct" or (
+        len(direct_source_ranges) > 0
+    ), "--connection-mode direct requires --direct-source-ranges (ie: the address range of your VPN)"
+
+    disk_created = False
+    # the name the image will be pulled by, which is what the service account needs access to
+    cached_docker_image = get_cached_docker_image(
+        docker_image, registry_cache, zone, project
+    )
+
+    def _setup_service_account():
+        nonlocal service_account
+        service_account = create_service_account.get_or_create_default_service_account(
+            project, enable=False
+        )
+
+    def _check_docker_image():
+        try:
+            image_check.check_docker_image(service_account, cached_docker_image)
+        except gcp.AccessDenied:
+            raise DockerAccessDenied()
+
+    def _create_volume():
+        nonlocal disk_created
+        create_volume(
+            pd_name,
+            drive_size,
+            drive_type,
+            name,
+            service_account,
+            zone,
+            project,
+            machine_type,
+            format_strategy,
+        )
+        disk_created = True
+
+    steps = []
+    # steps which need the compute API to be enabled
+    api_dependencies = []
+    # steps which need the service account to exist
+    service_account_dependencies = []
+    if service_account is None:
+        if not create_service_account.has_default_service_account(project):
+            steps.append(
+                Step(
+                    "enable-apis",
+                    lambda: create_service_account.enable_apis(project),
+                )
+            )
+            api_dependencies = ["enable-apis"]
+        steps.append(Step("service-account", _setup_service_account, api_dependencies))
+        service_account_dependencies = ["service-account"]
+
+    docker_image_dependencies = list(service_account_dependencies)
+    if cached_docker_image != docker_image:
+        steps.append(
+            Step(
+                "registry-cache",
+                lambda: ensure_registry_cache(
+                    docker_image, registry_cache, zone, project
+                ),
+            )
+        )
+        docker_image_dependencies.append("registry-cache")
 
-    create_volume(
-        pd_name,
-        drive_size,
-        drive_type,
-        name,
-        service_account,
-        zone,
-        project,
-        machine_type,
+    steps.extend(
+        [
+            Step("docker-image", _check_docker_image, docker_image_dependencies),
+            Step(
+                "firewall",
+                lambda: ensure_firewall_setup(
+                    project, direct_source_ranges, forwarded_ports
+                ),
+                api_dependencies,
+            ),
+            Step(
+                "disk",
+                _create_volume,
+                # the temporary VM runs as the service account, but the lazy strategy only needs the disk
+                api_dependencies
+                + (service_account_dependencies if format_strategy == "vm" else []),
+            ),
+        ]
     )
+
+    start_time = time.time()
+    try:
+        run_steps(steps)
+    except (DockerAccessDenied, image_check.InvalidDockerImage) as ex:
+        if isinstance(ex, DockerAccessDenied):
+            print(
+                gcp.get_grant_instructions(
+                    service_account, docker_image, cached_docker_image
+                )
+            )
+        else:
+            print(ex)
+        if disk_created:
+            # so that create can be re-run once access has been granted (or the image has been fixed)
+            print(f"Deleting persistent disk {pd_name} since create did not complete")
+            gcp.gcloud(
+                [
+                    "compute",
+                    "disks",
+                    "delete",
+                    pd_name,
+                    f"--zone={zone}",
+                    f"--project={project}",
+                ],
+                timeout=LONG_OPERATION_TIMEOUT,
+            )
+        return 1
+
+    assert service_account is not None
     print(
-        f"Successfully created {drive_size}GB filesystem on persistent disk {pd_name}"
+        f"Successfully created {drive_size}GB persistent disk {pd_name} in {time.time() - start_time:.1f} seconds (format strategy: {format_strategy})"
     )
 
     write_instance_config(
@@ -222,6 +508,23 @@ def create(
             service_account=service_account,
             boot_disk_size_in_gb=boot_disk_size_in_gb,
             local_ssd_count=local_ssd_count,
+            format_strategy=format_strategy,
+            disk_size_in_gb=int(drive_size),
+            disk_type=drive_type,
+            provisioning_model=provisioning_model,
+            fallback_zones=fallback_zones or [],
+            warm_standby=warm_standby,
+            working_day_start=working_day_start,
+            scratch_filesystem=scratch_filesystem,
+            docker_on_local_ssd=docker_on_local_ssd,
+            scratch_mounts=scratch_mounts,
+            max_concurrent_downloads=max_concurrent_downloads,
+            registry_mirrors=registry_mirrors or [],
+            containerd_snapshotter=containerd_snapshotter,
+            registry_cache=registry_cache,
+            connection_mode=connection_mode,
+            direct_source_ranges=direct_source_ranges,
+            forwarded_ports=allocate_forwarded_ports(forwarded_ports, local_port),
         )
     )
 
@@ -273,12 +576,16 @@ def add_command(subparser):
         else:
             local_port = args.local_port
 
-        if args.service_account:
-            service_account = args.service_account
-        else:
-            service_account = (
-                create_service_account.get_or_create_default_service_account(project)
-            )
+        fallback_zones = []
+        if args.fallback_zones:
+            fallback_zones = args.fallback_zones.split(",")
+
+        direct_source_ranges = []
+        if args.direct_source_ranges:
+            direct_source_ranges = args.direct_source_ranges.split(",")
+
+        # if not specified, the default service account is looked up (or created) as part of create
+        service_account = args.service_account
 
         create(
             args.name,
@@ -294,6 +601,21 @@ def add_command(subparser):
             args.idle_timeout,
             args.boot_disk_size_in_gb,
             args.local_ssd_count,
+            args.format_strategy,
+            args.provisioning_model,
+            fallback_zones,
+            args.warm_standby,
+            args.working_day_start,
+            args.scratch_filesystem,
+            args.docker_on_local_ssd,
+            args.scratch_mounts,
+            args.max_concurrent_downloads,
+            args.registry_mirrors,
+            args.containerd_snapshotter,
+            args.registry_cache,
+            args.connection_mode,
+            direct_source_ranges,
+            args.forwarded_ports,
         )
 
     parser = subparser.add_parser("create", help="Create a new instance config")
@@ -311,6 +633,7 @@ def add_command(subparser):
         default=200,
         help="Size of the home directory volume in GBs (Defaults to 200GB if not specified)",
         dest="disk_size",
+        type=int,
     )
     parser.add_argument(
         "--boot-disk-size",
@@ -365,3 +688,100 @@ def add_command(subparser):
         default=0,
         help="The number of local SSD drives to attach. If at least one local SSD drive is attached, it will be used for the /tmp volume. Note: locally attached SSD drives lose their contents during shutdown, so only temporary files should be placed on these volumes. (Default: 0)",
     )
+    parser.add_argument(
+        "--format-strategy",
+        dest="format_strategy",
+        choices=FORMAT_STRATEGIES,
+        default="lazy",
+        help='How to create the filesystem on the new persistent disk. "lazy" creates it when the instance first boots. "vm" boots a temporary instance during create to format it (the behavior of older versions of hermit). (Default: lazy)',
+    )
+    parser.add_argument(
+        "--spot",
+        dest="provisioning_model",
+        action="store_const",
+        const="SPOT",
+        default="STANDARD",
+        help="If set, use a Spot instance. These cost much less, but GCP may stop them at any time when it needs the capacity back. 'hermit up' will restart a preempted instance.",
+    )
+    parser.add_argument(
+        "--fallback-zones",
+        dest="fallback_zones",
+        help="A comma separated list of zones. If the instance's zone doesn't have the capacity to start the instance, 'hermit up' will copy the persistent disk to the first of these zones that does and move the instance there",
+    )
+    parser.add_argument(
+        "--warm-standby",
+        dest="warm_standby",
+        action="store_true",
+        help="If set, 'hermit down' suspends the instance instead of deleting it, so that 'hermit up' is much quicker (at the cost of paying for the suspended instance's memory and boot disk)",
+    )
+    parser.add_argument(
+        "--working-day-start",
+        dest="working_day_start",
+        help="The time your working day starts (ie: \"09:00\"). Used with --warm-standby so that 'hermit prewarm' can bring the instance up shortly beforehand",
+    )
+    parser.add_argument(
+        "--scratch-filesystem",
+        dest="scratch_filesystem",
+        choices=SCRATCH_FILESYSTEMS,
+        default="ext4",
+        help="The filesystem to create on the local SSD drives (Default: ext4)",
+    )
+    parser.add_argument(
+        "--docker-on-local-ssd",
+        dest="docker_on_local_ssd",
+        action="store_true",
+        help="If set, store docker's images and containers on the local SSD drives instead of the boot disk. This makes container I/O much faster, but images need to be pulled again after the instance has been shut down.",
+    )
+    parser.add_argument(
+        "--scratch-mount",
+        dest="scratch_mounts",
+        action="append",
+        default=[],
+        help="A path in the container (ie: /scratch) to mount a directory on the local SSD drives at. Can be specified multiple times.",
+    )
+    parser.add_argument(
+        "--max-concurrent-downloads",
+        dest="max_concurrent_downloads",
+        type=int,
+        help="How many layers of an image docker downloads at once (Default: docker's default of 3). Images with many large layers pull faster with a higher value.",
+    )
+    parser.add_argument(
+        "--registry-mirror",
+        dest="registry_mirrors",
+        action="append",
+        default=[],
+        help="The URL of a mirror for Docker Hub images (ie: https://mirror.gcr.io). Can be specified multiple times.",
+    )
+    parser.add_argument(
+        "--containerd-snapshotter",
+        dest="containerd_snapshotter",
+        action="store_true",
+        help="If set, have docker use containerd's image store, which supports pulling zstd compressed images (which decompress much faster than gzip compressed ones)",
+    )
+    parser.add_argument(
+        "--registry-cache",
+        dest="registry_cache",
+        nargs="?",
+        const=DEFAULT_REGISTRY_CACHE_NAME,
+        help=f"If set, pull the image through an Artifact Registry remote repository with this name (Default: {DEFAULT_REGISTRY_CACHE_NAME}) in the instance's region, which hermit creates if it doesn't already exist. Instances in the same region then share one copy of the image instead of each pulling it from the region it's hosted in.",
+    )
+    parser.add_argument(
+        "--connection-mode",
+        dest="connection_mode",
+        choices=CONNECTION_MODES,
+        default="iap",
+        help='How ssh connects to the instance. "iap" (the default) goes through an IAP tunnel. "direct" connects to the instance\'s internal IP, which is much faster but only works from the VPC (ie: over a VPN), and falls back to IAP when that isn\'t reachable',
+    )
+    parser.add_argument(
+        "--direct-source-ranges",
+        dest="direct_source_ranges",
+        help='A comma separated list of the address ranges (ie: "10.8.0.0/16") which direct connections come from. A firewall rule is added to allow connections to sshd from these',
+    )
+    parser.add_argument(
+        "--forward-port",
+        dest="forwarded_ports",
+        action="append",
+        type=int,
+        default=[],
+        help="A port on the instance (ie: 8888 for jupyter) which 'hermit up' should forward to a port on localhost (picked the same way as --local-port). Can be specified multiple times.",
+    )
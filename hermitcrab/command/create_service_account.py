@@ -19,15 +19,25 @@ def random_string(length):
     return "".join(random.choice(alphabet) for _ in range(length))
 
 
-def get_or_create_default_service_account(project):
-    # try reading it, and if it does not exist, create one
+def has_default_service_account(project):
+    try:
+        read_default_service_account(project)
+    except NoDefaultServiceAccount:
+        return False
+    return True
+
+
+def get_or_create_default_service_account(project, enable=True):
+    """try reading it, and if it does not exist, create one. If enable is False, the caller is
+    responsible for having already called enable_apis(project)"""
     try:
         return read_default_service_account(project)
     except NoDefaultServiceAccount:
         print(
             "Appears this may be the first time you've used hermit -- creating service account and enabling APIs"
         )
-        enable_apis(project)
+        if enable:
+            enable_apis(project)
         create_service_account(project, None)
 
     return read_default_service_account(project)
@@ -1,6 +1,7 @@
+from .. import agent
 from .. import gcp
 from ..tunnel import is_tunnel_running, stop_tunnel
-from ..config import get_instance_config, LONG_OPERATION_TIMEOUT
+from ..config import get_instance_config, update_instance_state, LONG_OPERATION_TIMEOUT
 import time
 import subprocess
 
@@ -29,13 +30,37 @@ def wait_for_instance_termination(instance_config, timeout):
         time.sleep(2)
 
 
-def down(name: str):
+def suspend_instance(instance_config):
+    print(f"Suspending {instance_config.name}...")
+    options = []
+    if instance_config.local_ssd_count > 0:
+        options.append("--discard-local-ssd=false")
+    gcp.gcloud(
+        [
+            "compute",
+            "instances",
+            "suspend",
+            instance_config.name,
+            f"--zone={instance_config.zone}",
+            f"--project={instance_config.project}",
+        ]
+        + options,
+        timeout=LONG_OPERATION_TIMEOUT,
+    )
+
+
+def down(name: str, delete: bool = False):
     instance_config = get_instance_config(name)
 
     if is_tunnel_running(instance_config.name):
         stop_tunnel(instance_config.name)
     else:
         print("Tunnel appears to already be stopped")
+    for remote_port in instance_config.forwarded_ports:
+        stop_tunnel(instance_config.name, int(remote_port))
+
+    # the instance is about to stop, so 'hermit proxy' should check before connecting
+    update_instance_state(instance_config.name, last_seen_running=None)
 
     status = gcp.get_instance_status(
         instance_config.name,
@@ -45,24 +70,33 @@ def down(name: str):
     )
     if status is None:
         print(f"Instance appears to be offline already.")
+    elif instance_config.warm_standby and not delete:
+        # keep the instance so that the next 'hermit up' only needs to resume it
+        if status == "RUNNING":
+            suspend_instance(instance_config)
+        else:
+            print(f"Instance is {status}, leaving it as is")
     else:
         if status == "RUNNING":
             print(f"Requesting graceful shutdown of {instance_config.name}...")
 
             try:
-                gcp.gcloud(
-                    [
-                        "compute",
-                        "ssh",
-                        instance_config.name,
-                        "--tunnel-through-iap",
-                        f"--zone={instance_config.zone}",
-                        f"--project={instance_config.project}",
-                        "--command",
-                        "sudo shutdown now",
-                    ],
-                    timeout=20,
-                )
+                if agent.has_agent(instance_config.name):
+                    agent.send_command(instance_config, "shutdown")
+                else:
+                    gcp.gcloud(
+                        [
+                            "compute",
+                            "ssh",
+                            instance_config.name,
+                            "--tunnel-through-iap",
+                            f"--zone={instance_config.zone}",
+                            f"--project={instance_config.project}",
+                            "--command",
+                            "sudo shutdown now",
+                        ],
+                        timeout=20,
+                    )
             except subprocess.TimeoutExpired:
                 print("Timeout expired waiting for command to terminate")
 
@@ -89,7 +123,7 @@ def down(name: str):
 
 def add_command(subparser):
     def _down(args):
-        down(args.name)
+        down(args.name, args.delete)
 
     parser = subparser.add_parser(
         "down",
@@ -102,3 +136,8 @@ def add_command(subparser):
         nargs="?",
         default="default",
     )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="If set, delete the instance even if the config has warm_standby set (which otherwise means the instance is suspended)",
+    )
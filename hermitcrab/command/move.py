@@ -0,0 +1,140 @@
+import dataclasses
+import re
+
+from .. import gcp
+from ..config import (
+    get_instance_config,
+    read_instance_state,
+    update_instance_state,
+    write_instance_config,
+    InstanceConfig,
+    LONG_OPERATION_TIMEOUT,
+)
+from ..errors import UserError
+from .create import create_volume
+from .resize import get_disk_type
+from .snapshot import create_snapshot, default_snapshot_name
+
+
+def _moved_pd_name(pd_name: str, zone: str):
+    # ie: "dev-pd" becomes "dev-pd-us-east1-b" and moving that back becomes "dev-pd-us-central1-a"
+    base = re.sub("-[a-z]+-[a-z]+[0-9]+-[a-z]$", "", pd_name)
+    return f"{base}-{zone}"
+
+
+def move_to_zone(instance_config: InstanceConfig, zone: str) -> InstanceConfig:
+    """Copy the persistent disk into another zone via a snapshot, and point the config at the copy.
+    The instance must not be running. Returns the updated config."""
+    status = gcp.get_instance_status(
+        instance_config.name,
+        instance_config.zone,
+        instance_config.project,
+        one_or_none=True,
+    )
+    if status == "TERMINATED":
+        # a stopped instance only holds on to the disk and the (disposable) boot disk
+        print(f"Deleting stopped instance {instance_config.name}...")
+        gcp.gcloud(
+            [
+                "compute",
+                "instances",
+                "delete",
+                instance_config.name,
+                f"--zone={instance_config.zone}",
+                f"--project={instance_config.project}",
+            ],
+            timeout=LONG_OPERATION_TIMEOUT,
+        )
+    elif status is not None:
+        raise UserError(
+            f"{instance_config.name} is {status}. It must be shut down (via 'hermit down {instance_config.name}') before it can be moved to another zone"
+        )
+
+    left_behind_disks = dict(
+        read_instance_state(instance_config.name).get("left_behind_disks", {})
+    )
+    new_pd_name = left_behind_disks.pop(zone, None)
+    if new_pd_name is None:
+        new_pd_name = _moved_pd_name(instance_config.pd_name, zone)
+    # (otherwise the copy would get the default type)
+    disk_type = get_disk_type(instance_config)
+    snapshot_name = default_snapshot_name(instance_config.pd_name)
+
+    create_snapshot(instance_config, snapshot_name)
+    if (
+        gcp.get_disk(new_pd_name, zone, instance_config.project, one_or_none=True)
+        is not None
+    ):
+        print(
+            f"Replacing {new_pd_name}, which was left in {zone} when {instance_config.name} was last moved from there, with an up to date copy..."
+        )
+        gcp.gcloud(
+            [
+                "compute",
+                "disks",
+                "delete",
+                new_pd_name,
+                f"--zone={zone}",
+                f"--project={instance_config.project}",
+            ],
+            timeout=LONG_OPERATION_TIMEOUT,
+        )
+    create_volume(
+        new_pd_name,
+        None,
+        disk_type,
+        instance_config.name,
+        instance_config.service_account,
+        zone,
+        instance_config.project,
+        instance_config.machine_type,
+        source_snapshot=snapshot_name,
+    )
+
+    # the new disk has everything, so the snapshot is no longer needed
+    print(f"Deleting snapshot {snapshot_name}...")
+    gcp.gcloud(
+        [
+            "compute",
+            "snapshots",
+            "delete",
+            snapshot_name,
+            f"--project={instance_config.project}",
+        ],
+        timeout=LONG_OPERATION_TIMEOUT,
+    )
+
+    left_behind_disks[instance_config.zone] = instance_config.pd_name
+    update_instance_state(instance_config.name, left_behind_disks=left_behind_disks)
+    print(
+        f"{instance_config.name} will now use {new_pd_name} in {zone}. The original disk {instance_config.pd_name} has not been deleted. Once you've confirmed everything is working, you can delete it with:\n\n"
+        f"  gcloud compute disks delete {instance_config.pd_name} --zone={instance_config.zone} --project={instance_config.project}\n"
+    )
+
+    instance_config = dataclasses.replace(
+        instance_config, zone=zone, pd_name=new_pd_name, disk_type=disk_type
+    )
+    write_instance_config(instance_config)
+    return instance_config
+
+
+def move(name: str, zone: str):
+    instance_config = get_instance_config(name)
+    if zone == instance_config.zone:
+        print(f"{name} is already in {zone}")
+        return
+    move_to_zone(instance_config, zone)
+    print(f"Execute 'hermit up {name}' to start it in {zone}")
+
+
+def add_command(subparser):
+    def _move(args):
+        move(args.name, args.zone)
+
+    parser = subparser.add_parser(
+        "move",
+        help="Move an instance (and a copy of its persistent disk) to a different zone",
+    )
+    parser.set_defaults(func=_move)
+    parser.add_argument("name", help="The name of the instance config")
+    parser.add_argument("zone", help="The zone to move to (ie: us-east1-b)")
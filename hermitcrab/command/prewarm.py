@@ -0,0 +1,122 @@
+import time
+from typing import List
+
+from .. import agent
+from .. import gcp
+from ..config import get_instance_config, get_instance_names, InstanceConfig
+from ..errors import UserError
+from .up import (
+    resume_instance,
+    start_or_create_instance,
+    wait_for_instance_start,
+)
+
+DAY_NAMES = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+def _parse_time_of_day(value: str):
+    "Parses 'HH:MM' into minutes since midnight"
+    try:
+        hours, minutes = value.split(":")
+        result = int(hours) * 60 + int(minutes)
+    except ValueError:
+        raise UserError(f'Could not parse {repr(value)} as a time of day (ie: "09:00")')
+    if not (0 <= result < 24 * 60):
+        raise UserError(f'{repr(value)} is not a time of day (ie: "09:00")')
+    return result
+
+
+def is_prewarm_time(
+    instance_config: InstanceConfig, now: time.struct_time, lead_time: int
+):
+    "Returns True if the working day of the instance's user starts within the next lead_time minutes"
+    if instance_config.working_day_start is None:
+        return False
+    start = _parse_time_of_day(instance_config.working_day_start)
+    current = now.tm_hour * 60 + now.tm_min
+    day = DAY_NAMES[now.tm_wday]
+    if start - lead_time < 0 and current >= start - lead_time + 24 * 60:
+        # the window starts before midnight, so it belongs to tomorrow's working day
+        day = DAY_NAMES[(now.tm_wday + 1) % 7]
+        current -= 24 * 60
+    return day in instance_config.working_days and start - lead_time <= current < start
+
+
+def prewarm_instance(instance_config: InstanceConfig, verbose: bool):
+    status = gcp.get_instance_status(
+        instance_config.name,
+        instance_config.zone,
+        instance_config.project,
+        one_or_none=True,
+    )
+    if status == "RUNNING":
+        print(f"{instance_config.name} is already running")
+        return
+
+    print(f"Prewarming {instance_config.name} (currently {status or 'OFFLINE'})")
+    if status == "SUSPENDED":
+        resume_instance(instance_config)
+    elif status == "TERMINATED" or status is None:
+        instance_config = start_or_create_instance(instance_config, status)
+    else:
+        print(f"Not prewarming {instance_config.name} because it is {status}")
+        return
+
+    wait_for_instance_start(
+        instance_config,
+        verbose,
+        timeout=60 * 60,
+        via_agent=agent.has_agent(instance_config.name),
+    )
+    print(
+        f"{instance_config.name} is ready. 'hermit up {instance_config.name}' will only need to start the tunnel"
+    )
+
+
+def prewarm(names: List[str], now: bool, lead_time: int, verbose: bool):
+    if len(names) == 0:
+        names = get_instance_names()
+
+    current_time = time.localtime()
+    for name in names:
+        instance_config = get_instance_config(name)
+        if not now:
+            if not instance_config.warm_standby:
+                continue
+            if not is_prewarm_time(instance_config, current_time, lead_time):
+                continue
+        prewarm_instance(instance_config, verbose)
+
+
+def add_command(subparser):
+    def _prewarm(args):
+        prewarm(args.names, args.now, args.lead_time, args.verbose)
+
+    parser = subparser.add_parser(
+        "prewarm",
+        help="Bring up instances which have warm_standby set shortly before their user's working day starts. Intended to be run periodically (ie: from cron)",
+    )
+    parser.set_defaults(func=_prewarm)
+    parser.add_argument(
+        "names",
+        nargs="*",
+        help="The instance configs to consider (Defaults to all of them)",
+    )
+    parser.add_argument(
+        "--now",
+        action="store_true",
+        help="If set, bring up the instances now regardless of their working hours",
+    )
+    parser.add_argument(
+        "--lead-time",
+        dest="lead_time",
+        type=int,
+        default=15,
+        help="How many minutes before the start of the working day to bring instances up. Run prewarm more often than this. (Default: 15)",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="If set, will print more logging information showing the server coming online",
+    )
@@ -0,0 +1,133 @@
+import contextlib
+import sys
+import time
+
+from .. import agent
+from .. import gcp
+from .. import tunnel
+from ..config import (
+    get_instance_config,
+    read_instance_state,
+    update_instance_state,
+    InstanceConfig,
+)
+from ..errors import UserError
+from .up import resume_instance, start_or_create_instance, wait_for_instance_start
+
+# how often the idle monitor on the instance checks for activity (see deploy_scripts/hermit_agent.py)
+IDLE_POLL_SECONDS = 60
+
+
+def _is_known_to_be_running(instance_config: InstanceConfig, now: float):
+    """Returns True if the instance must still be running, without having to ask GCE. The idle monitor
+    only suspends an instance after suspend_on_idle_timeout minutes without any traffic to sshd, so an
+    instance which was running when we last connected to it can't have been suspended since, unless that
+    long has passed."""
+    last_seen_running = read_instance_state(instance_config.name).get(
+        "last_seen_running"
+    )
+    if last_seen_running is None:
+        return False
+    window = instance_config.suspend_on_idle_timeout * 60 - IDLE_POLL_SECONDS
+    return 0 <= now - last_seen_running < window
+
+
+def wake_instance(instance_config: InstanceConfig):
+    "Make sure the instance is running, resuming or starting it if needed, and wait until sshd is ready"
+    status = gcp.get_instance_status(
+        instance_config.name,
+        instance_config.zone,
+        instance_config.project,
+        one_or_none=True,
+    )
+    if status is None:
+        raise UserError(
+            f"Instance {instance_config.name} does not exist. Run 'hermit up {instance_config.name}' to create it."
+        )
+
+    # let any transition which is underway finish before deciding what to do
+    if status == "SUSPENDING":
+        gcp.wait_for_instance_status(
+            instance_config.name,
+            instance_config.zone,
+            instance_config.project,
+            "SUSPENDED",
+        )
+        status = "SUSPENDED"
+    elif status == "STOPPING":
+        gcp.wait_for_instance_status(
+            instance_config.name,
+            instance_config.zone,
+            instance_config.project,
+            "TERMINATED",
+        )
+        status = "TERMINATED"
+
+    if status == "RUNNING":
+        return instance_config
+
+    if status == "SUSPENDED":
+        resume_instance(instance_config)
+    elif status == "TERMINATED":
+        instance_config = start_or_create_instance(instance_config, status)
+    elif status not in ["PROVISIONING", "STAGING"]:
+        raise UserError(
+            f"Instance {instance_config.name} is {status}, so can't connect to it"
+        )
+
+    wait_for_instance_start(
+        instance_config,
+        False,
+        timeout=60 * 60,
+        via_agent=agent.has_agent(instance_config.name),
+    )
+    return instance_config
+
+
+def wake_instance_unless_known_running(instance_config: InstanceConfig):
+    "Like wake_instance, but skips checking the instance's status if it must still be running"
+    if _is_known_to_be_running(instance_config, time.time()):
+        return instance_config
+    instance_config = wake_instance(instance_config)
+    update_instance_state(instance_config.name, last_seen_running=time.time())
+    return instance_config
+
+
+def proxy(name: str):
+    instance_config = get_instance_config(name)
+
+    if _is_known_to_be_running(instance_config, time.time()):
+        # go through the tunnel 'hermit up' started, rather than starting another gcloud for each connection
+        exit_code = tunnel.splice_stdio_to_local_port(instance_config.local_port)
+        if exit_code is not None:
+            update_instance_state(instance_config.name, last_seen_running=time.time())
+            return exit_code
+
+    # stdout is the ssh connection, so anything we have to say goes to stderr, which ssh shows the user
+    with contextlib.redirect_stdout(sys.stderr):
+        instance_config = wake_instance(instance_config)
+    update_instance_state(instance_config.name, last_seen_running=time.time())
+
+    exit_code = tunnel.run_tunnel_on_stdio(
+        instance_config.name, instance_config.zone, instance_config.project
+    )
+
+    if exit_code == 0:
+        # there was traffic until now, so the idle monitor won't suspend the instance for a while
+        update_instance_state(instance_config.name, last_seen_running=time.time())
+    else:
+        # perhaps the instance was stopped some other way, so check next time
+        update_instance_state(instance_config.name, last_seen_running=None)
+    return exit_code
+
+
+def add_command(subparser):
+    def _proxy(args):
+        return proxy(args.name)
+
+    parser = subparser.add_parser(
+        "proxy",
+        help="Connect stdin and stdout to sshd on the instance, resuming it first if it's suspended or stopped. This is used as the ProxyCommand in the ssh config which 'hermit up' writes",
+    )
+    parser.set_defaults(func=_proxy)
+    parser.add_argument("name", help="The name of the instance")
@@ -0,0 +1,226 @@
+import re
+import shlex
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+from .. import agent
+from .. import gcp
+from .. import image_check
+from .. import registry_cache
+from ..config import (
+    get_instance_config,
+    read_instance_state,
+    update_instance_state,
+    InstanceConfig,
+)
+from ..errors import UserError
+
+# the files on the VM which refer to the docker image the container runs (the agent is sent this list
+# with each refresh-image command)
+CONTAINER_IMAGE_FILES = [
+    "/etc/systemd/system/container-sshd.service",
+    "/home/cloudservice/pull-image.sh",
+]
+
+
+def _create_refresh_script(refresh_id: str, current_image: str, new_image: str):
+    "The refresh for instances without the agent (which does the same thing for the others)"
+    # the old container keeps running while the new image is pulled, so the only interruption is
+    # the restart of the container at the end
+    files = " ".join(CONTAINER_IMAGE_FILES)
+    return f"""
+echo "Refresh {refresh_id} started: {current_image} -> {new_image}"
+export HOME=/home/cloudservice
+start=$(date +%s)
+if docker pull {new_image} ; then
+  echo "Refresh {refresh_id} pulled {new_image} in $(( $(date +%s) - start )) seconds"
+  sed -i 's|{current_image}|{new_image}|g' {files}
+  systemctl daemon-reload
+  systemctl restart container-sshd.service
+  rc=$?
+else
+  rc=1
+fi
+echo "Refresh {refresh_id} finished (exit code $rc)"
+"""
+
+
+def _ssh_command(instance_config: InstanceConfig, command: str):
+    return [
+        "compute",
+        "ssh",
+        instance_config.name,
+        f"--project",
+        instance_config.project,
+        f"--zone",
+        instance_config.zone,
+        "--tunnel-through-iap",
+        f"--command",
+        command,
+    ]
+
+
+def start_refresh(instance_config: InstanceConfig, current_image: str, new_image: str):
+    "Starts pulling the new image and swapping the container over in the background on the VM. Returns an ID which identifies it in the log"
+    if agent.has_agent(instance_config.name):
+        return agent.send_command(
+            instance_config,
+            "refresh-image",
+            current_image=current_image,
+            new_image=new_image,
+            files=CONTAINER_IMAGE_FILES,
+        )
+
+    refresh_id = uuid.uuid4().hex[:8]
+    script = _create_refresh_script(refresh_id, current_image, new_image)
+    # detach from the ssh session so that closing the connection doesn't stop it
+    background = (
+        f"nohup sh -c {shlex.quote(script)} >> /var/log/hermit.log 2>&1 < /dev/null &"
+    )
+    gcp.gcloud(
+        _ssh_command(instance_config, f"sudo sh -c {shlex.quote(background)}"),
+        timeout=60,
+    )
+    return refresh_id
+
+
+def _read_log(instance_config: InstanceConfig):
+    if agent.has_agent(instance_config.name):
+        log_content = agent.read_log(instance_config)
+        if log_content is not None:
+            return log_content
+
+    stdout, stderr = gcp.gcloud_capturing_output(
+        _ssh_command(instance_config, "cat /var/log/hermit.log"),
+        ignore_error=True,
+        retries_on_timeout=10,
+    )
+    if stderr != "":
+        gcp.log_info(f"stderr from compute ssh poll command: {stderr}")
+    return stdout
+
+
+def get_refresh_status_from_log(
+    log_content: str, refresh_id: str
+) -> Tuple[Optional[int], List[str]]:
+    "Given the contents of /var/log/hermit.log, return a tuple of (exit_code:Optional[int], summary:List[str]) for the given refresh. exit_code is None if the refresh is still running."
+    status = []
+    exit_code = None
+
+    start_index = log_content.find(f"Refresh {refresh_id} started")
+    if start_index < 0:
+        return exit_code, status
+    log_content = log_content[start_index:]
+
+    for pattern in [
+        f"^(Refresh {refresh_id} started: .*)$",
+        f"^(Refresh {refresh_id} pulled .*)$",
+    ]:
+        m = re.search(pattern, log_content, re.MULTILINE)
+        if m:
+            status.append(m.group(1))
+
+    m = re.search(
+        f"^(Refresh {refresh_id} finished \\(exit code (\\d+)\\))$",
+        log_content,
+        re.MULTILINE,
+    )
+    if m:
+        status.append(m.group(1))
+        exit_code = int(m.group(2))
+
+    return exit_code, status
+
+
+def wait_for_refresh(
+    instance_config: InstanceConfig,
+    refresh_id: str,
+    output_callback=print,
+    poll_frequency=5,
+):
+    last_status = None
+    start_time = time.time()
+    while True:
+        exit_code, status = get_refresh_status_from_log(
+            _read_log(instance_config), refresh_id
+        )
+        if len(status) > 0 and status[-1] != last_status:
+            output_callback(f"[from /var/log/hermit.log] {status[-1]}")
+            last_status = status[-1]
+
+        if exit_code is not None:
+            if exit_code != 0:
+                raise UserError(
+                    f"Refreshing the image on the instance failed (exit code {exit_code}). Look at /var/log/hermit.log on the VM for details."
+                )
+            output_callback(
+                f"Refresh completed in {time.time() - start_time:.1f} seconds"
+            )
+            return
+
+        time.sleep(poll_frequency)
+
+
+def refresh_image(name: str):
+    instance_config = get_instance_config(name)
+
+    status = gcp.get_instance_status(
+        instance_config.name,
+        instance_config.zone,
+        instance_config.project,
+        one_or_none=True,
+    )
+    if status is None:
+        print(
+            f"Instance {instance_config.name} is not running. 'hermit up {name}' will use the latest version of {instance_config.docker_image}"
+        )
+        return
+    if status != "RUNNING":
+        raise UserError(
+            f"Instance {instance_config.name} is not running (status: {status}). Run 'hermit up {name}' first."
+        )
+
+    docker_image = registry_cache.get_instance_docker_image(instance_config)
+    try:
+        image_manifest = image_check.check_docker_image(
+            instance_config.service_account, docker_image
+        )
+    except gcp.AccessDenied:
+        print(
+            gcp.get_grant_instructions(
+                instance_config.service_account,
+                instance_config.docker_image,
+                docker_image,
+            )
+        )
+        return 1
+
+    new_image = gcp.pin_docker_image_name(docker_image, image_manifest.digest)
+    # instances created by older versions of hermit ran the image by tag
+    current_image = read_instance_state(name).get("docker_image", docker_image)
+    if current_image == new_image:
+        print(
+            f"{instance_config.name} is already running the latest version of {instance_config.docker_image}"
+        )
+        return
+
+    print(f"Pulling {new_image} on {instance_config.name}...")
+    refresh_id = start_refresh(instance_config, current_image, new_image)
+    wait_for_refresh(instance_config, refresh_id)
+    update_instance_state(name, docker_image=new_image)
+    print(
+        f"{instance_config.name} is now running {new_image}. Connections to it were restarted."
+    )
+
+
+def add_command(subparser):
+    def _refresh_image(args):
+        return refresh_image(args.name)
+
+    parser = subparser.add_parser(
+        "refresh-image",
+        help="Switch a running instance over to the latest version of its docker image's tag, without restarting the VM",
+    )
+    parser.set_defaults(func=_refresh_image)
+    parser.add_argument("name", help="The name of the instance")
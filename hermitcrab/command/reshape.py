@@ -0,0 +1,125 @@
+import dataclasses
+import json
+import os
+import time
+from typing import List
+
+from .. import gcp
+from ..config import (
+    get_instance_config,
+    write_instance_config,
+    get_machine_type_cache_dir,
+    ensure_dir_exists,
+)
+from ..errors import UserError
+
+# the machine types available in a zone rarely change, so avoid listing them (which is slow) every time
+MACHINE_TYPE_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+
+def _get_machine_type_cache_path(project: str, zone: str):
+    return os.path.join(get_machine_type_cache_dir(), f"{project}-{zone}.json")
+
+
+def get_machine_types(project: str, zone: str, refresh=False) -> List[str]:
+    "Returns the names of the machine types available in the zone, using a local cache if it's recent enough"
+    cache_path = _get_machine_type_cache_path(project, zone)
+    if not refresh and os.path.exists(cache_path):
+        with open(cache_path, "rt") as fd:
+            cached = json.load(fd)
+        if time.time() - cached["timestamp"] < MACHINE_TYPE_CACHE_MAX_AGE:
+            return cached["machine_types"]
+
+    machine_types = gcp.gcloud_capturing_json_output(
+        [
+            "compute",
+            "machine-types",
+            "list",
+            f"--zones={zone}",
+            "--format=json(name)",
+            f"--project={project}",
+        ]
+    )
+    names = sorted([machine_type["name"] for machine_type in machine_types])
+
+    ensure_dir_exists(os.path.dirname(cache_path))
+    with open(cache_path, "wt") as fd:
+        fd.write(json.dumps({"timestamp": time.time(), "machine_types": names}))
+
+    return names
+
+
+def get_machine_type_name(instance):
+    # machineType is a URL like https://www.googleapis.com/compute/v1/projects/P/zones/Z/machineTypes/n2-standard-2
+    return instance["machineType"].split("/")[-1]
+
+
+def set_machine_type(name: str, zone: str, project: str, machine_type: str):
+    "Change the machine type of an instance. The instance must be TERMINATED"
+    print(f"Changing machine type of {name} to {machine_type}...")
+    gcp.gcloud(
+        [
+            "compute",
+            "instances",
+            "set-machine-type",
+            name,
+            f"--machine-type={machine_type}",
+            f"--zone={zone}",
+            f"--project={project}",
+        ]
+    )
+
+
+def reshape(name: str, machine_type: str, refresh: bool):
+    instance_config = get_instance_config(name)
+
+    machine_types = get_machine_types(
+        instance_config.project, instance_config.zone, refresh
+    )
+    if machine_type not in machine_types:
+        raise UserError(
+            f"{machine_type} is not available in {instance_config.zone}. (If it was recently added, try again with --refresh)"
+        )
+
+    write_instance_config(
+        dataclasses.replace(instance_config, machine_type=machine_type)
+    )
+    print(
+        f"Changed the machine type of {instance_config.name} from {instance_config.machine_type} to {machine_type}"
+    )
+
+    status = gcp.get_instance_status(
+        instance_config.name,
+        instance_config.zone,
+        instance_config.project,
+        one_or_none=True,
+    )
+    if status == "RUNNING":
+        print(
+            f"The instance is currently running. The new machine type will be used after 'hermit down {name}' and 'hermit up {name}'"
+        )
+    else:
+        print(
+            f"The new machine type will be used the next time 'hermit up {name}' is run"
+        )
+
+
+def add_command(subparser):
+    def _reshape(args):
+        reshape(args.name, args.machine_type, args.refresh)
+
+    parser = subparser.add_parser(
+        "reshape",
+        help="Change the machine type used for an instance (applied the next time the instance is brought up)",
+    )
+    parser.set_defaults(func=_reshape)
+    parser.add_argument("name", help="The name of the instance config")
+    parser.add_argument(
+        "machine_type",
+        help="The new machine type (see: https://cloud.google.com/compute/docs/machine-resource )",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="If set, ignore the locally cached list of machine types available in the zone",
+    )
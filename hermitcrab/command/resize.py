@@ -0,0 +1,204 @@
+import dataclasses
+import re
+import time
+from typing import Optional
+
+from .. import gcp
+from ..config import (
+    get_instance_config,
+    write_instance_config,
+    InstanceConfig,
+    LONG_OPERATION_TIMEOUT,
+)
+from ..errors import UserError
+from .create import create_volume
+from .snapshot import create_snapshot, default_snapshot_name
+
+DISK_TYPES = ["pd-standard", "pd-balanced", "pd-ssd", "pd-extreme"]
+
+
+def grow_filesystem(instance_config: InstanceConfig):
+    "Grow the filesystem to fill the disk while it's mounted on the running instance"
+    print(f"Growing filesystem on {instance_config.pd_name}...")
+    stdout, stderr = gcp.gcloud_capturing_output(
+        [
+            "compute",
+            "ssh",
+            instance_config.name,
+            f"--project",
+            instance_config.project,
+            f"--zone",
+            instance_config.zone,
+            "--tunnel-through-iap",
+            f"--command",
+            f"sudo resize2fs /dev/disk/by-id/google-{instance_config.pd_name}",
+        ]
+    )
+    gcp.log_info(f"resize2fs output: {stdout}{stderr}")
+
+
+def _get_disk(pd_name: str, zone: str, project: str):
+    disk = gcp.get_disk(pd_name, zone, project, one_or_none=True)
+    if disk is None:
+        raise UserError(f"Could not find the persistent disk {pd_name} in {zone}")
+    return disk
+
+
+def get_disk_type(instance_config: InstanceConfig):
+    "The type of the instance's disk, which configs written by older versions of hermit don't record"
+    if instance_config.disk_type is not None:
+        return instance_config.disk_type
+    disk = _get_disk(
+        instance_config.pd_name, instance_config.zone, instance_config.project
+    )
+    return gcp.get_disk_type(disk)
+
+
+def resize_disk(instance_config: InstanceConfig, size_in_gb: int, status):
+    disk = _get_disk(
+        instance_config.pd_name, instance_config.zone, instance_config.project
+    )
+    current_size = int(disk["sizeGb"])
+    if size_in_gb < current_size:
+        raise UserError(
+            f"Persistent disks can only grow: {instance_config.pd_name} is already {current_size}GB"
+        )
+
+    if size_in_gb > current_size:
+        print(
+            f"Resizing {instance_config.pd_name} from {current_size}GB to {size_in_gb}GB..."
+        )
+        gcp.gcloud(
+            [
+                "compute",
+                "disks",
+                "resize",
+                instance_config.pd_name,
+                f"--size={size_in_gb}",
+                f"--zone={instance_config.zone}",
+                f"--project={instance_config.project}",
+                "--quiet",
+            ],
+            timeout=LONG_OPERATION_TIMEOUT,
+        )
+
+    if status == "RUNNING":
+        grow_filesystem(instance_config)
+    else:
+        # the bootcmd always runs resize2fs after mounting the disk
+        print(
+            "The filesystem will be grown to fill the disk the next time the instance boots"
+        )
+        if status == "SUSPENDED":
+            print(
+                f"(Resuming does not boot the instance, so to grow it sooner run 'hermit up {instance_config.name}' and then re-run this command)"
+            )
+
+    return dataclasses.replace(instance_config, disk_size_in_gb=size_in_gb)
+
+
+def _migrated_pd_name(pd_name: str, disk_type: str):
+    # ie: "dev-pd" becomes "dev-pd-ssd" and "dev-pd-ssd" becomes "dev-pd-balanced"
+    base = re.sub("-(" + "|".join(DISK_TYPES + ["pd"]) + ")$", "", pd_name)
+    return f"{base}-{disk_type}"
+
+
+def migrate_disk_type(
+    instance_config: InstanceConfig, disk_type: str, size_in_gb: Optional[int]
+):
+    "Copy the disk onto a new disk of a different type via a snapshot"
+    new_pd_name = _migrated_pd_name(instance_config.pd_name, disk_type)
+    snapshot_name = default_snapshot_name(instance_config.pd_name)
+
+    create_snapshot(instance_config, snapshot_name)
+    create_volume(
+        new_pd_name,
+        size_in_gb,
+        disk_type,
+        instance_config.name,
+        instance_config.service_account,
+        instance_config.zone,
+        instance_config.project,
+        instance_config.machine_type,
+        source_snapshot=snapshot_name,
+    )
+
+    print(
+        f"The instance will now use {new_pd_name}. The original disk {instance_config.pd_name} and snapshot {snapshot_name} have not been deleted. Once you've confirmed everything is working, you can delete them with:\n\n"
+        f"  gcloud compute disks delete {instance_config.pd_name} --zone={instance_config.zone} --project={instance_config.project}\n"
+        f"  gcloud compute snapshots delete {snapshot_name} --project={instance_config.project}\n"
+    )
+    disk = _get_disk(new_pd_name, instance_config.zone, instance_config.project)
+    return dataclasses.replace(
+        instance_config,
+        pd_name=new_pd_name,
+        disk_type=disk_type,
+        disk_size_in_gb=int(disk["sizeGb"]),
+    )
+
+
+def resize(name: str, size_in_gb: Optional[int], disk_type: Optional[str]):
+    instance_config = get_instance_config(name)
+
+    if size_in_gb is None and disk_type is None:
+        raise UserError("Specify a new size and/or --disk-type")
+
+    status = gcp.get_instance_status(
+        instance_config.name,
+        instance_config.zone,
+        instance_config.project,
+        one_or_none=True,
+    )
+
+    if disk_type is not None:
+        # (so that an old config doesn't cause a needless migration to the type the disk already is)
+        instance_config = dataclasses.replace(
+            instance_config, disk_type=get_disk_type(instance_config)
+        )
+
+    start_time = time.time()
+    if disk_type is not None and disk_type != instance_config.disk_type:
+        if status is not None:
+            # with warm standby, a plain 'hermit down' only suspends the instance
+            down_command = (
+                f"hermit down --delete {name}"
+                if instance_config.warm_standby
+                else f"hermit down {name}"
+            )
+            raise UserError(
+                f"The disk type can only be changed while the instance is offline. Run '{down_command}' first."
+            )
+        instance_config = migrate_disk_type(instance_config, disk_type, size_in_gb)
+    elif size_in_gb is None:
+        print(f"{instance_config.pd_name} is already {disk_type}")
+        write_instance_config(instance_config)
+        return
+    else:
+        instance_config = resize_disk(instance_config, size_in_gb, status)
+
+    write_instance_config(instance_config)
+    print(f"Finished in {time.time() - start_time:.1f} seconds")
+
+
+def add_command(subparser):
+    def _resize(args):
+        resize(args.name, args.size, args.disk_type)
+
+    parser = subparser.add_parser(
+        "resize",
+        help="Grow the persistent disk of an instance (the filesystem is grown as well) or move it to a different type of disk",
+    )
+    parser.set_defaults(func=_resize)
+    parser.add_argument("name", help="The name of the instance config")
+    parser.add_argument(
+        "size",
+        type=int,
+        nargs="?",
+        help="The new size of the disk in GB",
+    )
+    parser.add_argument(
+        "--disk-type",
+        dest="disk_type",
+        choices=DISK_TYPES,
+        help="If set, copy the disk onto a new disk of this type (via a snapshot). The instance must be offline (see 'hermit down')",
+    )
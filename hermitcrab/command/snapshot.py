@@ -0,0 +1,143 @@
+import time
+from typing import Optional
+
+from .. import gcp
+from ..config import get_instance_config, InstanceConfig, LONG_OPERATION_TIMEOUT
+
+SCHEDULES = ["hourly", "daily", "weekly"]
+
+
+def default_snapshot_name(pd_name: str):
+    # snapshot names must be lowercase and at most 63 characters
+    return f"{pd_name[:45]}-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}"
+
+
+def create_snapshot(instance_config: InstanceConfig, snapshot_name: str):
+    print(f"Creating snapshot {snapshot_name} of {instance_config.pd_name}...")
+    start_time = time.time()
+    gcp.gcloud(
+        [
+            "compute",
+            "snapshots",
+            "create",
+            snapshot_name,
+            f"--source-disk={instance_config.pd_name}",
+            f"--source-disk-zone={instance_config.zone}",
+            f"--project={instance_config.project}",
+        ],
+        timeout=LONG_OPERATION_TIMEOUT,
+    )
+    print(f"Created snapshot {snapshot_name} in {time.time() - start_time:.1f} seconds")
+
+
+def attach_snapshot_schedule(
+    instance_config: InstanceConfig, schedule: str, retention_days: int
+):
+    "Have GCP take snapshots of the disk automatically, deleting them after retention_days"
+    assert schedule in SCHEDULES
+    policy_name = f"{instance_config.pd_name[:40]}-{schedule}-snapshots"
+    region = gcp.get_region(instance_config.zone)
+
+    if schedule == "hourly":
+        schedule_options = ["--hourly-schedule=1"]
+    elif schedule == "daily":
+        schedule_options = ["--daily-schedule"]
+    else:
+        schedule_options = ["--weekly-schedule=sunday"]
+
+    print(
+        f"Creating {schedule} snapshot schedule {policy_name} (keeping snapshots for {retention_days} days)"
+    )
+    gcp.gcloud(
+        [
+            "compute",
+            "resource-policies",
+            "create",
+            "snapshot-schedule",
+            policy_name,
+            f"--region={region}",
+            f"--max-retention-days={retention_days}",
+            "--start-time=04:00",
+            "--on-source-disk-delete=keep-auto-snapshots",
+        ]
+        + schedule_options
+        + [f"--project={instance_config.project}"]
+    )
+
+    gcp.gcloud(
+        [
+            "compute",
+            "disks",
+            "add-resource-policies",
+            instance_config.pd_name,
+            f"--resource-policies={policy_name}",
+            f"--zone={instance_config.zone}",
+            f"--project={instance_config.project}",
+        ]
+    )
+
+
+def snapshot(
+    name: str,
+    snapshot_name: Optional[str],
+    schedule: Optional[str],
+    retention_days: int,
+):
+    instance_config = get_instance_config(name)
+
+    if schedule is not None:
+        attach_snapshot_schedule(instance_config, schedule, retention_days)
+        return
+
+    status = gcp.get_instance_status(
+        instance_config.name,
+        instance_config.zone,
+        instance_config.project,
+        one_or_none=True,
+    )
+    if status == "RUNNING":
+        print(
+            f"Warning: {instance_config.name} is running, so the snapshot will only contain what has been flushed to disk. Run 'hermit down {name}' first for a consistent snapshot."
+        )
+
+    if snapshot_name is None:
+        snapshot_name = default_snapshot_name(instance_config.pd_name)
+
+    create_snapshot(instance_config, snapshot_name)
+    print(
+        f"To create a new instance from this snapshot execute: hermit clone {name} NEW_NAME --snapshot {snapshot_name}"
+    )
+
+
+def add_command(subparser):
+    def _snapshot(args):
+        snapshot(args.name, args.snapshot_name, args.schedule, args.retention_days)
+
+    parser = subparser.add_parser(
+        "snapshot",
+        help="Snapshot the persistent disk of an instance (or set up a schedule of snapshots)",
+    )
+    parser.set_defaults(func=_snapshot)
+    parser.add_argument(
+        "name",
+        help="The name of the instance config",
+        nargs="?",
+        default="default",
+    )
+    parser.add_argument(
+        "--snapshot-name",
+        dest="snapshot_name",
+        help="The name to give the snapshot (Defaults to the disk name followed by a timestamp)",
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=SCHEDULES,
+        help="If set, instead of taking a snapshot now, attach a schedule so that snapshots are taken automatically",
+    )
+    parser.add_argument(
+        "--retention-days",
+        dest="retention_days",
+        type=int,
+        default=14,
+        help="When used with --schedule, how many days to keep each snapshot (Default: 14)",
+    )
@@ -0,0 +1,207 @@
+import re
+import shlex
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+from .. import gcp
+from ..config import get_instance_config, InstanceConfig
+from ..errors import UserError
+
+# the image the idle monitor already pulls at boot, so it should be cached on the VM
+CLOUD_SDK_IMAGE = "google/cloud-sdk"
+
+# gcloud storage already downloads objects in parallel and splits large objects into slices. These
+# make slicing kick in for moderately sized files too, so single large files can saturate the VM's NIC.
+STORAGE_SETTINGS = {
+    "CLOUDSDK_STORAGE_SLICED_OBJECT_DOWNLOAD_THRESHOLD": "64M",
+    "CLOUDSDK_STORAGE_SLICED_OBJECT_DOWNLOAD_MAX_COMPONENTS": "16",
+}
+
+CONTAINER_HOME = "/home/ubuntu"
+
+# while a file exists in this directory, the idle monitor treats the VM as busy
+BUSY_DIR = "/run/hermit-busy"
+
+
+def get_host_path(pd_name: str, path: str):
+    """Translate a path as seen from inside the container to where it lives on the VM. Only
+    the home directory (stored on the persistent disk) and /tmp are visible from the container.
+    """
+    if path == "/tmp" or path.startswith("/tmp/"):
+        return path
+    if path == CONTAINER_HOME or path.startswith(CONTAINER_HOME + "/"):
+        path = path[len(CONTAINER_HOME) :].lstrip("/")
+    elif path.startswith("/"):
+        raise UserError(
+            f"{path} is not visible from inside the container. Only paths under {CONTAINER_HOME} or /tmp can be used as destinations."
+        )
+    host_home = f"/mnt/disks/{pd_name}/home/ubuntu"
+    if path == "":
+        return host_home
+    return f"{host_home}/{path}"
+
+
+def _create_stage_script(stage_id: str, source: str, host_dest: str):
+    env_options = " ".join([f"-e {k}={v}" for k, v in STORAGE_SETTINGS.items()])
+    return f"""
+echo "Staging {stage_id} started: {source} -> {host_dest}"
+mkdir -p {BUSY_DIR} {shlex.quote(host_dest)}
+touch {BUSY_DIR}/stage-{stage_id}
+docker run --rm --network=host {env_options} -v /mnt/disks:/mnt/disks -v /tmp:/tmp {CLOUD_SDK_IMAGE} gcloud storage cp --recursive {shlex.quote(source)} {shlex.quote(host_dest)}
+rc=$?
+chown -R 2000:2000 {shlex.quote(host_dest)}
+rm -f {BUSY_DIR}/stage-{stage_id}
+echo "Staging {stage_id} finished (exit code $rc)"
+"""
+
+
+def _ssh_command(instance_config: InstanceConfig, command: str):
+    return [
+        "compute",
+        "ssh",
+        instance_config.name,
+        f"--project",
+        instance_config.project,
+        f"--zone",
+        instance_config.zone,
+        "--tunnel-through-iap",
+        f"--command",
+        command,
+    ]
+
+
+def start_staging(instance_config: InstanceConfig, source: str, dest: str):
+    "Starts the copy running in the background on the VM and returns an ID which identifies it in the log"
+    stage_id = uuid.uuid4().hex[:8]
+    host_dest = get_host_path(instance_config.pd_name, dest)
+    script = _create_stage_script(stage_id, source, host_dest)
+    # detach the copy from the ssh session so that closing the connection doesn't stop it
+    background = (
+        f"nohup sh -c {shlex.quote(script)} >> /var/log/hermit.log 2>&1 < /dev/null &"
+    )
+    gcp.gcloud(
+        _ssh_command(instance_config, f"sudo sh -c {shlex.quote(background)}"),
+        timeout=60,
+    )
+    return stage_id
+
+
+def get_stage_status_from_log(
+    log_content: str, stage_id: str
+) -> Tuple[Optional[int], List[str]]:
+    "Given the contents of /var/log/hermit.log, return a tuple of (exit_code:Optional[int], summary:List[str]) for the given staging operation. exit_code is None if the operation is still running."
+    status = []
+    exit_code = None
+
+    start_index = log_content.find(f"Staging {stage_id} started")
+    if start_index < 0:
+        return exit_code, status
+    log_content = log_content[start_index:]
+
+    m = re.search(f"^(Staging {stage_id} started: .*)$", log_content, re.MULTILINE)
+    if m:
+        status.append(m.group(1))
+
+    # gcloud storage redraws its progress line using carriage returns, so just take the last one
+    progress_matches = re.findall(
+        "(Completed files [^\r\n|]+\\|[^\r\n|]+(?:\\|[^\r\n|]+)?)", log_content
+    )
+    if len(progress_matches) > 0:
+        status.append(progress_matches[-1].strip())
+
+    m = re.search(
+        f"^(Staging {stage_id} finished \\(exit code (\\d+)\\))$",
+        log_content,
+        re.MULTILINE,
+    )
+    if m:
+        status.append(m.group(1))
+        exit_code = int(m.group(2))
+
+    return exit_code, status
+
+
+def wait_for_staging(
+    instance_config: InstanceConfig,
+    stage_id: str,
+    output_callback=print,
+    poll_frequency=10,
+):
+    last_status = None
+    start_time = time.time()
+    while True:
+        stdout, stderr = gcp.gcloud_capturing_output(
+            _ssh_command(instance_config, "cat /var/log/hermit.log"),
+            ignore_error=True,
+            retries_on_timeout=10,
+        )
+        if stderr != "":
+            gcp.log_info(f"stderr from compute ssh poll command: {stderr}")
+
+        exit_code, status = get_stage_status_from_log(stdout, stage_id)
+        if len(status) > 0 and status[-1] != last_status:
+            output_callback(f"[from /var/log/hermit.log] {status[-1]}")
+            last_status = status[-1]
+
+        if exit_code is not None:
+            elapsed = time.time() - start_time
+            if exit_code != 0:
+                raise UserError(
+                    f"Copying files on the instance failed (exit code {exit_code}). Look at /var/log/hermit.log on the VM for details."
+                )
+            output_callback(f"Staging completed in {elapsed:.1f} seconds")
+            return
+
+        time.sleep(poll_frequency)
+
+
+def stage(name: str, source: str, dest: str, wait: bool):
+    instance_config = get_instance_config(name)
+
+    if not source.startswith("gs://"):
+        raise UserError(f"Expected a source starting with gs:// but got {source}")
+
+    status = gcp.get_instance_status(
+        instance_config.name,
+        instance_config.zone,
+        instance_config.project,
+        one_or_none=True,
+    )
+    if status != "RUNNING":
+        raise UserError(
+            f"Instance {instance_config.name} is not running (status: {status}). Run 'hermit up {name}' first."
+        )
+
+    print(f"Starting copy of {source} to {dest} on {instance_config.name}...")
+    stage_id = start_staging(instance_config, source, dest)
+
+    if wait:
+        wait_for_staging(instance_config, stage_id)
+    else:
+        print(
+            f"Copy is running in the background on the instance. Progress is logged to /var/log/hermit.log (look for 'Staging {stage_id}')"
+        )
+
+
+def add_command(subparser):
+    def _stage(args):
+        stage(args.name, args.source, args.dest, args.wait)
+
+    parser = subparser.add_parser(
+        "stage",
+        help="Have the instance copy data from Google Cloud Storage directly onto its disk (without the data passing through this machine)",
+    )
+    parser.set_defaults(func=_stage)
+    parser.add_argument("name", help="The name of the instance")
+    parser.add_argument("source", help="The gs:// path to copy from")
+    parser.add_argument(
+        "dest",
+        help="The destination path as seen from inside the container. Relative paths are relative to /home/ubuntu. Paths under /tmp are placed on the local SSD (if the instance has one)",
+    )
+    parser.add_argument(
+        "--no-wait",
+        dest="wait",
+        action="store_false",
+        help="If set, will start the copy and exit without waiting for it to complete",
+    )
@@ -1,3 +1,4 @@
+from .. import agent
 from .. import gcp
 from ..config import (
     get_min_instance_config,
@@ -5,8 +6,12 @@ from ..config import (
     config_exists,
     CONTAINER_SSHD_PORT,
     LONG_OPERATION_TIMEOUT,
+    read_instance_state,
 )
+from ..tunnel import is_tunnel_running
+from .watchdog import describe_tunnel_health, read_tunnel_health
 from typing import Optional
+import time
 
 
 def status(name: Optional[str]):
@@ -41,6 +46,35 @@ def status(name: Optional[str]):
 
         print(f"{instance_config.name} {status} {default_label}")
 
+        state = read_instance_state(instance_config.name)
+        running_image = state.get("docker_image")
+        if status != "OFFLINE" and running_image is not None:
+            print(f"  Image: {running_image}")
+
+        tunnel_health = read_tunnel_health(instance_config.name)
+        if is_tunnel_running(instance_config.name) and tunnel_health is not None:
+            print(f"  Tunnel: {describe_tunnel_health(tunnel_health, time.time())}")
+
+        if status == "RUNNING" and agent.has_agent(instance_config.name):
+            metrics = agent.get_metrics(
+                agent.get_guest_attributes(
+                    instance_config.name, instance_config.zone, instance_config.project
+                )
+            )
+            if metrics is not None:
+                print(f"  Load: {agent.describe_metrics(metrics)}")
+
+        if instance_config.provisioning_model == "SPOT":
+            preemptions = gcp.get_preemptions(
+                instance_config.name, instance_config.zone, instance_config.project
+            )
+            if len(preemptions) == 0:
+                print("  Spot instance, no recent preemptions")
+            else:
+                print(
+                    f"  Spot instance, preempted {len(preemptions)} time(s) recently: {', '.join(preemptions)}"
+                )
+
 
 def add_command(subparser):
     def _status(args):
@@ -0,0 +1,335 @@
+import os
+import re
+import shlex
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Tuple
+
+from ..config import get_instance_config
+from ..errors import UserError
+from .. import gcp
+from .proxy import wake_instance_unless_known_running
+
+# ssh options used for every stream. Each stream is its own ssh connection (and therefore its own
+# connection through the IAP tunnel) so avoid connection sharing, which would funnel all of the streams
+# back through a single connection.
+SSH_COMMAND = ["ssh", "-T", "-x", "-o", "Compression=no", "-o", "ControlMaster=no"]
+
+RSYNC_OPTIONS = ["--archive", "--partial", "--human-readable"]
+
+
+@dataclass
+class FileToSync:
+    path: str
+    size: int
+
+
+@dataclass
+class SyncPlan:
+    rsync_streams: List[List[FileToSync]]
+    tar_batches: List[List[FileToSync]]
+
+
+def _parse_location(location: str) -> Tuple[bool, str]:
+    "Locations starting with ':' refer to a path on the instance. Returns (is_remote, path)"
+    if location.startswith(":"):
+        path = location[1:]
+        if path == "":
+            path = "."
+        return True, path
+    return False, location
+
+
+def _as_dir(path: str):
+    if path.endswith("/"):
+        return path
+    return path + "/"
+
+
+def parse_rsync_dry_run(output: str) -> List[FileToSync]:
+    "Parse the output of rsync --dry-run --out-format='%l %n' into the list of files rsync would transfer"
+    files = []
+    for line in output.split("\n"):
+        m = re.match("^(\\d+) (.+)$", line)
+        if m is None:
+            continue
+        size, path = m.groups()
+        if path.endswith("/"):
+            # directories get created as a side effect of transferring the files within them
+            continue
+        files.append(FileToSync(path, int(size)))
+    return files
+
+
+def plan_transfer(
+    files: List[FileToSync],
+    stream_count: int,
+    small_file_size: int,
+    tar_batch_size: int,
+) -> SyncPlan:
+    """Split the files which need to be transferred into small files which get bundled into tar batches and
+    large files which are spread across rsync streams so that each stream moves roughly the same number of bytes
+    """
+    assert stream_count > 0
+
+    small_files = [f for f in files if f.size < small_file_size]
+    large_files = [f for f in files if f.size >= small_file_size]
+
+    tar_batches = []
+    batch = []
+    batch_size = 0
+    for f in small_files:
+        batch.append(f)
+        batch_size += f.size
+        if batch_size >= tar_batch_size:
+            tar_batches.append(batch)
+            batch = []
+            batch_size = 0
+    if len(batch) > 0:
+        tar_batches.append(batch)
+
+    # assign largest files first, each to the stream with the fewest bytes so far
+    streams = [[] for _ in range(stream_count)]
+    stream_sizes = [0] * stream_count
+    for f in sorted(large_files, key=lambda x: x.size, reverse=True):
+        i = stream_sizes.index(min(stream_sizes))
+        streams[i].append(f)
+        stream_sizes[i] += f.size
+
+    return SyncPlan(
+        rsync_streams=[s for s in streams if len(s) > 0], tar_batches=tar_batches
+    )
+
+
+def _file_list(files: List[FileToSync]):
+    return "".join([f"{f.path}\n" for f in files]).encode("utf8")
+
+
+def _run_checked(cmd, input=None):
+    gcp.log_info(f"Executing: {cmd}")
+    proc = subprocess.run(
+        cmd, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if proc.returncode != 0:
+        raise UserError(
+            f"Executing {cmd} failed (return code: {proc.returncode}). Stderr: {proc.stderr.decode('utf8')}"
+        )
+    return proc.stdout.decode("utf8")
+
+
+def _rsync_location(host, is_remote, path):
+    if is_remote:
+        return f"{host}:{_as_dir(path)}"
+    return _as_dir(path)
+
+
+def _rsync(host, src, dst, extra_options, files=None):
+    src_is_remote, src_path = src
+    dst_is_remote, dst_path = dst
+    cmd = (
+        ["rsync", "-e", " ".join(SSH_COMMAND)]
+        + RSYNC_OPTIONS
+        + extra_options
+        + [
+            _rsync_location(host, src_is_remote, src_path),
+            _rsync_location(host, dst_is_remote, dst_path),
+        ]
+    )
+    if files is None:
+        return _run_checked(cmd)
+    return _run_checked(cmd[:1] + ["--files-from=-"] + cmd[1:], input=_file_list(files))
+
+
+def _tar_pipe(host, src, dst, files):
+    "Copy a batch of small files with a single tar stream instead of per-file round trips"
+    src_is_remote, src_path = src
+    dst_is_remote, dst_path = dst
+
+    create_cmd = ["tar", "-C", src_path, "-cf", "-", "-T", "-"]
+    extract_cmd = ["tar", "-C", dst_path, "-xpf", "-"]
+
+    if src_is_remote:
+        reader_cmd = SSH_COMMAND + [host, shlex.join(create_cmd)]
+        os.makedirs(dst_path, exist_ok=True)
+        writer_cmd = extract_cmd
+    else:
+        reader_cmd = create_cmd
+        writer_cmd = SSH_COMMAND + [
+            host,
+            f"mkdir -p {shlex.quote(dst_path)} && {shlex.join(extract_cmd)}",
+        ]
+
+    gcp.log_info(f"Executing: {reader_cmd} | {writer_cmd}")
+    reader = subprocess.Popen(
+        reader_cmd,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    writer = subprocess.Popen(
+        writer_cmd,
+        stdin=reader.stdout,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    assert (
+        reader.stdin is not None
+        and reader.stdout is not None
+        and reader.stderr is not None
+    )
+    # let the writer be the only one holding the pipe so it gets EOF when reader exits
+    reader.stdout.close()
+    # read the reader's stderr as it's written, as the reader (and so the writer) would block once the pipe
+    # is full of warnings
+    reader_stderr_pipe = reader.stderr
+    reader_stderr_chunks = []
+    stderr_thread = threading.Thread(
+        target=lambda: reader_stderr_chunks.append(reader_stderr_pipe.read())
+    )
+    stderr_thread.start()
+    reader.stdin.write(_file_list(files))
+    reader.stdin.close()
+    _, writer_stderr = writer.communicate()
+    stderr_thread.join()
+    reader_stderr = b"".join(reader_stderr_chunks)
+    reader.wait()
+
+    if reader.returncode != 0 or writer.returncode != 0:
+        raise UserError(
+            f"Copying batch of {len(files)} files with tar failed. Stderr: {reader_stderr.decode('utf8')}{writer_stderr.decode('utf8')}"
+        )
+
+
+def _format_bytes(count):
+    value = float(count)
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if value < 1024 or unit == "TB":
+            return f"{value:.1f} {unit}"
+        value /= 1024
+    raise Exception("Code should not be reachable")
+
+
+def sync(
+    name: str,
+    src: str,
+    dst: str,
+    parallel: int,
+    small_file_size: int,
+    tar_batch_size: int,
+    compress: bool,
+    dry_run: bool,
+):
+    instance_config = get_instance_config(name)
+
+    src_location = _parse_location(src)
+    dst_location = _parse_location(dst)
+    if src_location[0] == dst_location[0]:
+        raise UserError(
+            "Exactly one of the source and destination must be a path on the instance (prefixed with ':')"
+        )
+
+    # each stream connects through 'hermit proxy', which would wake the instance too, but better to do it
+    # once here than from every stream at the same time
+    instance_config = wake_instance_unless_known_running(instance_config)
+
+    host = instance_config.name
+    extra_options = ["--compress"] if compress else []
+
+    # let rsync's delta detection decide which files need to move. After that we can choose how
+    # to move each of them.
+    print("Finding files which need to be transferred...")
+    dry_run_output = _rsync(
+        host,
+        src_location,
+        dst_location,
+        extra_options + ["--dry-run", "--out-format=%l %n"],
+    )
+    files = parse_rsync_dry_run(dry_run_output)
+    total_bytes = sum([f.size for f in files])
+
+    plan = plan_transfer(files, parallel, small_file_size, tar_batch_size)
+    print(
+        f"{len(files)} files ({_format_bytes(total_bytes)}) to transfer: {len(plan.tar_batches)} tar batches of small files and {len(plan.rsync_streams)} rsync streams for large files"
+    )
+    if dry_run or len(files) == 0:
+        return
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [
+            executor.submit(_tar_pipe, host, src_location, dst_location, batch)
+            for batch in plan.tar_batches
+        ] + [
+            executor.submit(
+                _rsync, host, src_location, dst_location, extra_options, stream
+            )
+            for stream in plan.rsync_streams
+        ]
+        for future in futures:
+            # re-raises any exception from the worker
+            future.result()
+
+    # a final pass over the whole tree to sync directory metadata and anything which changed while we were copying
+    _rsync(host, src_location, dst_location, extra_options)
+
+    elapsed = time.time() - start
+    print(
+        f"Transferred {len(files)} files ({_format_bytes(total_bytes)}) in {elapsed:.1f} seconds ({_format_bytes(total_bytes / max(elapsed, 0.001))}/s)"
+    )
+
+
+def add_command(subparser):
+    def _sync(args):
+        sync(
+            args.name,
+            args.src,
+            args.dst,
+            args.parallel,
+            args.small_file_size,
+            args.tar_batch_size,
+            args.compress,
+            args.dry_run,
+        )
+
+    parser = subparser.add_parser(
+        "sync",
+        help="Copy the contents of a directory to or from an instance over its tunnel. Paths on the instance are prefixed with ':' (ie: 'hermit sync default ./data :data')",
+    )
+    parser.set_defaults(func=_sync)
+    parser.add_argument("name", help="The name of the instance")
+    parser.add_argument("src", help="The directory to copy from")
+    parser.add_argument("dst", help="The directory to copy into")
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=4,
+        help="The number of transfers to run at the same time (Default: 4)",
+    )
+    parser.add_argument(
+        "--small-file-size",
+        dest="small_file_size",
+        type=int,
+        default=1024 * 1024,
+        help="Files smaller than this many bytes are bundled into tar batches instead of being sent by rsync (Default: 1MB)",
+    )
+    parser.add_argument(
+        "--tar-batch-size",
+        dest="tar_batch_size",
+        type=int,
+        default=64 * 1024 * 1024,
+        help="The approximate number of bytes to put into each tar batch (Default: 64MB)",
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="If set, will have rsync compress data in transit (useful for uncompressed text data)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="If set, only report what would be transferred",
+    )
@@ -6,31 +6,80 @@ from ..config import (
     CONTAINER_SSHD_PORT,
     LONG_OPERATION_TIMEOUT,
     set_default_instance_config,
+    read_instance_state,
+    update_instance_state,
 )
 import tempfile
-from ..tunnel import is_tunnel_running, stop_tunnel, start_tunnel
+from typing import Optional
+from ..tunnel import is_tunnel_running, stop_tunnel, start_tunnel, probe_ssh_banner
 import pkg_resources
 from ..ssh import update_ssh_config
 import time
 import re
 import io
+import json
 import yaml
 from ..config import InstanceConfig
 from .. import __version__
 import os
 from ..errors import UserError
-
-# change the live-restore flag to false because its incompatible with swarm mode
-# (which is required by miniwdl). The other options were the values in the file before.
-docker_daemon_config = """
-{
-	"live-restore": false,
-	"log-opts": {
-                "tag": "{{.Name}}"
-        },
-	"storage-driver": "overlay2",
-	"mtu": 1460
-}
+from .reshape import get_machine_type_name, set_machine_type
+from .move import move_to_zone
+from .create import ensure_firewall_setup
+from . import watchdog
+from .. import agent
+from .. import placement
+from .. import registry_cache
+from .. import image_check
+
+LOCAL_SSD_MOUNT = "/mnt/disks/local-ssd"
+# with mdadm's default chunk (512K) a typical large request is served by a single SSD. A smaller chunk
+# spreads it over more of them, which is where RAID0's throughput comes from.
+LOCAL_SSD_RAID_CHUNK_KB = 256
+LOCAL_SSD_MOUNT_OPTIONS = "noatime,discard"
+
+
+def _docker_daemon_config(instance_config: InstanceConfig):
+    config = {
+        # live-restore is false because its incompatible with swarm mode (which is required by
+        # miniwdl). The other options were the values in the file before.
+        "live-restore": False,
+        "log-opts": {"tag": "{{.Name}}"},
+        "storage-driver": "overlay2",
+        "mtu": 1460,
+    }
+    if instance_config.docker_on_local_ssd:
+        config["data-root"] = f"{LOCAL_SSD_MOUNT}/docker"
+    if instance_config.max_concurrent_downloads is not None:
+        config["max-concurrent-downloads"] = instance_config.max_concurrent_downloads
+    if len(instance_config.registry_mirrors) > 0:
+        config["registry-mirrors"] = instance_config.registry_mirrors
+    if instance_config.containerd_snapshotter:
+        # containerd's snapshotter replaces the storage driver
+        del config["storage-driver"]
+        config["features"] = {"containerd-snapshotter": True}
+    return json.dumps(config, indent=2)
+
+
+def _credential_helper_registry(docker_image):
+    "The registry docker-credential-gcr should provide credentials for"
+    parsed_image_name = gcp.parse_docker_image_name(docker_image)
+    if isinstance(
+        parsed_image_name, (gcp.ArtifactRegistryPath, gcp.ContainerRegistryPath)
+    ):
+        return parsed_image_name.host
+    return "us-central1-docker.pkg.dev"
+
+
+def _pull_image_script(docker_image):
+    # pull explicitly (rather than leaving it to 'docker run') so that we can report how long it took. A failed
+    # pull fails the ExecStartPre, rather than being reported as pulled.
+    return f"""
+if ! /usr/bin/docker image inspect {docker_image} > /dev/null 2>&1 ; then
+  start=$(date +%s)
+  /usr/bin/docker pull {docker_image} || exit 1
+  echo "Pulled {docker_image} in $(( $(date +%s) - start )) seconds"
+fi
 """
 
 
@@ -49,34 +98,124 @@ def resume_instance(instance_config):
     )
 
 
-def _format_and_mount_tmp(dev_name):
-    return [
-        # format filesystem
-        f"mkfs -t ext4 {dev_name}",
+def _scratch_mount_host_path(container_path: str):
+    return f"{LOCAL_SSD_MOUNT}/mounts{container_path}"
+
+
+def _format_and_mount_local_ssd(dev_name, instance_config: InstanceConfig):
+    if instance_config.scratch_filesystem == "xfs":
+        # -K skips discarding the blocks, which local SSDs don't need as they start out empty
+        mkfs = (
+            f"if command -v mkfs.xfs ; then mkfs.xfs -f -K {dev_name} ; "
+            f'else echo "mkfs.xfs is not available, using ext4" >> /var/log/hermit.log ; '
+            f"mkfs.ext4 -F -E lazy_itable_init=1,lazy_journal_init=1,nodiscard {dev_name} ; fi"
+        )
+    else:
+        # initialize the inode tables and journal in the background after mounting, which makes
+        # formatting a multi-TB array take seconds instead of minutes
+        mkfs = f"mkfs.ext4 -F -E lazy_itable_init=1,lazy_journal_init=1,nodiscard {dev_name}"
+
+    commands = [
+        f'echo "Formatting local SSD {dev_name}" >> /var/log/hermit.log',
+        mkfs,
         # create mount point
-        f"mkdir -p /mnt/disks/local-ssd",
-        # mount filesystem at mount point
-        f"mount -t ext4 {dev_name} /mnt/disks/local-ssd",
+        f"mkdir -p {LOCAL_SSD_MOUNT}",
+        # mount filesystem at mount point (letting mount detect the type in case xfs was unavailable)
+        f"mount -o {LOCAL_SSD_MOUNT_OPTIONS} {dev_name} {LOCAL_SSD_MOUNT}",
         # now, mount /tmp from the new filesystem (on the ssd filesystem)
-        f"mkdir /mnt/disks/local-ssd/tmp",
-        f"chmod 1777 /mnt/disks/local-ssd/tmp",
-        f"mount --bind /mnt/disks/local-ssd/tmp /tmp",
+        f"mkdir -p {LOCAL_SSD_MOUNT}/tmp",
+        f"chmod 1777 {LOCAL_SSD_MOUNT}/tmp",
+        f"mount --bind {LOCAL_SSD_MOUNT}/tmp /tmp",
     ]
+    for container_path in instance_config.scratch_mounts:
+        commands.extend(
+            [
+                f"mkdir -p {_scratch_mount_host_path(container_path)}",
+                f"chmod 1777 {_scratch_mount_host_path(container_path)}",
+            ]
+        )
+    if instance_config.docker_on_local_ssd:
+        commands.append(f"mkdir -p {LOCAL_SSD_MOUNT}/docker")
+    return commands
+
+
+def _format_if_blank(dev_name):
+    # blkid -p exits with 2 only when it positively found no filesystem signature on the device. Any other
+    # failure leaves the disk alone, so we never format a disk which has data on it. (It also exits with 2 if
+    # the device doesn't exist, so wait for udev to create the link first, and only run blkid if it did.)
+    return (
+        f"for i in $(seq 30) ; do [ -b {dev_name} ] && break ; sleep 1 ; done ; "
+        f"if [ -b {dev_name} ] ; then blkid -p {dev_name} ; rc=$? ; else rc=1 ; fi ; "
+        f"if [ $rc -eq 2 ] ; then "
+        f'echo "Creating filesystem on blank disk {dev_name}" >> /var/log/hermit.log ; '
+        f"start=$(date +%s) ; "
+        f"mkfs -t ext4 {dev_name} >> /var/log/hermit.log 2>&1 ; "
+        f'echo "Finished creating filesystem on {dev_name} in $(( $(date +%s) - start )) seconds" >> /var/log/hermit.log ; '
+        f"fi"
+    )
+
+
+def _check_filesystem_if_needed(dev_name, fsck_interval_days):
+    """Only run fsck if the filesystem wasn't cleanly unmounted, or if it hasn't had a full check in
+    fsck_interval_days. The decision (and how long the check took) is written to /var/log/hermit.log
+    """
+    return (
+        f"info=$(tune2fs -l {dev_name} 2>/dev/null) ; "
+        f"state=$(echo \"$info\" | sed -n 's/^Filesystem state: *//p') ; "
+        f'last_checked=$(date -d "$(echo "$info" | sed -n \'s/^Last checked: *//p\')" +%s 2>/dev/null || echo 0) ; '
+        f"days=$(( ($(date +%s) - last_checked) / 86400 )) ; "
+        f'if [ -z "$state" ] ; then reason="could not read filesystem state" ; options="-a" ; '
+        f'elif [ "$state" != "clean" ] ; then reason="filesystem state is \'$state\'" ; options="-a" ; '
+        f'elif echo "$info" | grep -q "^Filesystem features:.*needs_recovery" ; then reason="filesystem was not cleanly unmounted" ; options="-a" ; '
+        f'elif [ $days -ge {fsck_interval_days} ] ; then reason="last full check was $days days ago" ; options="-f -a" ; '
+        f'else reason="" ; fi ; '
+        f'if [ -z "$reason" ] ; then '
+        f'echo "Skipped checking filesystem {dev_name} (cleanly unmounted and last checked $days days ago)" >> /var/log/hermit.log ; '
+        f"else "
+        f'echo "Starting check filesystem {dev_name} ($reason)" >> /var/log/hermit.log ; '
+        f"start=$(date +%s) ; "
+        f"fsck -C 1 $options {dev_name} >> /var/log/hermit.log ; "
+        f"echo $(( $(date +%s) - start )) > /run/hermit-fsck-seconds ; "
+        f'echo "Finished checking filesystem {dev_name} in $(cat /run/hermit-fsck-seconds) seconds" >> /var/log/hermit.log ; '
+        f"fi"
+    )
+
+
+def _record_fsck_duration(mount_point):
+    # remember how long the last check took (on the disk itself, as the boot disk doesn't outlive the
+    # instance) so that we can report how much time skipping it saved
+    last_fsck_seconds = f"{mount_point}/.hermit/last-fsck-seconds"
+    return (
+        f"mkdir -p {mount_point}/.hermit ; "
+        f"if [ -f /run/hermit-fsck-seconds ] ; then cp /run/hermit-fsck-seconds {last_fsck_seconds} ; "
+        f'elif [ -f {last_fsck_seconds} ] ; then echo "Skipping the filesystem check saved about $(cat {last_fsck_seconds}) seconds" >> /var/log/hermit.log ; '
+        f"fi"
+    )
+
+
+def _boot_stage_marker(stage):
+    "A command which logs the time (since the kernel started) that a stage of booting was reached"
+    return f'echo "Boot stage {stage} reached at $(cut -d " " -f 1 /proc/uptime) seconds" >> /var/log/hermit.log'
 
 
 def _create_bootcmd(instance_config: InstanceConfig):
     bootcmd = [
         "echo in-bootcmd",
         'echo "Starting cloudinit bootcmd..." >> /var/log/hermit.log',
+        _boot_stage_marker("bootcmd-start"),
         "mount",
         "umount /tmp",
     ]
     # if we have no local ssd drives, use /var/tmp for /tmp
     if instance_config.local_ssd_count == 0:
         bootcmd.append("mount --bind /var/tmp /tmp")
-    if instance_config.local_ssd_count == 1:
+    elif instance_config.local_ssd_count == 1:
         # if we have a single ssd drive format it and mount it
-        bootcmd.extend(_format_and_mount_tmp("/dev/disk/by-id/google-local-nvme-ssd-0"))
+        bootcmd.extend(
+            _format_and_mount_local_ssd(
+                "/dev/disk/by-id/google-local-nvme-ssd-0", instance_config
+            )
+        )
     else:
         # if we have more than one turn them into a single volume
         dev_list = " ".join(
@@ -87,22 +226,37 @@ def _create_bootcmd(instance_config: InstanceConfig):
         )
         bootcmd.extend(
             [
-                f"mdadm --create /dev/md0 --level=0 --raid-devices={instance_config.local_ssd_count} {dev_list}",
+                f"mdadm --create /dev/md0 --level=0 --chunk={LOCAL_SSD_RAID_CHUNK_KB} --raid-devices={instance_config.local_ssd_count} {dev_list}",
             ]
-            + _format_and_mount_tmp("/dev/md0")
+            + _format_and_mount_local_ssd("/dev/md0", instance_config)
         )
 
     bootcmd.extend(
         [
             f"echo in-bootcmd-after-tmp-remount",
             f"mount",
-            f'echo "Starting check filesystem /dev/disk/by-id/google-{instance_config.pd_name}" >> /var/log/hermit.log',
-            f"fsck -C 1 -a /dev/disk/by-id/google-{instance_config.pd_name} >> /var/log/hermit.log",
-            f'echo "Finished checking filesystem /dev/disk/by-id/google-{instance_config.pd_name}" >> /var/log/hermit.log',
+        ]
+    )
+
+    if instance_config.format_strategy == "lazy":
+        bootcmd.append(
+            _format_if_blank(f"/dev/disk/by-id/google-{instance_config.pd_name}")
+        )
+
+    bootcmd.extend(
+        [
+            _check_filesystem_if_needed(
+                f"/dev/disk/by-id/google-{instance_config.pd_name}",
+                instance_config.fsck_interval_days,
+            ),
             f"mkdir -p /mnt/disks/{instance_config.pd_name}",
             f'echo "Mounting /dev/disk/by-id/google-{instance_config.pd_name}" as /mnt/disks/{instance_config.pd_name} >> /var/log/hermit.log',
             f"mount -t ext4 /dev/disk/by-id/google-{instance_config.pd_name} /mnt/disks/{instance_config.pd_name}",
+            _record_fsck_duration(f"/mnt/disks/{instance_config.pd_name}"),
+            # grow the filesystem if the disk was resized while the instance was offline (this is quick when there's nothing to do)
+            f"resize2fs /dev/disk/by-id/google-{instance_config.pd_name} >> /var/log/hermit.log 2>&1",
             f"mkdir -p /mnt/disks/{instance_config.pd_name}/home/ubuntu/.ssh",
+            _boot_stage_marker("home-mounted"),
             f'echo "Finished hermit VM setup" >> /var/log/hermit.log',
         ]
     )
@@ -110,18 +264,36 @@ def _create_bootcmd(instance_config: InstanceConfig):
     return bootcmd
 
 
-def _create_cloud_config(instance_config: InstanceConfig):
+def _create_cloud_config(instance_config: InstanceConfig, docker_image: str):
     ssh_pub_key = get_pub_key()
 
-    suspend_on_idle = pkg_resources.resource_string(
-        "hermitcrab", "deploy_scripts/suspend_on_idle.py"
+    hermit_agent = pkg_resources.resource_string(
+        "hermitcrab", "deploy_scripts/hermit_agent.py"
     ).decode("utf8")
 
+    scratch_volumes = "".join(
+        [
+            f" -v {_scratch_mount_host_path(container_path)}:{container_path}"
+            for container_path in instance_config.scratch_mounts
+        ]
+    )
+
+    # traffic to these counts as activity for the idle check, just like traffic to sshd
+    forwarded_port_options = "".join(
+        f" --forwarded-port {port}" for port in instance_config.forwarded_ports
+    )
+
+    # the steps below are ordered (and where possible run concurrently) to keep the time until sshd is
+    # listening short. The boot stage markers and the systemd-analyze output end up in /var/log/hermit.log
+    # for 'hermit up --verbose' to report.
     hermit_setup = f"""
 set -ex
+{_boot_stage_marker("setup-start")}
 echo "initial mount state"
 mount
+
 echo "Setting up ubuntu home directory permissions..."
+(
 usermod -u 2000 ubuntu
 groupmod -g 2000 ubuntu
 chown 2000:2000 /mnt/disks/{instance_config.pd_name}/home/ubuntu
@@ -130,12 +302,43 @@ chown -R 2000:2000 /mnt/disks/{instance_config.pd_name}/home/ubuntu/.ssh
 echo "Mounting home directory into place..."
 mount --bind /mnt/disks/{instance_config.pd_name}/home/ubuntu/ /home/ubuntu
 chown ubuntu:ubuntu /mnt/disks/{instance_config.pd_name}/home/ubuntu/.ssh/authorized_keys
-chmod 0666 /var/run/docker.sock
+) &
+home_setup=$!
+
+HOME=/home/cloudservice /usr/bin/docker-credential-gcr configure-docker --registries {_credential_helper_registry(docker_image)} &
+credential_setup=$!
+
 echo "Starting up services..."
 systemctl daemon-reload
-systemctl restart docker
-systemctl start container-sshd.service
-systemctl start suspend-on-idle.service
+# start the agent as early as possible, because 'hermit up' reads this log through it
+systemctl start --no-block hermit-agent.service
+# docker may have already been started with the daemon.json it shipped with. Only pay for a restart in that case.
+if systemctl is-active --quiet docker && [ /etc/docker/daemon.json -nt /var/run/docker.pid ] ; then
+  systemctl restart docker
+else
+  systemctl start docker
+fi
+chmod 0666 /var/run/docker.sock
+{_boot_stage_marker("docker-ready")}
+
+wait $home_setup
+wait $credential_setup
+systemctl start --no-block container-sshd.service
+{_boot_stage_marker("services-started")}
+
+(
+timeout 3600 bash -c 'until echo > /dev/tcp/127.0.0.1/{CONTAINER_SSHD_PORT} ; do sleep 0.2 ; done' 2> /dev/null || true
+{_boot_stage_marker("sshd-listening")}
+systemctl is-system-running --wait > /dev/null || true
+{{
+echo "Boot profile (systemd-analyze critical-chain container-sshd.service):"
+systemd-analyze critical-chain container-sshd.service
+echo "Boot profile (systemd-analyze blame):"
+systemd-analyze blame | head -n 15
+}} > /run/hermit-boot-profile.txt 2>&1
+cat /run/hermit-boot-profile.txt >> /var/log/hermit.log
+) > /dev/null 2>&1 &
+
 echo "final mount state"
 mount
 echo "hermit-setup.sh complete"
@@ -150,19 +353,31 @@ echo "hermit-setup.sh complete"
                 "content": ssh_pub_key,
             },
             {
-                "path": "/home/cloudservice/suspend_on_idle.py",
-                "content": suspend_on_idle,
+                "path": "/home/cloudservice/hermit_agent.py",
+                "content": hermit_agent,
             },
             {"path": "/home/cloudservice/hermit-setup.sh", "content": hermit_setup},
+            {
+                "path": "/home/cloudservice/pull-image.sh",
+                "content": _pull_image_script(docker_image),
+            },
             {
                 "path": "/home/cloudservice/setup_firewall",
                 "content": f"""
-# Create a chain for tracking traffic to ssh in container
+# Create a chain for tracking traffic to ssh in container. Only packets which carry data (and so have PSH
+# set) are counted, so that hermit's tunnel watchdog, whose probes connect and hang up without sending
+# anything, doesn't keep the instance from being suspended. (Even an otherwise quiet session sends keepalives.)
 iptables -N CONTAINER_SSH
 iptables -I INPUT -j CONTAINER_SSH
-iptables -A CONTAINER_SSH -p tcp --dport {CONTAINER_SSHD_PORT}
+iptables -A CONTAINER_SSH -p tcp --dport {CONTAINER_SSHD_PORT} --tcp-flags PSH PSH
 iptables -A INPUT -p tcp --dport {CONTAINER_SSHD_PORT} -j ACCEPT
-""",
+"""
+                + "".join(
+                    f"""iptables -A CONTAINER_SSH -p tcp --dport {port} --tcp-flags PSH PSH
+iptables -A INPUT -p tcp --dport {port} -j ACCEPT
+"""
+                    for port in instance_config.forwarded_ports
+                ),
             },
             {
                 "path": "/etc/systemd/system/config-firewall.service",
@@ -191,32 +406,32 @@ After=gcr-online.target config-firewall.service
 [Service]
 Environment="HOME=/home/cloudservice"
 StandardOutput=append:/var/log/hermit.log
-ExecStartPre=/usr/bin/docker-credential-gcr configure-docker --registries us-central1-docker.pkg.dev
-ExecStart=/usr/bin/docker run --rm --name=container-sshd --network=host -v /var/run/docker.sock:/var/run/docker.sock -v /tmp:/tmp -v /mnt/disks/{instance_config.pd_name}/home/ubuntu:/home/ubuntu {instance_config.docker_image} /usr/sbin/sshd -D -e -p {CONTAINER_SSHD_PORT}
+ExecStartPre=/bin/bash /home/cloudservice/pull-image.sh
+ExecStart=/usr/bin/docker run --rm --name=container-sshd --network=host -v /var/run/docker.sock:/var/run/docker.sock -v /tmp:/tmp{scratch_volumes} -v /mnt/disks/{instance_config.pd_name}/home/ubuntu:/home/ubuntu {docker_image} /usr/sbin/sshd -D -e -p {CONTAINER_SSHD_PORT}
 ExecStop=/usr/bin/docker stop container-sshd
 ExecStopPost=/usr/bin/docker rm container-sshd
 Restart=always
 """,
             },
             {
-                "path": "/etc/systemd/system/suspend-on-idle.service",
+                "path": "/etc/systemd/system/hermit-agent.service",
                 "permissions": "0644",
                 "owner": "root",
                 "content": f"""
 [Unit]
-Description=Suspend when container is detected to be idle
+Description=hermit agent (suspends when the container is idle, reports the boot log and carries out commands from hermit)
 Wants=gcr-online.target
 After=gcr-online.target
 
 [Service]
-ExecStart=/usr/bin/python /home/cloudservice/suspend_on_idle.py 1 {instance_config.suspend_on_idle_timeout} {instance_config.name} {instance_config.zone} {instance_config.project} {CONTAINER_SSHD_PORT}
+ExecStart=/usr/bin/python /home/cloudservice/hermit_agent.py --name {instance_config.name} --zone {instance_config.zone} --project {instance_config.project} --port {CONTAINER_SSHD_PORT} --idle-timeout {instance_config.suspend_on_idle_timeout}{forwarded_port_options}{" --watch-preemption" if instance_config.provisioning_model == "SPOT" else ""}
 Restart=always""",
             },
             {
                 "path": "/etc/docker/daemon.json",
                 "permissions": "0644",
                 "owner": "root",
-                "content": docker_daemon_config,
+                "content": _docker_daemon_config(instance_config),
             },
         ],
         "users": [{"name": "ubuntu"}],
@@ -249,10 +464,18 @@ def start_instance(instance_config: InstanceConfig):
     )
 
 
-def create_instance(instance_config: InstanceConfig):
+def create_instance(
+    instance_config: InstanceConfig, image_digest: Optional[str] = None
+):
+    """If image_digest is provided, the instance runs that version of the docker image rather than
+    whichever the tag points to when it boots"""
     username = os.getlogin()
 
-    cloud_config = _create_cloud_config(instance_config)
+    docker_image = registry_cache.get_instance_docker_image(instance_config)
+    if image_digest is not None:
+        docker_image = gcp.pin_docker_image_name(docker_image, image_digest)
+
+    cloud_config = _create_cloud_config(instance_config, docker_image)
 
     with tempfile.NamedTemporaryFile("wt") as tmp:
         # write out cloudinit file
@@ -272,7 +495,8 @@ def create_instance(instance_config: InstanceConfig):
             f"--project={instance_config.project}",
             f"--machine-type={instance_config.machine_type}",
             f"--metadata-from-file=user-data={cloudinit_path}",
-            f"--metadata=google-monitoring-enabled=true",
+            # guest attributes are how the agent reports back to hermit
+            f"--metadata=google-monitoring-enabled=true,enable-guest-attributes=TRUE",
             f"--disk=name={instance_config.pd_name},device-name={instance_config.pd_name},auto-delete=no",
             # use scopes that are equivilent to 'default' from https://cloud.google.com/sdk/gcloud/reference/compute/instances/create#--scopes
             # but also add compute-rw so that the instance can suspend itself down when idle.
@@ -283,6 +507,13 @@ def create_instance(instance_config: InstanceConfig):
         for _ in range(instance_config.local_ssd_count):
             create_options.extend(["--local-ssd=interface=nvme"])
 
+        if instance_config.provisioning_model == "SPOT":
+            # stop rather than delete on preemption, so the boot disk (and the docker images cached on it)
+            # are still there when 'hermit up' restarts the instance
+            create_options.extend(
+                ["--provisioning-model=SPOT", "--instance-termination-action=STOP"]
+            )
+
         gcp.gcloud(
             [
                 "compute",
@@ -294,36 +525,239 @@ def create_instance(instance_config: InstanceConfig):
             timeout=LONG_OPERATION_TIMEOUT,
         )
 
+    # so that 'hermit refresh-image' knows what's running, and hermit knows it can talk to the agent
+    update_instance_state(
+        instance_config.name, docker_image=docker_image, has_agent=True
+    )
+
+
+def apply_machine_type(instance_config: InstanceConfig, status):
+    """The machine type in the config differs from the existing instance's (ie: after 'hermit reshape').
+    Change the instance if possible. Returns the instance's status afterwards."""
+    if status == "RUNNING":
+        print(
+            f"Warning: {instance_config.name} is already running, so it will not use the machine type {instance_config.machine_type} until after 'hermit down {instance_config.name}'"
+        )
+        return status
 
-def up(name: str, verbose: bool):
+    if status == "SUSPENDED":
+        # the machine type can't be changed while suspended, and the instance's memory may contain
+        # writes which haven't been flushed to the persistent disk. Resume and shut down cleanly first.
+        print(
+            f"Restarting {instance_config.name} to change its machine type to {instance_config.machine_type}"
+        )
+        resume_instance(instance_config)
+        print(f"Stopping {instance_config.name}...")
+        gcp.gcloud(
+            [
+                "compute",
+                "instances",
+                "stop",
+                instance_config.name,
+                f"--zone={instance_config.zone}",
+                f"--project={instance_config.project}",
+            ],
+            timeout=LONG_OPERATION_TIMEOUT,
+        )
+        status = "TERMINATED"
+
+    if status == "TERMINATED":
+        set_machine_type(
+            instance_config.name,
+            instance_config.zone,
+            instance_config.project,
+            instance_config.machine_type,
+        )
+
+    return status
+
+
+def start_or_create_instance(
+    instance_config: InstanceConfig, status, image_digest: Optional[str] = None
+):
+    """Start the stopped instance (or create it if status is None). If the zone is out of capacity,
+    try the config's fallback zones, moving the instance and a copy of its disk. Returns the config
+    of the instance, which will have a different zone if it was moved. A created instance runs the
+    version of the image given by image_digest (if not None)."""
+    zones = placement.order_zones(instance_config)
+    for zone in zones:
+        if zone != instance_config.zone:
+            print(f"Moving {instance_config.name} to {zone}...")
+            instance_config = move_to_zone(instance_config, zone)
+            status = None
+            # the new region may not have a registry cache yet
+            registry_cache.ensure_instance_registry_cache(instance_config)
+
+        try:
+            if status == "TERMINATED":
+                gcp.log_info("Starting stopped instance")
+                start_instance(instance_config)
+            else:
+                gcp.log_info(f"Creating instance")
+                create_instance(instance_config, image_digest)
+        except gcp.GCloudError as ex:
+            if not placement.is_capacity_error(ex.error_message):
+                raise
+            placement.record_capacity(instance_config, zone, False)
+            if len(instance_config.fallback_zones) == 0:
+                raise UserError(
+                    f"{zone} does not currently have the capacity for a {instance_config.machine_type} instance. Try again later, or add zones to \"fallback_zones\" in the config for {instance_config.name} to allow 'hermit up' to move it to another zone"
+                )
+            print(f"{zone} does not currently have the capacity for this instance")
+            continue
+
+        placement.record_capacity(instance_config, zone, True)
+        return instance_config
+
+    raise UserError(
+        f"None of the zones {', '.join(zones)} currently have the capacity for a {instance_config.machine_type} instance. Try again later"
+    )
+
+
+def restart_tunnel(instance_config: InstanceConfig):
+    if is_tunnel_running(instance_config.name):
+        gcp.log_info(f"Stopping tunnel process")
+        stop_tunnel(instance_config.name)
+    else:
+        gcp.log_info(f"Tunnel is not running running")
+
+    gcp.log_info(f"Starting tunnel")
+    start_tunnel(
+        instance_config.name,
+        instance_config.zone,
+        instance_config.project,
+        instance_config.local_port,
+    )
+
+    for remote_port in instance_config.forwarded_ports:
+        stop_tunnel(instance_config.name, int(remote_port))
+        start_forwarded_port_tunnel(instance_config, remote_port)
+
+
+def start_forwarded_port_tunnel(instance_config: InstanceConfig, remote_port: str):
+    start_tunnel(
+        instance_config.name,
+        instance_config.zone,
+        instance_config.project,
+        instance_config.forwarded_ports[remote_port],
+        remote_port=int(remote_port),
+    )
+
+
+def connect_to_booted_instance(instance_config: InstanceConfig):
+    """Make sure a tunnel is running and check whether sshd answers through it. This is much quicker
+    than polling the log over 'gcloud compute ssh', and is all that's needed for an instance which was
+    already up (ie: one resumed by 'hermit prewarm')."""
+    if not is_tunnel_running(instance_config.name):
+        restart_tunnel(instance_config)
+    else:
+        for remote_port in instance_config.forwarded_ports:
+            if not is_tunnel_running(instance_config.name, int(remote_port)):
+                stop_tunnel(instance_config.name, int(remote_port))
+                start_forwarded_port_tunnel(instance_config, remote_port)
+    return probe_ssh_banner(instance_config.local_port)
+
+
+def record_internal_ip(instance_config: InstanceConfig):
+    "Save the instance's internal IP, which the ssh config connects to directly when it's reachable"
+    instance = gcp.get_instance(
+        instance_config.name, instance_config.zone, instance_config.project
+    )
+    assert instance is not None
+    internal_ip = instance["networkInterfaces"][0]["networkIP"]
+    gcp.log_info(f"Internal IP of {instance_config.name} is {internal_ip}")
+    update_instance_state(instance_config.name, internal_ip=internal_ip)
+
+
+def report_preemptions(instance_config: InstanceConfig):
+    preemptions = gcp.get_preemptions(
+        instance_config.name, instance_config.zone, instance_config.project
+    )
+    if len(preemptions) > 0:
+        print(
+            f"Spot instance {instance_config.name} has been preempted {len(preemptions)} time(s) recently (most recently at {preemptions[-1]}). Restarting it..."
+        )
+
+
+def report_image_update(instance_config: InstanceConfig, image_digest: str):
+    "Let the user know if the image's tag has moved since the instance was created"
+    running_image = read_instance_state(instance_config.name).get("docker_image")
+    if running_image is None:
+        return
+    latest_image = gcp.pin_docker_image_name(
+        registry_cache.get_instance_docker_image(instance_config), image_digest
+    )
+    if running_image != latest_image:
+        print(
+            f"{instance_config.docker_image} has been updated since {instance_config.name} was started. Run 'hermit refresh-image {instance_config.name}' to switch to the new version."
+        )
+
+
+def up(name: str, verbose: bool, start_watchdog: bool = True):
     instance_config = get_instance_config(name)
 
-    if not gcp.has_access_to_docker_image(
-        instance_config.service_account, instance_config.docker_image
+    registry_cache.ensure_instance_registry_cache(instance_config)
+    if (
+        instance_config.connection_mode == "direct"
+        or len(instance_config.forwarded_ports) > 0
     ):
+        # the config may have been edited since the instance was created
+        ensure_firewall_setup(
+            instance_config.project,
+            instance_config.direct_source_ranges,
+            [int(port) for port in instance_config.forwarded_ports],
+        )
+    docker_image = registry_cache.get_instance_docker_image(instance_config)
+    try:
+        # fail now, rather than after booting, if the image can't work
+        image_manifest = image_check.check_docker_image(
+            instance_config.service_account, docker_image
+        )
+    except gcp.AccessDenied:
         print(
             gcp.get_grant_instructions(
-                instance_config.service_account, instance_config.docker_image
+                instance_config.service_account,
+                instance_config.docker_image,
+                docker_image,
             )
         )
         return 1
 
-    status = gcp.get_instance_status(
+    instance = gcp.get_instance(
         instance_config.name,
         instance_config.zone,
         instance_config.project,
         one_or_none=True,
     )
+    status = None if instance is None else instance["status"]
 
-    if status == "TERMINATED":
-        gcp.log_info("Starting stopped instance")
-        start_instance(instance_config)
-        # raise UserError(
-        #     f"Found existing stopped instance. You'll need to manually run `hermit down {name}` before trying to bring it back up"
-        # )
-    elif status is None:
-        gcp.log_info(f"Creating instance")
-        create_instance(instance_config)
+    if (
+        instance is not None
+        and get_machine_type_name(instance) != instance_config.machine_type
+    ):
+        status = apply_machine_type(instance_config, status)
+
+    if status == "STOPPING" and instance_config.provisioning_model == "SPOT":
+        # most likely in the middle of being preempted
+        print(f"Waiting for {instance_config.name} to finish stopping...")
+        gcp.wait_for_instance_status(
+            instance_config.name,
+            instance_config.zone,
+            instance_config.project,
+            "TERMINATED",
+        )
+        status = "TERMINATED"
+
+    # a resumed instance doesn't boot again, so sshd may already be listening
+    already_booted = status in ["RUNNING", "SUSPENDED"]
+    start_time = time.time()
+
+    if status == "TERMINATED" or status is None:
+        if status == "TERMINATED" and instance_config.provisioning_model == "SPOT":
+            report_preemptions(instance_config)
+        instance_config = start_or_create_instance(
+            instance_config, status, image_manifest.digest
+        )
     elif status == "RUNNING":
         gcp.log_info(f"Instance is running")
         print(f"Instance {instance_config.name} is already running.")
@@ -335,22 +769,34 @@ def up(name: str, verbose: bool):
             f"Instance status is {status}, and this tool doesn't know what to do with that status."
         )
 
-    gcp.log_info(f"Waiting for instance to start")
-    wait_for_instance_start(instance_config, verbose, timeout=60 * 60)
+    report_image_update(instance_config, image_manifest.digest)
 
-    if is_tunnel_running(instance_config.name):
-        gcp.log_info(f"Stopping tunnel process")
-        stop_tunnel(instance_config.name)
+    if already_booted and connect_to_booted_instance(instance_config):
+        gcp.log_info(f"sshd answered through the tunnel, so not waiting for boot")
     else:
-        gcp.log_info(f"Tunnel is not running running")
+        gcp.log_info(f"Waiting for instance to start")
+        log_content = wait_for_instance_start(
+            instance_config,
+            verbose,
+            timeout=60 * 60,
+            via_agent=agent.has_agent(instance_config.name),
+        )
+        if verbose:
+            print(
+                f"sshd was listening {time.time() - start_time:.1f} seconds after 'hermit up' started the instance"
+            )
+            print_boot_profile(log_content)
+        restart_tunnel(instance_config)
 
-    gcp.log_info(f"Starting tunnel")
-    start_tunnel(
-        instance_config.name,
-        instance_config.zone,
-        instance_config.project,
-        instance_config.local_port,
-    )
+    if instance_config.connection_mode == "direct":
+        record_internal_ip(instance_config)
+
+    # lets 'hermit proxy' connect without first checking the instance's status
+    update_instance_state(instance_config.name, last_seen_running=time.time())
+
+    if start_watchdog:
+        # restarts the tunnel if it stops answering (ie: after the laptop sleeps)
+        watchdog.start_watchdog()
 
     gcp.log_info(f"Updating ssh config")
     update_ssh_config(get_instance_configs())
@@ -365,7 +811,10 @@ def wait_for_instance_start(
     timeout: float,
     output_callback=print,
     poll_frequency=1,
+    via_agent=False,
 ):
+    """Polls /var/log/hermit.log until sshd is listening. If via_agent is set, the log is read from what the
+    agent publishes, falling back to ssh until the agent has started"""
     # the lines of status we've already shown to the user
     printed_status = set()
     previous_printed = ""
@@ -373,22 +822,28 @@ def wait_for_instance_start(
     start_time = time.time()
     # breakpoint()
     while True:
-        stdout, stderr = gcp.gcloud_capturing_output(
-            [
-                "compute",
-                "ssh",
-                instance_config.name,
-                f"--project",
-                instance_config.project,
-                f"--zone",
-                instance_config.zone,
-                "--tunnel-through-iap",
-                f"--command",
-                "cat /var/log/hermit.log",
-            ],
-            ignore_error=True,
-            retries_on_timeout=10,
-        )
+        # (the agent isn't started until partway through booting, so the start of a boot, ie: the
+        # filesystem check, is only visible over ssh)
+        stdout = agent.read_log(instance_config) if via_agent else None
+        if stdout is not None:
+            stderr = ""
+        else:
+            stdout, stderr = gcp.gcloud_capturing_output(
+                [
+                    "compute",
+                    "ssh",
+                    instance_config.name,
+                    f"--project",
+                    instance_config.project,
+                    f"--zone",
+                    instance_config.zone,
+                    "--tunnel-through-iap",
+                    f"--command",
+                    "cat /var/log/hermit.log",
+                ],
+                ignore_error=True,
+                retries_on_timeout=10,
+            )
 
         if stderr != "":
             gcp.log_info(f"stderr from compute ssh poll command: {stderr}")
@@ -403,7 +858,11 @@ def wait_for_instance_start(
             # be blank.
 
             if verbose:
-                new_output = stdout[len(previous_printed) :]
+                # (the agent only publishes the end of a long log, so it may not start where it did before)
+                if stdout.startswith(previous_printed):
+                    new_output = stdout[len(previous_printed) :]
+                else:
+                    new_output = stdout
                 output_callback(new_output, end="")
                 previous_printed = stdout
 
@@ -416,7 +875,7 @@ def wait_for_instance_start(
                     printed_status.add(line)
 
             if is_ssh_ready:
-                break
+                return stdout
 
         elapsed = time.time() - start_time
         if elapsed > timeout:
@@ -429,6 +888,30 @@ def wait_for_instance_start(
         time.sleep(poll_frequency)
 
 
+def get_boot_profile(log_content):
+    "Returns a list of (stage, seconds since the kernel started) from the boot stage markers in /var/log/hermit.log"
+    return [
+        (stage, float(seconds))
+        for stage, seconds in re.findall(
+            "^Boot stage (\\S+) reached at ([0-9.]+) seconds$",
+            log_content,
+            re.MULTILINE,
+        )
+    ]
+
+
+def print_boot_profile(log_content, output_callback=print):
+    profile = get_boot_profile(log_content)
+    if len(profile) == 0:
+        return
+    output_callback("Boot profile (seconds since the kernel started):")
+    prev_seconds = None
+    for stage, seconds in profile:
+        delta = "" if prev_seconds is None else f" (+{seconds - prev_seconds:.1f})"
+        output_callback(f"  {seconds:8.1f} {stage}{delta}")
+        prev_seconds = seconds
+
+
 COULD_NOT_CHECK_FILESYSTEM_MSG = "superblock could not be read"
 COULD_NOT_START_DOCKER_CONTAINER = 'error during container init: exec: "/usr/sbin/sshd"'
 # b08e2ff4391e: Download complete
@@ -456,15 +939,48 @@ def get_status_from_log(log_content):
             'In /var/log/hermit.log an error message indicates that the docker container could not be started because the image did not contain "sshd". See the README at https://github.com/broadinstitute/hermitcrab for what is required installed inside the docker image to work with hermit.'
         )
 
-    check_fs_m = re.search("^(Starting check filesystem)", log_content, re.MULTILINE)
+    m = re.search("^(Creating filesystem on blank disk)", log_content, re.MULTILINE)
+    if m:
+        status.append(m.group(1))
+
+    m = re.search(
+        "^Finished creating filesystem on \\S+ (in \\d+ seconds)$",
+        log_content,
+        re.MULTILINE,
+    )
+    if m:
+        status.append(f"Finished creating filesystem {m.group(1)}")
+
+    m = re.search(
+        "^(Skipped checking filesystem) \\S+ (\\(.*\\))$", log_content, re.MULTILINE
+    )
+    if m:
+        status.append(f"{m.group(1)} {m.group(2)}")
+
+    m = re.search(
+        "^(Skipping the filesystem check saved about \\d+ seconds)$",
+        log_content,
+        re.MULTILINE,
+    )
+    if m:
+        status.append(m.group(1))
+
+    # (the filesystem and reason were not logged by older versions)
+    check_fs_m = re.search(
+        "^(Starting check filesystem)(?: \\S+ (\\(.*\\)))?", log_content, re.MULTILINE
+    )
     if check_fs_m:
-        status.append(check_fs_m.group(1))
+        status.append(" ".join([x for x in check_fs_m.groups() if x is not None]))
 
     finished_check_fs_m = re.search(
-        "^(Finished checking filesystem)", log_content, re.MULTILINE
+        "^(Finished checking filesystem)(?: \\S+ (in \\d+ seconds))?",
+        log_content,
+        re.MULTILINE,
     )
     if finished_check_fs_m:
-        status.append(finished_check_fs_m.group(1))
+        status.append(
+            " ".join([x for x in finished_check_fs_m.groups() if x is not None])
+        )
 
     if check_fs_m and not finished_check_fs_m:
         progress_matches = re.findall(
@@ -489,6 +1005,10 @@ def get_status_from_log(log_content):
     if pulled_m is not None:
         status.append(pulled_m.group(1))
 
+    m = re.search("^(Pulled \\S+ in \\d+ seconds)$", log_content, re.MULTILINE)
+    if m:
+        status.append(m.group(1))
+
     m = re.search("^(Server listening on 0.0.0.0.*)$", log_content, re.MULTILINE)
     if m:
         status.append(m.group(1))
@@ -499,7 +1019,7 @@ def get_status_from_log(log_content):
 
 def add_command(subparser):
     def _up(args):
-        up(args.name, args.verbose)
+        up(args.name, args.verbose, args.watchdog)
 
     parser = subparser.add_parser(
         "up", help="Start a compute instance based on the named configuration"
@@ -517,3 +1037,9 @@ def add_command(subparser):
         action="store_true",
         help="If set, will print more logging information showing the server coming online",
     )
+    parser.add_argument(
+        "--no-watchdog",
+        dest="watchdog",
+        action="store_false",
+        help="If set, don't start the background process which restarts the tunnel when it stops answering",
+    )
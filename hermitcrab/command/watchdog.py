@@ -0,0 +1,270 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import Optional, TypedDict
+
+from .. import gcp
+from ..config import (
+    get_instance_config,
+    get_instance_names,
+    get_tunnel_status_dir,
+    update_instance_state,
+    write_file_atomically,
+    InstanceConfig,
+)
+from ..tunnel import (
+    get_process_command,
+    is_pid_valid,
+    is_tunnel_process,
+    measure_ssh_banner_latency,
+    read_pid,
+    start_tunnel,
+    stop_tunnel,
+    terminate_tunnel_process,
+)
+
+# The watchdog is a background process, started by 'hermit up', which probes each tunnel by waiting for sshd's
+# banner through it. A tunnel which has wedged (ie: after the laptop slept or changed networks) is restarted,
+# backing off if that doesn't help. It looks after the tunnels which have a pid file (which 'hermit down'
+# removes) and exits once there are none left.
+
+# seconds between probes of each tunnel
+WATCHDOG_INTERVAL = 15
+# seconds to wait for the banner before deciding the tunnel is broken
+PROBE_TIMEOUT = 5
+# seconds to wait before the first restart, which doubles with each failed restart up to MAX_BACKOFF
+INITIAL_BACKOFF = 5
+MAX_BACKOFF = 5 * 60
+# statuses in which the instance's sshd can't answer, however often the tunnel is restarted
+STOPPED_STATUSES = ["SUSPENDING", "SUSPENDED", "STOPPING", "TERMINATED"]
+
+
+@dataclass
+class TunnelWatch:
+    "What the watchdog remembers about a tunnel between probes"
+    failures: int = 0
+    restarts: int = 0
+    next_restart: float = 0
+    pid: Optional[int] = None
+    # whether the instance wasn't running when the tunnel was last due to be restarted
+    stopped: bool = False
+
+
+class TunnelHealth(TypedDict):
+    "What the watchdog saw when it last probed a tunnel"
+    # "ok", "restarted", "failing" (still broken, but not yet time to restart it again) or "stopped" (the
+    # instance isn't running, so the tunnel is left alone)
+    status: str
+    # how long sshd's banner took to arrive through the tunnel, if it did
+    latency_ms: Optional[int]
+    # the earliest time the watchdog will restart the tunnel again
+    next_restart: float
+    checked_at: float
+    restarts: int
+
+
+def _get_tunnel_health_path(name: str):
+    # kept apart from the instance's state, as the watchdog writes it every WATCHDOG_INTERVAL seconds
+    return os.path.join(
+        get_tunnel_status_dir(create_if_missing=True), f"{name}.health.json"
+    )
+
+
+def read_tunnel_health(name: str) -> Optional[TunnelHealth]:
+    "Returns the health recorded by the watchdog, or None if it hasn't probed the instance's tunnel"
+    health_path = _get_tunnel_health_path(name)
+    if not os.path.exists(health_path):
+        return None
+    with open(health_path, "rt") as fd:
+        return json.load(fd)
+
+
+def get_backoff(failures: int):
+    "Returns how many seconds to wait before restarting a tunnel which has failed this many times in a row"
+    return min(MAX_BACKOFF, INITIAL_BACKOFF * 2 ** (failures - 1))
+
+
+def _restart_tunnel(instance_config: InstanceConfig):
+    pid = read_pid(instance_config.name)
+    if pid is not None and is_pid_valid(pid) and is_tunnel_process(pid):
+        terminate_tunnel_process(pid)
+    # only try once, because the watchdog does its own retrying with a backoff
+    start_tunnel(
+        instance_config.name,
+        instance_config.zone,
+        instance_config.project,
+        instance_config.local_port,
+        max_attempts=1,
+    )
+
+    # whatever broke the tunnel to sshd (ie: the laptop sleeping) most likely broke these too
+    for remote_port, local_port in instance_config.forwarded_ports.items():
+        stop_tunnel(instance_config.name, int(remote_port))
+        start_tunnel(
+            instance_config.name,
+            instance_config.zone,
+            instance_config.project,
+            local_port,
+            max_attempts=1,
+            remote_port=int(remote_port),
+        )
+
+
+def _is_instance_stopped(instance_config: InstanceConfig):
+    "Returns True if the instance is suspended, stopped or deleted. (If GCE can't be asked, assume it's running.)"
+    try:
+        status = gcp.get_instance_status(
+            instance_config.name,
+            instance_config.zone,
+            instance_config.project,
+            one_or_none=True,
+        )
+    except Exception as ex:
+        gcp.log_info(f"Could not get the status of {instance_config.name}: {ex}")
+        return False
+    return status is None or status in STOPPED_STATUSES
+
+
+def check_tunnel(instance_config: InstanceConfig, watch: TunnelWatch, now: float):
+    "Probe the tunnel, restart it if it's broken and it's time to, and record its health for 'hermit status'"
+    pid = read_pid(instance_config.name)
+    if pid != watch.pid:
+        # the tunnel was restarted by someone else (ie: 'hermit up'), so start afresh
+        watch.failures = 0
+        watch.pid = pid
+
+    latency = None
+    if pid is not None and is_pid_valid(pid) and is_tunnel_process(pid):
+        latency = measure_ssh_banner_latency(
+            instance_config.local_port, timeout=PROBE_TIMEOUT
+        )
+
+    if latency is not None:
+        watch.failures = 0
+        watch.stopped = False
+        status = "ok"
+    elif now < watch.next_restart:
+        status = "stopped" if watch.stopped else "failing"
+    elif _is_instance_stopped(instance_config):
+        # restarting the tunnel won't help until the instance is woken (ie: by 'hermit proxy'), so only
+        # look at it again after the longest backoff
+        watch.stopped = True
+        watch.next_restart = now + MAX_BACKOFF
+        update_instance_state(instance_config.name, last_seen_running=None)
+        status = "stopped"
+    else:
+        watch.stopped = False
+        watch.failures += 1
+        watch.restarts += 1
+        print(
+            f"Tunnel for {instance_config.name} isn't answering, restarting it (attempt {watch.failures})"
+        )
+        try:
+            _restart_tunnel(instance_config)
+            watch.pid = read_pid(instance_config.name)
+        except Exception as ex:
+            gcp.log_info(f"Restarting tunnel for {instance_config.name} failed: {ex}")
+        watch.next_restart = now + get_backoff(watch.failures)
+        status = "restarted"
+
+    health: TunnelHealth = {
+        "status": status,
+        "latency_ms": None if latency is None else round(latency * 1000),
+        "next_restart": watch.next_restart,
+        "checked_at": now,
+        "restarts": watch.restarts,
+    }
+    # (only the watchdog writes it, so it needs no lock)
+    write_file_atomically(
+        _get_tunnel_health_path(instance_config.name), json.dumps(health)
+    )
+    return health
+
+
+def describe_tunnel_health(health: TunnelHealth, now: float):
+    "Returns a description of the health recorded by the watchdog for 'hermit status'"
+    checked = f"checked {now - health['checked_at']:.0f} seconds ago"
+    restarts = f", restarted {health['restarts']} time(s)" if health["restarts"] else ""
+    if health["status"] == "ok":
+        return f"ok, {health['latency_ms']} ms round trip ({checked}{restarts})"
+    if health["status"] == "stopped":
+        return f"not answering, as the instance isn't running ({checked}{restarts})"
+    return f"not answering, next restart in {max(0, health['next_restart'] - now):.0f} seconds ({checked}{restarts})"
+
+
+def get_watched_names():
+    "Returns the names of the instances whose tunnels the watchdog should look after"
+    return [name for name in get_instance_names() if read_pid(name) is not None]
+
+
+def run_watchdog(interval=WATCHDOG_INTERVAL):
+    watches = {}
+    while True:
+        names = get_watched_names()
+        if len(names) == 0:
+            print("No tunnels to look after, exiting")
+            return
+        for name in names:
+            check_tunnel(
+                get_instance_config(name),
+                watches.setdefault(name, TunnelWatch()),
+                time.time(),
+            )
+        time.sleep(interval)
+
+
+def _get_watchdog_pid_path():
+    return os.path.join(get_tunnel_status_dir(create_if_missing=True), "watchdog.pid")
+
+
+def is_watchdog_running():
+    pid_path = _get_watchdog_pid_path()
+    if not os.path.exists(pid_path):
+        return False
+    with open(pid_path, "rt") as fd:
+        pid = int(fd.read())
+    return is_pid_valid(pid) and "hermitcrab.main watchdog" in get_process_command(pid)
+
+
+def start_watchdog():
+    "Start the watchdog in the background, unless it's already running"
+    if is_watchdog_running():
+        gcp.log_info("Watchdog is already running")
+        return
+
+    tunnel_status_dir = get_tunnel_status_dir(create_if_missing=True)
+    with open(os.path.join(tunnel_status_dir, "watchdog.log"), "at") as log_fd:
+        # run in its own session so that it outlives the terminal 'hermit up' was run from
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "hermitcrab.main", "watchdog"],
+            cwd=tunnel_status_dir,
+            stdout=log_fd,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+            start_new_session=True,
+            # so that the log is written as it goes
+            env={**os.environ, "PYTHONUNBUFFERED": "1"},
+        )
+    with open(_get_watchdog_pid_path(), "wt") as fd:
+        fd.write(str(proc.pid))
+    gcp.log_info(f"Started watchdog as pid={proc.pid}")
+
+
+def add_command(subparser):
+    def _watchdog(args):
+        run_watchdog(args.interval)
+
+    parser = subparser.add_parser(
+        "watchdog",
+        help="Probe the tunnels to running instances and restart any which stop answering. ('hermit up' runs this in the background)",
+    )
+    parser.set_defaults(func=_watchdog)
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=WATCHDOG_INTERVAL,
+        help=f"The number of seconds between probes of each tunnel (Default: {WATCHDOG_INTERVAL})",
+    )
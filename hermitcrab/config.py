@@ -1,12 +1,17 @@
 import os
 import json
-from typing import Dict, List
+import fcntl
+import tempfile
+from contextlib import contextmanager
+from typing import Dict, List, Optional, TypedDict
 import sqlite3
 
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, field
 
 CONTAINER_SSHD_PORT = 3022
 LONG_OPERATION_TIMEOUT = 60 * 5
+SCRATCH_FILESYSTEMS = ["ext4", "xfs"]
+CONNECTION_MODES = ["iap", "direct"]
 
 
 class NoDefaultServiceAccount(Exception):
@@ -26,6 +31,49 @@ class InstanceConfig:
     boot_disk_size_in_gb: int
     suspend_on_idle_timeout: int = 30
     local_ssd_count: int = 0
+    # how the local SSDs are set up: "ext4" or "xfs", whether docker's images and containers are stored on
+    # them, and paths (in addition to /tmp) in the container which are backed by them
+    scratch_filesystem: str = "ext4"
+    docker_on_local_ssd: bool = False
+    scratch_mounts: List[str] = field(default_factory=list)
+    # settings for the docker daemon which affect how quickly images are pulled. (None means docker's
+    # default, which is 3 concurrent downloads)
+    max_concurrent_downloads: Optional[int] = None
+    registry_mirrors: List[str] = field(default_factory=list)
+    # use containerd's image store, which can pull zstd compressed images (requires docker 24 or later)
+    containerd_snapshotter: bool = False
+    # the name of an Artifact Registry remote repository in the instance's region to pull the image through
+    # (created by hermit if it doesn't exist). None means pull directly from where the image is hosted.
+    registry_cache: Optional[str] = None
+    # how the filesystem on the persistent disk gets created. "vm" means a temporary VM formatted
+    # it during 'hermit create'. "lazy" means it's formatted by the first boot if it's blank.
+    format_strategy: str = "lazy"
+    # a full fsck of the persistent disk is only run at boot if it wasn't cleanly unmounted or if it has
+    # been at least this many days since the last one (0 means check on every boot)
+    fsck_interval_days: int = 30
+    # the size and type of the persistent disk (None if the config predates these being recorded)
+    disk_size_in_gb: Optional[int] = None
+    disk_type: Optional[str] = None
+    # "SPOT" instances are much cheaper, but GCP may stop them at any time (they are restarted by 'hermit up')
+    provisioning_model: str = "STANDARD"
+    # zones which 'hermit up' may move the instance (and a copy of its disk) to when its zone is out of capacity
+    fallback_zones: List[str] = field(default_factory=list)
+    # if set, 'hermit down' suspends the instance instead of deleting it, so the next 'hermit up' is quick
+    warm_standby: bool = False
+    # when the user's working day starts ("HH:MM", local time) and on which days. 'hermit prewarm' uses
+    # this to bring the instance up shortly beforehand.
+    working_day_start: Optional[str] = None
+    working_days: List[str] = field(
+        default_factory=lambda: ["mon", "tue", "wed", "thu", "fri"]
+    )
+    # how ssh reaches the instance. "iap" goes through an IAP tunnel. "direct" connects to the instance's
+    # internal IP (for workstations on the VPC, or a VPN into it, within direct_source_ranges) and falls
+    # back to IAP when that isn't reachable.
+    connection_mode: str = "iap"
+    direct_source_ranges: List[str] = field(default_factory=list)
+    # ports of services in the container (ie: jupyter) which 'hermit up' forwards to localhost, each over its
+    # own IAP tunnel. Maps the port on the instance (a string, as it's a key in the JSON) to the local port.
+    forwarded_ports: Dict[str, int] = field(default_factory=dict)
 
 
 @dataclass
@@ -34,6 +82,7 @@ class MinInstanceConfig:
     zone: str
     project: str
     pd_name: str
+    provisioning_model: str = "STANDARD"
 
 
 def get_home_config_dir():
@@ -57,11 +106,41 @@ def get_tunnel_status_dir(create_if_missing=False):
     return path
 
 
+def get_machine_type_cache_dir():
+    return os.path.join(get_home_config_dir(), "machine-types")
+
+
+def get_zone_capacity_cache_path():
+    return os.path.join(get_home_config_dir(), "zone-capacity.json")
+
+
+def get_image_check_cache_dir():
+    return os.path.join(get_home_config_dir(), "image-checks")
+
+
+def get_instance_state_dir():
+    return os.path.join(get_home_config_dir(), "state")
+
+
 def ensure_dir_exists(config_dir):
     if not os.path.exists(config_dir):
         os.makedirs(config_dir)
 
 
+def write_file_atomically(filename: str, content: str):
+    "Replace the file's content in one step, so that a concurrent reader never sees it partially written"
+    tmpfd, tmpname = tempfile.mkstemp(
+        prefix=".tmp", dir=os.path.dirname(filename), text=True
+    )
+    try:
+        with os.fdopen(tmpfd, "wt") as fd:
+            fd.write(content)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
 def record_assumption(name):
     filename = get_assumption_cache()
     new_db = not os.path.exists(filename)
@@ -131,6 +210,9 @@ def get_min_instance_config(name):
     min_config_dict = {}
     for prop in ["name", "zone", "project", "pd_name"]:
         min_config_dict[prop] = config_dict[prop]
+    # optional because configs written by older versions don't have it
+    if "provisioning_model" in config_dict:
+        min_config_dict["provisioning_model"] = config_dict["provisioning_model"]
 
     return MinInstanceConfig(**min_config_dict)
 
@@ -169,6 +251,58 @@ def delete_instance_config(name: str):
     assert os.path.exists(config_filename)
     os.unlink(config_filename)
 
+    state_filename = _get_instance_state_path(name)
+    if os.path.exists(state_filename):
+        os.unlink(state_filename)
+
+
+# Unlike the config, which describes what the user wants, the state records what hermit has
+# observed or done (ie: which version of the docker image the instance was started with)
+
+
+class InstanceState(TypedDict, total=False):
+    # the name (pinned to a digest) of the docker image the instance is running
+    docker_image: str
+    # when hermit last saw the instance running (cleared by 'hermit down'), so 'hermit proxy' can skip checking
+    last_seen_running: Optional[float]
+    # the instance's address on its VPC network, which the ssh config connects to directly when it's reachable
+    internal_ip: str
+    # whether the instance runs hermit-agent (instances created by older versions of hermit don't)
+    has_agent: bool
+    # zone -> the disk left there when the instance was moved to another zone. It's out of date, so moving
+    # back to that zone replaces it with a fresh copy rather than making yet another disk
+    left_behind_disks: Dict[str, str]
+
+
+def _get_instance_state_path(name):
+    return os.path.join(get_instance_state_dir(), f"{name}.json")
+
+
+def read_instance_state(name) -> InstanceState:
+    state_filename = _get_instance_state_path(name)
+    if not os.path.exists(state_filename):
+        return {}
+    with open(state_filename, "rt") as fd:
+        return json.load(fd)
+
+
+@contextmanager
+def _instance_state_lock():
+    "Held while updating any instance's state, so that concurrent updates (ie: by 'hermit proxy') aren't lost"
+    ensure_dir_exists(get_instance_state_dir())
+    with open(os.path.join(get_instance_state_dir(), ".lock"), "at") as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        # (released when the file is closed)
+        yield
+
+
+def update_instance_state(name, **values):
+    with _instance_state_lock():
+        state = dict(read_instance_state(name), **values)
+        write_file_atomically(
+            _get_instance_state_path(name), json.dumps(state, indent=2, sort_keys=True)
+        )
+
 
 def write_instance_config(config: InstanceConfig):
     config_dir = get_instance_config_dir()
@@ -0,0 +1,568 @@
+import subprocess
+import re
+import time
+import argparse
+import json
+import os
+import socket
+import threading
+import urllib.error
+import urllib.request
+
+# The hermit agent runs on the VM (started by hermit-agent.service) so that hermit doesn't need an ssh
+# session for each thing it wants done there. It
+#  - suspends the instance once the container has been idle for a while (and flushes state to disk if a
+#    spot instance is being preempted)
+#  - publishes /var/log/hermit.log (which has the boot stages) and some metrics as guest attributes, which
+#    hermit reads with 'gcloud compute instances get-guest-attributes'
+#  - carries out the commands (shutdown, refresh-image) hermit writes to the instance's hermit-command
+#    metadata key
+#
+# It only uses the standard library, because it runs with the python which comes with Container-Optimized OS.
+
+# cmd to suspend: docker run google/cloud-sdk gcloud compute instances suspend {name} --zone {zone}
+# but needs additional scopes/permissions. Create a service account for this? Actually just a broadening the scope looks sufficient
+import logging
+
+log = logging.getLogger(__name__)
+
+METADATA_URL = "http://metadata.google.internal/computeMetadata/v1/instance"
+# (these must match hermitcrab/agent.py)
+GUEST_ATTRIBUTE_NAMESPACE = "hermit"
+COMMAND_METADATA_KEY = "hermit-command"
+
+HERMIT_LOG_PATH = "/var/log/hermit.log"
+# the most bytes GCE accepts for a guest attribute's value
+GUEST_ATTRIBUTE_VALUE_LIMIT = 4 * 1024
+# only the end of the log is published, to keep within GUEST_ATTRIBUTE_VALUE_LIMIT. If the metadata server
+# rejects it anyway, the limit is halved until it's accepted or reaches MIN_LOG_ATTRIBUTE_LIMIT.
+LOG_ATTRIBUTE_LIMIT = GUEST_ATTRIBUTE_VALUE_LIMIT
+MIN_LOG_ATTRIBUTE_LIMIT = 512
+# seconds between checks for new lines in the log, and between publishing the metrics
+PUBLISH_FREQUENCY = 2
+METRICS_FREQUENCY = 30
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--name", required=True)
+    parser.add_argument("--zone", required=True)
+    parser.add_argument("--project", required=True)
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        required=True,
+        help="minutes without activity before suspending",
+    )
+    parser.add_argument(
+        "--poll-frequency",
+        type=float,
+        default=1,
+        help="minutes between checks for activity",
+    )
+    parser.add_argument("--forwarded-port", action="append", default=[])
+    parser.add_argument("--watch-preemption", action="store_true")
+    parser.add_argument("--log-path", default=HERMIT_LOG_PATH)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    metadata = MetadataServer()
+    monitor = IdleMonitor(time.time())
+
+    threading.Thread(
+        target=publish, args=(metadata, args.log_path, monitor), daemon=True
+    ).start()
+    threading.Thread(
+        target=watch_for_commands,
+        args=(metadata, CommandRunner(args.log_path)),
+        daemon=True,
+    ).start()
+
+    if args.watch_preemption:
+        threading.Thread(
+            target=watch_for_preemption, args=(metadata,), daemon=True
+        ).start()
+
+    # fetch docker image at the beginning just to make sure it's successful and we don't wait until
+    # we actually need it. (But only once sshd is up, so that it doesn't compete with pulling the image
+    # the user is waiting for.)
+    threading.Thread(
+        target=pull_cloud_sdk_image, args=(args.port,), daemon=True
+    ).start()
+
+    poll(
+        args.poll_frequency * 60,
+        args.idle_timeout * 60,
+        args.name,
+        args.zone,
+        args.project,
+        [str(args.port)] + args.forwarded_port,
+        monitor,
+    )
+
+
+class MetadataServer:
+    "Reads this instance's metadata, and writes its guest attributes"
+
+    def __init__(self, url=METADATA_URL):
+        self.url = url
+
+    def get(self, path, last_etag=None):
+        """Returns (value, etag) of the metadata at path. If last_etag is given, this is a long poll which
+        returns once the value no longer has that etag"""
+        url = f"{self.url}/{path}"
+        if last_etag is not None:
+            url += f"?wait_for_change=true&last_etag={last_etag}"
+        request = urllib.request.Request(url, headers={"Metadata-Flavor": "Google"})
+        with urllib.request.urlopen(request) as response:
+            return response.read().decode("utf8"), response.headers.get("ETag")
+
+    def put_guest_attribute(self, key, value):
+        request = urllib.request.Request(
+            f"{self.url}/guest-attributes/{GUEST_ATTRIBUTE_NAMESPACE}/{key}",
+            data=value.encode("utf8"),
+            headers={"Metadata-Flavor": "Google"},
+            method="PUT",
+        )
+        with urllib.request.urlopen(request) as response:
+            response.read()
+
+
+def wait_for_port(port):
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=5).close()
+            return
+        except OSError:
+            time.sleep(1)
+
+
+def pull_cloud_sdk_image(port):
+    wait_for_port(port)
+    subprocess.check_call(["docker", "pull", "google/cloud-sdk"])
+
+
+# --- idle detection ---
+
+
+def is_activity(last_bytes_transmitted, bytes_transmitted):
+    """Returns True if there's been traffic to sshd since the last poll. (The CONTAINER_SSH rules only count
+    packets which carry data, so the probes from hermit's tunnel watchdog, which connect and hang up without
+    sending anything, aren't included.)"""
+    return last_bytes_transmitted != bytes_transmitted
+
+
+class IdleMonitor:
+    "Keeps track of when the container was last in use, from the traffic to its ports at each poll"
+
+    def __init__(self, now):
+        self.last_bytes_transmitted = None
+        self.last_activity = now
+
+    def observe(self, bytes_transmitted, busy, now):
+        "Record the result of a poll. Returns True if there's been activity since the last one"
+        # something like a background copy running counts as activity too
+        active = busy or is_activity(self.last_bytes_transmitted, bytes_transmitted)
+        if active:
+            self.last_activity = now
+        self.last_bytes_transmitted = bytes_transmitted
+        return active
+
+    def get_idle_seconds(self, now):
+        return now - self.last_activity
+
+
+def poll(poll_frequency, activity_timeout, name, zone, project, ports, monitor):
+    suspend_fail_count = 0
+    while True:
+        if monitor.observe(get_bytes_transmitted(ports), is_busy(), time.time()):
+            log.info(
+                "%s", f"active (bytes_transmitted={monitor.last_bytes_transmitted})"
+            )
+
+            # reset if there's some activity. Only want to count the number of failed suspends since we've decided that we're idle
+            suspend_fail_count = 0
+        elapsed_since_activity = monitor.get_idle_seconds(time.time())
+        if preempting.is_set():
+            log.info("Instance is being preempted, so not checking for idleness")
+        elif elapsed_since_activity > activity_timeout:
+            log.info(
+                "%s",
+                f"{elapsed_since_activity} seconds elapsed since last sign of activity. Suspending...",
+            )
+            successful_suspend = suspend_instance(name, zone, project)
+            log.info(
+                f"Suspend is over. Waiting for {activity_timeout/60} minutes before polling again"
+            )
+            time.sleep(activity_timeout)
+            # this is likely after the VM has been resumed but ...
+            # it's been observed that the suspend command often reports failure even though the vm successfully suspended.
+            # I don't have a reliable way of telling whether it worked or not. (Specificly, it gets a timeout trying to read the response
+            # to the suspend request, because while it was
+            # reading, the VM got suspended. ) In the event that suspend _really_ is broken, we want to shutdown as that's
+            # safer then leaving the machine run forever. So, let's go with a heuristic of, if it fails repeatedly then shutdown.
+
+            if not successful_suspend:
+                log.info(
+                    "Suspend command reportedly failed -- but not sure if that's true. Incrementing fail count"
+                )
+                suspend_fail_count += 1
+
+                if suspend_fail_count > 10:
+                    log.info(
+                        f"suspending failed {suspend_fail_count} times. Shutting down as a last resort"
+                    )
+                    _shutdown()
+
+            log.info("Resuming polling...")
+        time.sleep(poll_frequency)
+
+
+def _shutdown():
+    return_code = subprocess.run(["shutdown", "--poweroff"]).returncode
+    log.info(f"return code = {return_code}")
+
+
+def suspend_instance(name, zone, project):
+    has_ssd = os.path.exists("/mnt/disks/local-ssd-0") or os.path.exists(
+        "/mnt/disks/local-ssd"
+    )
+    cmd = [
+        "docker",
+        "run",
+        "google/cloud-sdk",
+        "gcloud",
+        "compute",
+        "instances",
+        "suspend",
+        name,
+        "--zone",
+        zone,
+        "--project",
+        project,
+    ]
+
+    if has_ssd:
+        cmd.append("--discard-local-ssd=false")
+
+    return_code = subprocess.run(cmd).returncode
+
+    return return_code == 0
+
+
+# set once GCP has told us this (spot) instance is going to be stopped
+preempting = threading.Event()
+
+
+def wait_for_preemption(metadata):
+    "Blocks until the metadata server reports that this instance is being preempted"
+    etag = None
+    while True:
+        try:
+            value, etag = metadata.get("preempted", last_etag=etag)
+        except OSError as ex:
+            log.info(
+                f"Could not read preempted from the metadata server ({ex}), will retry"
+            )
+            time.sleep(5)
+            continue
+        if value.strip() == "TRUE":
+            return
+
+
+def watch_for_preemption(metadata):
+    wait_for_preemption(metadata)
+    preempting.set()
+    log.info("Instance is being preempted. Flushing state to disk...")
+    flush_state()
+    log.info("Finished flushing state")
+
+
+def flush_state():
+    # GCP only allows ~30 seconds between the notice and the instance stopping. Stopping the containers sends
+    # SIGTERM to the processes in them, giving them a chance to checkpoint, and then sync makes sure everything
+    # written so far is on the persistent disk.
+    subprocess.run(["sync"])
+    container_ids = subprocess.run(
+        ["docker", "ps", "-q"], stdout=subprocess.PIPE
+    ).stdout.split()
+    if len(container_ids) > 0:
+        subprocess.run(["docker", "stop", "--time=15"] + container_ids)
+    subprocess.run(["sync"])
+
+
+BUSY_DIR = "/run/hermit-busy"
+
+
+def is_busy():
+    "Returns True if any long running operations (ie: hermit stage) have left a marker file in BUSY_DIR"
+    return os.path.exists(BUSY_DIR) and len(os.listdir(BUSY_DIR)) > 0
+
+
+def get_bytes_transmitted(ports):
+    "Returns the total bytes sent to the given ports (sshd and any forwarded ports)"
+    output = subprocess.check_output(["iptables", "-nvxL", "CONTAINER_SSH"])
+    return parse_bytes_transmitted(output.decode("utf8"), ports)
+
+
+def parse_bytes_transmitted(output, ports):
+    lines = output.split("\n")
+
+    def parse(port):
+        for line in lines:
+            if (
+                f"tcp dpt:{port}" in line
+            ):  # find the line for the rule for traffic on the port
+                m = re.match("\\s*(\\d+)\\s+(\\d+)\\s+.", line)
+                if m is not None:
+                    return int(m.group(2))
+        return None  # could not find the rule
+
+    total = 0
+    for port in ports:
+        result = parse(port)
+        if result is None:
+            print(f"Could not parse: {output}")
+            return None
+        total += result
+    return total
+
+
+# --- reporting ---
+
+
+def read_metrics(proc_dir="/proc"):
+    "Returns a summary of how busy the VM is, read from the files in proc_dir"
+    with open(os.path.join(proc_dir, "loadavg"), "rt") as fd:
+        load_average = float(fd.read().split()[0])
+    with open(os.path.join(proc_dir, "uptime"), "rt") as fd:
+        uptime = float(fd.read().split()[0])
+    meminfo = {}
+    with open(os.path.join(proc_dir, "meminfo"), "rt") as fd:
+        for line in fd:
+            m = re.match("^(\\S+):\\s+(\\d+)", line)
+            if m:
+                meminfo[m.group(1)] = int(m.group(2))
+    memory_used = meminfo["MemTotal"] - meminfo["MemAvailable"]
+    return {
+        "load_average": load_average,
+        "memory_used_percent": round(100 * memory_used / meminfo["MemTotal"]),
+        "uptime_seconds": round(uptime),
+    }
+
+
+def read_log_tail(log_path, limit=LOG_ATTRIBUTE_LIMIT):
+    "Returns at most the last limit bytes (once encoded as utf8) of the log, starting at the beginning of a line, or '' if it doesn't exist yet"
+    if not os.path.exists(log_path):
+        return ""
+    with open(log_path, "rb") as fd:
+        fd.seek(0, os.SEEK_END)
+        size = fd.tell()
+        fd.seek(max(0, size - limit))
+        content = fd.read()
+    if size > limit:
+        content = content[content.find(b"\n") + 1 :]
+    # each invalid byte is replaced by a 3 byte character, which can take it over the limit again
+    content = content.decode("utf8", errors="replace").encode("utf8")
+    if len(content) > limit:
+        content = content[-limit:]
+        content = content[content.find(b"\n") + 1 :]
+    return content.decode("utf8", errors="ignore")
+
+
+def publish(metadata, log_path, monitor, proc_dir="/proc"):
+    "Keeps the log and the metrics in the guest attributes up to date"
+    published_log = None
+    log_limit = LOG_ATTRIBUTE_LIMIT
+    metrics_published_at = 0
+    while True:
+        try:
+            log_content = read_log_tail(log_path, log_limit)
+            if log_content != published_log:
+                try:
+                    metadata.put_guest_attribute("log", log_content)
+                    published_log = log_content
+                except urllib.error.HTTPError as ex:
+                    # (a 4xx won't succeed by trying the same thing again)
+                    if not 400 <= ex.code < 500:
+                        raise
+                    if log_limit > MIN_LOG_ATTRIBUTE_LIMIT:
+                        log_limit = max(MIN_LOG_ATTRIBUTE_LIMIT, log_limit // 2)
+                        log.info(
+                            f"Log rejected ({ex}), publishing only its last {log_limit} bytes"
+                        )
+                    else:
+                        log.info(f"Log rejected ({ex}), skipping this version of it")
+                        published_log = log_content
+
+            now = time.time()
+            if now - metrics_published_at >= METRICS_FREQUENCY:
+                metrics = read_metrics(proc_dir)
+                metrics["idle_seconds"] = round(monitor.get_idle_seconds(now))
+                metadata.put_guest_attribute("metrics", json.dumps(metrics))
+                metrics_published_at = now
+        except OSError as ex:
+            log.info(f"Could not publish guest attributes ({ex}), will retry")
+        time.sleep(PUBLISH_FREQUENCY)
+
+
+# --- commands from hermit ---
+
+# commands which the agent first saw longer ago than this are ignored, so that one which was left in the
+# metadata isn't carried out long after it was sent. (This is measured with the VM's clock, rather than by
+# when hermit sent it, as the two clocks may not agree.)
+COMMAND_EXPIRY = 10 * 60
+# when the agent first saw each command and whether it was carried out. This is on the stateful partition,
+# so that a command which was already carried out (ie: a shutdown) isn't repeated after a reboot
+COMMANDS_PATH = "/var/lib/hermit-agent/commands.json"
+
+
+def parse_command(value):
+    "Returns the command hermit wrote to the metadata (a dict with at least 'id' and 'action'), or None if it's not a command"
+    try:
+        command = json.loads(value)
+    except ValueError:
+        return None
+    if not isinstance(command, dict) or not all(
+        key in command for key in ["id", "action"]
+    ):
+        return None
+    return command
+
+
+def is_pending(command, handled_ids, first_seen, now):
+    "Returns True if the command still needs to be carried out, given when the agent first saw it"
+    return command["id"] not in handled_ids and now - first_seen < COMMAND_EXPIRY
+
+
+class CommandRunner:
+    "Carries out commands from hermit, writing their progress to the log hermit reads"
+
+    def __init__(self, log_path, commands_path=COMMANDS_PATH):
+        self.log_path = log_path
+        self.commands_path = commands_path
+
+    def _log(self, line):
+        log.info("%s", line)
+        with open(self.log_path, "at") as fd:
+            fd.write(line + "\n")
+
+    def _read_commands(self):
+        "Returns a dict of command id -> {'first_seen': ..., 'handled': ...}"
+        if not os.path.exists(self.commands_path):
+            return {}
+        with open(self.commands_path, "rt") as fd:
+            return json.load(fd)
+
+    def _write_commands(self, commands):
+        os.makedirs(os.path.dirname(self.commands_path), exist_ok=True)
+        tmp_path = self.commands_path + ".tmp"
+        with open(tmp_path, "wt") as fd:
+            json.dump(commands, fd)
+        os.replace(tmp_path, self.commands_path)
+
+    def get_first_seen(self, command_id, now):
+        "Returns when the agent first saw the command, recording now if this is the first time"
+        commands = self._read_commands()
+        if command_id not in commands:
+            commands[command_id] = {"first_seen": now, "handled": False}
+            self._write_commands(commands)
+        return commands[command_id]["first_seen"]
+
+    def get_handled_ids(self):
+        return {
+            command_id
+            for command_id, record in self._read_commands().items()
+            if record["handled"]
+        }
+
+    def run(self, command):
+        commands = self._read_commands()
+        commands.setdefault(command["id"], {"first_seen": time.time()})
+        commands[command["id"]]["handled"] = True
+        self._write_commands(commands)
+
+        action = command["action"]
+        if action == "shutdown":
+            self._log(f"Command {command['id']}: shutting down")
+            _shutdown()
+        elif action == "refresh-image":
+            self.refresh_image(
+                command["id"],
+                command["current_image"],
+                command["new_image"],
+                command["files"],
+            )
+        else:
+            self._log(f"Command {command['id']}: unknown action {repr(action)}")
+
+    def refresh_image(self, refresh_id, current_image, new_image, files):
+        "files are the ones on the VM which refer to the docker image the container runs"
+        # the old container keeps running while the new image is pulled, so the only interruption is
+        # the restart of the container at the end
+        self._log(f"Refresh {refresh_id} started: {current_image} -> {new_image}")
+        start = time.time()
+        with open(self.log_path, "at") as log_fd:
+            pull = subprocess.run(
+                ["docker", "pull", new_image],
+                env={**os.environ, "HOME": "/home/cloudservice"},
+                stdout=log_fd,
+                stderr=subprocess.STDOUT,
+            )
+        if pull.returncode == 0:
+            self._log(
+                f"Refresh {refresh_id} pulled {new_image} in {time.time() - start:.0f} seconds"
+            )
+            for path in files:
+                with open(path, "rt") as fd:
+                    content = fd.read()
+                with open(path, "wt") as fd:
+                    fd.write(content.replace(current_image, new_image))
+            subprocess.run(["systemctl", "daemon-reload"])
+            rc = subprocess.run(
+                ["systemctl", "restart", "container-sshd.service"]
+            ).returncode
+        else:
+            rc = 1
+        self._log(f"Refresh {refresh_id} finished (exit code {rc})")
+
+
+def watch_for_commands(metadata, runner):
+    "Carries out each command hermit writes to the hermit-command metadata key"
+    etag = None
+    while True:
+        try:
+            value, etag = metadata.get(
+                f"attributes/{COMMAND_METADATA_KEY}", last_etag=etag
+            )
+        except urllib.error.HTTPError as ex:
+            if ex.code != 404:
+                log.info(f"Could not read {COMMAND_METADATA_KEY} ({ex}), will retry")
+            # (404 means no command has been sent yet)
+            etag = None
+            time.sleep(5)
+            continue
+        except OSError as ex:
+            log.info(f"Could not read {COMMAND_METADATA_KEY} ({ex}), will retry")
+            time.sleep(5)
+            continue
+
+        command = parse_command(value)
+        if command is None:
+            log.info(f"Ignoring {COMMAND_METADATA_KEY}={repr(value)}")
+        elif is_pending(
+            command,
+            runner.get_handled_ids(),
+            runner.get_first_seen(command["id"], time.time()),
+            time.time(),
+        ):
+            try:
+                runner.run(command)
+            except Exception as ex:
+                log.exception(f"Command {command['id']} failed: {ex}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
+import hashlib
 import subprocess
 import time
-from typing import List, Union
+from typing import List, Optional, Union
 import logging
 import json
 import requests
@@ -144,8 +145,14 @@ def gcloud(args: List[str], timeout=10):
         )
 
 
-def get_instance_status(name, zone, project, one_or_none=False):
-    status = gcloud_capturing_json_output(
+def get_region(zone: str):
+    # zones are named like "us-central1-a" where "us-central1" is the region
+    return zone.rsplit("-", 1)[0]
+
+
+def get_instance(name, zone, project, one_or_none=False):
+    "Returns the full description of the instance (including status and machineType)"
+    instances = gcloud_capturing_json_output(
         [
             "compute",
             "instances",
@@ -157,11 +164,88 @@ def get_instance_status(name, zone, project, one_or_none=False):
         ],
     )
     if one_or_none:
-        if len(status) == 0:
+        if len(instances) == 0:
+            return None
+    assert len(instances) == 1
+
+    return instances[0]
+
+
+def get_instance_status(name, zone, project, one_or_none=False):
+    instance = get_instance(name, zone, project, one_or_none=one_or_none)
+    if instance is None:
+        return None
+    return instance["status"]
+
+
+def get_disk_type(disk):
+    "Returns the type (ie: pd-balanced) of a disk described by get_disk, which gcloud gives as a URL"
+    return disk["type"].split("/")[-1]
+
+
+def get_disk(name, zone, project, one_or_none=False):
+    "Returns the description of the persistent disk (including sizeGb and type)"
+    disks = gcloud_capturing_json_output(
+        [
+            "compute",
+            "disks",
+            "list",
+            f"--filter=name={name}",
+            "--format=json",
+            f"--zones={zone}",
+            f"--project={project}",
+        ],
+    )
+    if one_or_none:
+        if len(disks) == 0:
             return None
-    assert len(status) == 1
+    assert len(disks) == 1
+
+    return disks[0]
 
-    return status[0]["status"]
+
+def get_preemptions(name, zone, project):
+    "Returns the times (as RFC3339 strings, oldest first) of the preemptions of the instance that GCP still has a record of"
+    operations = gcloud_capturing_json_output(
+        [
+            "compute",
+            "operations",
+            "list",
+            f"--filter=operationType=compute.instances.preempted AND targetLink~/instances/{name}$",
+            "--format=json",
+            f"--zones={zone}",
+            f"--project={project}",
+        ],
+    )
+    return sorted(
+        [
+            operation["insertTime"]
+            for operation in operations
+            if operation["operationType"] == "compute.instances.preempted"
+            and operation["targetLink"].endswith(f"/instances/{name}")
+        ]
+    )
+
+
+def get_repository(name, location, project, one_or_none=False):
+    "Returns the description of the Artifact Registry repository (including its mode and remoteRepositoryConfig)"
+    repositories = gcloud_capturing_json_output(
+        [
+            "artifacts",
+            "repositories",
+            "list",
+            f"--filter=name=projects/{project}/locations/{location}/repositories/{name}",
+            "--format=json",
+            f"--location={location}",
+            f"--project={project}",
+        ],
+    )
+    if one_or_none:
+        if len(repositories) == 0:
+            return None
+    assert len(repositories) == 1
+
+    return repositories[0]
 
 
 def wait_for_instance_status(name, zone, project, goal_status, max_time=5 * 60):
@@ -246,8 +330,41 @@ def has_access_to_docker_image(service_account, docker_image):
     return True
 
 
+# the manifest formats we can make sense of. Without an Accept header, registries may fall back to the
+# deprecated schema 1 format.
+DOCKER_MANIFEST_MEDIA_TYPES = [
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.oci.image.index.v1+json",
+]
+
+
+@dataclass
+class DockerImageManifest:
+    image_name: "DockerImageName"
+    # a token for the registry which acts as the service account, for fetching the image's blobs
+    access_token: str
+    manifest: dict
+    # the digest of the manifest, which identifies this version of the image even if the tag is moved
+    digest: str
+
+    def get_registry_url(self, kind: str, reference: str):
+        "Returns the URL of a manifest or blob (kind is 'manifests' or 'blobs') in the image's repository"
+        return f"https://{self.image_name.host}:{self.image_name.port}/v2/{self.image_name.path}/{kind}/{reference}"
+
+    def get_auth_headers(self):
+        return {"Authorization": f"Bearer {self.access_token}"}
+
+
+def get_docker_image_manifest(service_account, docker_image) -> DockerImageManifest:
+    """Fetches the image's manifest as the service account. Raises AccessDenied if the service account
+    can't read the image"""
+    return _check_access_to_docker_image(service_account, docker_image)
+
+
 def _check_access_to_docker_image(service_account, docker_image):
-    "Tests to make sure that the given service account can read the docker_image. Throws an assertion error if not"
+    "Tests to make sure that the given service account can read the docker_image. Throws an assertion error if not. Returns the manifest"
     access_token = _get_access_token()
 
     service_account_access_token = _get_impersonating_access_token(
@@ -265,7 +382,10 @@ def _check_access_to_docker_image(service_account, docker_image):
     #    manifest_url="https://us-central1-docker.pkg.dev:443/v2/us-central1-docker.pkg.dev/cds-docker-containers/docker/manifests/latest"
     res = requests.get(
         manifest_url,
-        headers={"Authorization": f"Bearer {service_account_access_token}"},
+        headers={
+            "Authorization": f"Bearer {service_account_access_token}",
+            "Accept": ", ".join(DOCKER_MANIFEST_MEDIA_TYPES),
+        },
     )
 
     #     with open("req.py", "wt") as fd:
@@ -282,7 +402,13 @@ def _check_access_to_docker_image(service_account, docker_image):
 
     if res.status_code == 200:
         # return if we were successful
-        return
+        # registries report the digest in a header, but it's defined as the hash of the manifest
+        digest = res.headers.get(
+            "Docker-Content-Digest", "sha256:" + hashlib.sha256(res.content).hexdigest()
+        )
+        return DockerImageManifest(
+            parsed_image_name, service_account_access_token, res.json(), digest
+        )
 
     if res.status_code == 404:
         raise Exception(
@@ -331,7 +457,7 @@ def _default_to(value, default):
 
 def parse_docker_image_name(docker_image):
     m = re.match(
-        r"(?:([a-z0-9-]+\\.[a-z0-9-.]+)?(?::(\\d+))?/)?([a-z0-9-_/]+)(?::([a-z0-9-_/.]+))?",
+        r"(?:([a-z0-9-]+\.[a-z0-9-.]+)?(?::(\d+))?/)?([a-z0-9-_/]+)(?::([a-z0-9-_/.]+))?",
         docker_image,
     )
     if m is None:
@@ -393,7 +519,56 @@ def parse_docker_image_name(docker_image):
     return generic
 
 
-def get_grant_instructions(service_account, docker_image):
+def _get_registry_cache_grant_instructions(
+    service_account, docker_image, cached_docker_image
+):
+    parsed_name = parse_docker_image_name(docker_image)
+    cache_name = parse_docker_image_name(cached_docker_image)
+    assert isinstance(cache_name, ArtifactRegistryPath)
+
+    upstream_grant = ""
+    if isinstance(parsed_name, ArtifactRegistryPath):
+        # the cache fetches images from the upstream repository as Artifact Registry's service agent
+        upstream_grant = f"""
+gcloud artifacts repositories add-iam-policy-binding {parsed_name.repository} \\
+    --location={parsed_name.location} \\
+    --member="serviceAccount:service-$(gcloud projects describe {cache_name.project} --format='value(projectNumber)')@gcp-sa-artifactregistry.iam.gserviceaccount.com" \\
+    --role='roles/artifactregistry.reader' \\
+    --project='{parsed_name.project}'
+"""
+
+    return f"""{docker_image} is pulled through the registry cache {cache_name.repository} in {cache_name.location}.
+Execute the following to grant access to hermit's service account (and, so that it can fill the cache,
+to the registry cache itself):
+
+gcloud artifacts repositories add-iam-policy-binding {cache_name.repository} \\
+    --location={cache_name.location} \\
+    --member='serviceAccount:{service_account}' \\
+    --role='roles/artifactregistry.reader' \\
+    --project='{cache_name.project}'
+{upstream_grant}
+After this has executed successfully, wait a few minutes (grants don't apply instantaneously)
+and try your hermit operation again.
+            """
+
+
+def pin_docker_image_name(docker_image, digest):
+    "Returns a reference to the docker image which refers to the given digest, even if the tag is moved later"
+    name = docker_image.split("@")[0]
+    # a ':' after the last '/' separates the tag (one before it would be the registry's port)
+    if ":" in name.split("/")[-1]:
+        name = name[: name.rfind(":")]
+    return f"{name}@{digest}"
+
+
+def get_grant_instructions(service_account, docker_image, cached_docker_image=None):
+    """cached_docker_image is the name the image is pulled by if it goes through a registry cache
+    (see registry_cache.py)"""
+    if cached_docker_image is not None and cached_docker_image != docker_image:
+        return _get_registry_cache_grant_instructions(
+            service_account, docker_image, cached_docker_image
+        )
+
     parsed_name = parse_docker_image_name(docker_image)
 
     if isinstance(parsed_name, ArtifactRegistryPath):
@@ -0,0 +1,189 @@
+import json
+import os
+import posixpath
+import tarfile
+from typing import Dict, List, Optional
+
+import requests
+
+from . import gcp
+from .config import get_image_check_cache_dir, ensure_dir_exists
+from .errors import UserError
+
+# Checks that an image meets hermit's requirements (see dockerimage/basic/Dockerfile) by reading it
+# through the registry API, instead of finding out after a VM has booted and pulled it. Only the two
+# files which matter are read out of the layers, and the result is cached by the digest of the image's
+# config, so an image is only scanned once.
+
+PASSWD_PATH = "etc/passwd"
+SSHD_PATH = "usr/sbin/sshd"
+REQUIRED_UID = 2000
+
+MANIFEST_LIST_MEDIA_TYPES = [
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+]
+
+
+class InvalidDockerImage(UserError):
+    pass
+
+
+def _normalize_path(name):
+    # layer tarballs name their entries either "etc/passwd" or "./etc/passwd"
+    return posixpath.normpath(name).lstrip("/")
+
+
+def _is_hidden_by(path, whiteouts, opaque_dirs):
+    "Returns True if a layer's whiteouts mean that the path from the layers below it is deleted"
+    if path in whiteouts:
+        return True
+    parent = posixpath.dirname(path)
+    while parent != "":
+        if parent in opaque_dirs or parent in whiteouts:
+            return True
+        parent = posixpath.dirname(parent)
+    return False
+
+
+def scan_layer(fileobj, unresolved: List[str]) -> Dict[str, Optional[bytes]]:
+    """Reads the layer tarball as a stream, looking for the paths in unresolved. Returns a dict of path ->
+    contents (b"" if it's not a regular file) for the paths in the layer, or path -> None for those which
+    the layer deletes. Paths not mentioned by the layer are left out."""
+    found = {}
+    whiteouts = set()
+    opaque_dirs = set()
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        for member in tar:
+            path = _normalize_path(member.name)
+            dirname, basename = posixpath.split(path)
+            if basename == ".wh..wh..opq":
+                opaque_dirs.add(dirname)
+            elif basename.startswith(".wh."):
+                whiteouts.add(posixpath.join(dirname, basename[len(".wh.") :]))
+            elif path in unresolved:
+                extracted = tar.extractfile(member) if member.isfile() else None
+                found[path] = b"" if extracted is None else extracted.read()
+                if len(found) == len(unresolved):
+                    # a path can't be both present and deleted in the same layer, so we're done
+                    break
+
+    for path in unresolved:
+        if path not in found and _is_hidden_by(path, whiteouts, opaque_dirs):
+            found[path] = None
+    return found
+
+
+def get_problems(files: Dict[str, Optional[bytes]]) -> List[str]:
+    "Given the contents of the files the image's filesystem ends up with (None if missing), returns what's wrong with it"
+    problems = []
+    if files.get(SSHD_PATH) is None:
+        problems.append(
+            f"/{SSHD_PATH} does not exist (openssh-server must be installed)"
+        )
+
+    passwd = files.get(PASSWD_PATH)
+    if passwd is None:
+        problems.append(f"/{PASSWD_PATH} does not exist")
+    else:
+        uid = None
+        for line in passwd.decode("utf8", errors="replace").split("\n"):
+            fields = line.split(":")
+            if len(fields) >= 3 and fields[0] == "ubuntu":
+                uid = fields[2]
+        if uid is None:
+            problems.append(f'there is no user named "ubuntu" in /{PASSWD_PATH}')
+        elif uid != str(REQUIRED_UID):
+            problems.append(
+                f'the user "ubuntu" has uid {uid}, but it must have uid {REQUIRED_UID}'
+            )
+    return problems
+
+
+def _resolve_platform_manifest(image_manifest: gcp.DockerImageManifest, docker_image):
+    "If the manifest is a list of per-platform manifests, fetch the one for the VM's platform (linux/amd64)"
+    manifest = image_manifest.manifest
+    if manifest.get("mediaType") not in MANIFEST_LIST_MEDIA_TYPES:
+        return manifest
+
+    for entry in manifest["manifests"]:
+        platform = entry.get("platform", {})
+        if platform.get("os") == "linux" and platform.get("architecture") == "amd64":
+            res = requests.get(
+                image_manifest.get_registry_url("manifests", entry["digest"]),
+                headers={
+                    **image_manifest.get_auth_headers(),
+                    "Accept": entry["mediaType"],
+                },
+            )
+            assert (
+                res.status_code == 200
+            ), f"Unexpected status_code={res.status_code} when fetching manifest {entry['digest']}"
+            return res.json()
+
+    raise InvalidDockerImage(f"{docker_image} does not have a linux/amd64 version")
+
+
+def _scan_image(image_manifest: gcp.DockerImageManifest, manifest):
+    """Reads the layers from the top down until it's known what the image ends up with at each path we care
+    about. Returns a dict of path -> contents (None or missing if the image doesn't have it), or None if a
+    layer couldn't be read"""
+    files = {}
+    for layer in reversed(manifest["layers"]):
+        unresolved = [path for path in [PASSWD_PATH, SSHD_PATH] if path not in files]
+        if len(unresolved) == 0:
+            break
+        if "zstd" in layer["mediaType"]:
+            # tarfile can't decompress these, so we can't tell
+            return None
+        res = requests.get(
+            image_manifest.get_registry_url("blobs", layer["digest"]),
+            headers=image_manifest.get_auth_headers(),
+            stream=True,
+        )
+        assert (
+            res.status_code == 200
+        ), f"Unexpected status_code={res.status_code} when fetching layer {layer['digest']}"
+        try:
+            files.update(scan_layer(res.raw, unresolved))
+        finally:
+            res.close()
+    return files
+
+
+def _get_cache_path(digest):
+    return os.path.join(get_image_check_cache_dir(), f"{digest.replace(':', '-')}.json")
+
+
+def check_docker_image(service_account, docker_image) -> gcp.DockerImageManifest:
+    """Raises gcp.AccessDenied if the service account can't read the image, and InvalidDockerImage if
+    the image can't work with hermit. Returns the image's manifest."""
+    image_manifest = gcp.get_docker_image_manifest(service_account, docker_image)
+    manifest = _resolve_platform_manifest(image_manifest, docker_image)
+    digest = manifest["config"]["digest"]
+
+    cache_path = _get_cache_path(digest)
+    if os.path.exists(cache_path):
+        with open(cache_path, "rt") as fd:
+            problems = json.load(fd)["problems"]
+    else:
+        print(f"Checking that {docker_image} has what hermit needs...")
+        files = _scan_image(image_manifest, manifest)
+        if files is None:
+            gcp.log_info(
+                f"Could not check {docker_image} because it has zstd compressed layers"
+            )
+            return image_manifest
+        problems = get_problems(files)
+        ensure_dir_exists(get_image_check_cache_dir())
+        with open(cache_path, "wt") as fd:
+            fd.write(json.dumps({"image": docker_image, "problems": problems}))
+
+    if len(problems) > 0:
+        raise InvalidDockerImage(
+            f"The docker image {docker_image} can't be used with hermit because "
+            + " and ".join(problems)
+            + ". See dockerimage/basic/Dockerfile in https://github.com/broadinstitute/hermitcrab for what an image needs."
+        )
+
+    return image_manifest
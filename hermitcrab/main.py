@@ -1,6 +1,25 @@
 import argparse
 import sys
-from .command import create, up, down, update_ssh, status, delete, version
+from .command import (
+    create,
+    up,
+    down,
+    update_ssh,
+    status,
+    delete,
+    version,
+    sync,
+    stage,
+    snapshot,
+    clone,
+    resize,
+    reshape,
+    move,
+    prewarm,
+    refresh_image,
+    proxy,
+    watchdog,
+)
 import logging
 
 
@@ -17,6 +36,17 @@ def main(argv=None):
     status.add_command(subparser)
     delete.add_command(subparser)
     version.add_command(subparser)
+    sync.add_command(subparser)
+    stage.add_command(subparser)
+    snapshot.add_command(subparser)
+    clone.add_command(subparser)
+    resize.add_command(subparser)
+    reshape.add_command(subparser)
+    move.add_command(subparser)
+    prewarm.add_command(subparser)
+    refresh_image.add_command(subparser)
+    proxy.add_command(subparser)
+    watchdog.add_command(subparser)
 
     def print_help(args):
         parse.print_help()
@@ -0,0 +1,78 @@
+import json
+import os
+import time
+from typing import List
+
+from .config import InstanceConfig, get_zone_capacity_cache_path
+
+# how long to trust what we saw the last time we tried to get an instance in a zone
+CAPACITY_CACHE_MAX_AGE = 60 * 60
+
+# gcloud reports a zone being out of capacity with either of these, depending on whether the
+# failure was detected before or after the operation started
+CAPACITY_ERROR_MESSAGES = [
+    "ZONE_RESOURCE_POOL_EXHAUSTED",
+    "does not have enough resources available",
+]
+
+
+def is_capacity_error(message: str):
+    return any(msg in message for msg in CAPACITY_ERROR_MESSAGES)
+
+
+def _capacity_key(instance_config: InstanceConfig, zone: str):
+    # capacity depends on what kind of instance is being requested, not just the zone
+    return f"{instance_config.project}/{zone}/{instance_config.machine_type}/{instance_config.local_ssd_count}/{instance_config.provisioning_model}"
+
+
+def _read_cache():
+    path = get_zone_capacity_cache_path()
+    if not os.path.exists(path):
+        return {}
+    with open(path, "rt") as fd:
+        return json.load(fd)
+
+
+def record_capacity(instance_config: InstanceConfig, zone: str, has_capacity: bool):
+    cache = _read_cache()
+    cache[_capacity_key(instance_config, zone)] = {
+        "has_capacity": has_capacity,
+        "timestamp": time.time(),
+    }
+    # drop the entries which are too old to be used
+    cache = {
+        key: value
+        for key, value in cache.items()
+        if time.time() - value["timestamp"] < CAPACITY_CACHE_MAX_AGE
+    }
+    with open(get_zone_capacity_cache_path(), "wt") as fd:
+        fd.write(json.dumps(cache, indent=2, sort_keys=True))
+
+
+def recent_capacity(instance_config: InstanceConfig, zone: str):
+    "Returns True or False if we recently tried to get this kind of instance in the zone, otherwise None"
+    entry = _read_cache().get(_capacity_key(instance_config, zone))
+    if entry is None or time.time() - entry["timestamp"] >= CAPACITY_CACHE_MAX_AGE:
+        return None
+    return entry["has_capacity"]
+
+
+def order_zones(instance_config: InstanceConfig) -> List[str]:
+    """Returns the zones to try, in order. Moving to another zone means copying the disk, so the
+    current zone is tried first unless it recently didn't have capacity. Fallback zones which recently
+    had capacity are tried before the others."""
+
+    def priority(zone):
+        has_capacity = recent_capacity(instance_config, zone)
+        if has_capacity == False:
+            return 3
+        if zone == instance_config.zone:
+            return 0
+        if has_capacity == True:
+            return 1
+        return 2
+
+    zones = [instance_config.zone] + [
+        zone for zone in instance_config.fallback_zones if zone != instance_config.zone
+    ]
+    return sorted(zones, key=priority)
@@ -0,0 +1,141 @@
+from typing import Optional
+
+from . import gcp
+from .config import (
+    InstanceConfig,
+    LONG_OPERATION_TIMEOUT,
+    is_assumption_present,
+    record_assumption,
+)
+from .errors import UserError
+
+# An Artifact Registry "remote repository" is a pull-through cache: images pulled through it are fetched
+# from the upstream registry the first time and served from the cache's region afterwards. Keeping one
+# in the VM's region means the multi-GB image only crosses regions once per region instead of once per VM.
+
+DEFAULT_REGISTRY_CACHE_NAME = "hermit-cache"
+
+
+def _upstream_repo(parsed_image_name):
+    "Returns the value of --remote-docker-repo for a cache of the registry the image is hosted in"
+    if isinstance(parsed_image_name, gcp.ArtifactRegistryPath):
+        return f"https://{parsed_image_name.host}/{parsed_image_name.project}/{parsed_image_name.repository}"
+    if parsed_image_name.host == "docker.io":
+        return "DOCKER-HUB"
+    raise UserError(
+        f"A registry cache can only be used for images hosted in Artifact Registry or Docker Hub, not {parsed_image_name.host}"
+    )
+
+
+def _path_in_cache(parsed_image_name):
+    if isinstance(parsed_image_name, gcp.ArtifactRegistryPath):
+        return parsed_image_name.image_name
+    if "/" not in parsed_image_name.path:
+        # official images on Docker Hub (ie: "ubuntu") live under "library/"
+        return f"library/{parsed_image_name.path}"
+    return parsed_image_name.path
+
+
+def get_cached_docker_image(
+    docker_image: str, registry_cache: Optional[str], zone: str, project: str
+):
+    """Returns the name to pull docker_image by from a VM in zone. If there is no registry cache, or the
+    image is already hosted in the VM's region, this is docker_image itself."""
+    if registry_cache is None:
+        return docker_image
+
+    parsed_image_name = gcp.parse_docker_image_name(docker_image)
+    region = gcp.get_region(zone)
+    if (
+        isinstance(parsed_image_name, gcp.ArtifactRegistryPath)
+        and parsed_image_name.location == region
+    ):
+        return docker_image
+
+    # fail early if this image can't go through a cache
+    _upstream_repo(parsed_image_name)
+
+    return f"{region}-docker.pkg.dev/{project}/{registry_cache}/{_path_in_cache(parsed_image_name)}:{parsed_image_name.tag}"
+
+
+def get_instance_docker_image(instance_config: InstanceConfig):
+    "Returns the name the instance pulls its docker image by"
+    return get_cached_docker_image(
+        instance_config.docker_image,
+        instance_config.registry_cache,
+        instance_config.zone,
+        instance_config.project,
+    )
+
+
+def _existing_upstream_repo(repository):
+    remote_config = repository.get("remoteRepositoryConfig", {}).get(
+        "dockerRepository", {}
+    )
+    if remote_config.get("publicRepository") == "DOCKER_HUB":
+        return "DOCKER-HUB"
+    return remote_config.get("customRepository", {}).get("uri")
+
+
+def ensure_registry_cache(
+    docker_image: str, registry_cache: Optional[str], zone: str, project: str
+):
+    "Create the registry cache in the zone's region, unless it's not needed or already exists"
+    if (
+        registry_cache is None
+        or get_cached_docker_image(docker_image, registry_cache, zone, project)
+        == docker_image
+    ):
+        return
+
+    region = gcp.get_region(zone)
+    upstream_repo = _upstream_repo(gcp.parse_docker_image_name(docker_image))
+    # a repository can't change its upstream, so once we've seen it, there's no need to look again
+    assumption = f"registry-cache:{project}/{region}/{registry_cache}:{upstream_repo}"
+    if is_assumption_present(assumption):
+        return
+
+    repository = gcp.get_repository(registry_cache, region, project, one_or_none=True)
+    if repository is None:
+        print(
+            f"Creating registry cache {registry_cache} in {region} for {upstream_repo}..."
+        )
+        gcp.gcloud(
+            [
+                "services",
+                "enable",
+                "artifactregistry.googleapis.com",
+                f"--project={project}",
+            ],
+            timeout=60 * 10,
+        )
+        gcp.gcloud(
+            [
+                "artifacts",
+                "repositories",
+                "create",
+                registry_cache,
+                "--repository-format=docker",
+                "--mode=remote-repository",
+                f"--remote-docker-repo={upstream_repo}",
+                f"--location={region}",
+                f"--project={project}",
+                "--description=Pull-through cache of docker images for hermit instances",
+            ],
+            timeout=LONG_OPERATION_TIMEOUT,
+        )
+    elif _existing_upstream_repo(repository) != upstream_repo:
+        raise UserError(
+            f"The repository {registry_cache} in {region} already exists, but is not a cache of {upstream_repo}. Use a different name for the registry cache"
+        )
+
+    record_assumption(assumption)
+
+
+def ensure_instance_registry_cache(instance_config: InstanceConfig):
+    ensure_registry_cache(
+        instance_config.docker_image,
+        instance_config.registry_cache,
+        instance_config.zone,
+        instance_config.project,
+    )
@@ -54,6 +54,30 @@ def get_ssh_config_path():
     return os.path.join(get_ssh_dir(), "config")
 
 
+def get_proxy_command(name: str):
+    # use the full path, because ssh may be run (ie: by an editor) without hermit's virtualenv on the PATH
+    hermit = shutil.which("hermit") or "hermit"
+    return f"{hermit} proxy {name}"
+
+
+def _direct_connection_section(instance_config: config.InstanceConfig):
+    """For instances with connection_mode "direct", returns a block which makes ssh connect straight to the
+    instance's internal IP when it answers, instead of using the ProxyCommand of the Host block after it.
+    (ssh uses the first value it finds for each setting, so this has to come first.)"""
+    if instance_config.connection_mode != "direct":
+        return ""
+    internal_ip = config.read_instance_state(instance_config.name).get("internal_ip")
+    if internal_ip is None:
+        # not known until the instance has been brought up
+        return ""
+    return f"""Match originalhost {instance_config.name} exec "nc -z -w 1 {internal_ip} {config.CONTAINER_SSHD_PORT}"
+   Hostname {internal_ip}
+   Port {config.CONTAINER_SSHD_PORT}
+   ProxyCommand none
+
+"""
+
+
 def update_ssh_config(configs: Sequence[config.InstanceConfig]):
     # because default is an alias, we get dups in this sequence. Dedup them by name
     by_name = {c.name: c for c in configs}
@@ -87,11 +111,11 @@ def update_ssh_config(configs: Sequence[config.InstanceConfig]):
 """
         ]
         for instance_config in configs:
+            new_section.append(_direct_connection_section(instance_config))
             new_section.append(
                 f"""Host {instance_config.name}
-   Hostname localhost
    User ubuntu
-   Port {instance_config.local_port}
+   ProxyCommand {get_proxy_command(instance_config.name)}
    UserKnownHostsFile /dev/null
    StrictHostKeyChecking no
 
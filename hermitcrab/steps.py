@@ -0,0 +1,75 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+
+@dataclass
+class Step:
+    name: str
+    callback: Callable[[], object]
+    depends_on: List[str] = field(default_factory=list)
+
+
+def run_steps(steps: List[Step], output_callback=print) -> Dict[str, object]:
+    """Run each step as soon as all the steps it depends on have completed. Independent steps run
+    concurrently. Returns a dict of step name -> value returned by the step's callback.
+
+    If a step fails, no further steps are started, the ones already running are allowed to finish and
+    then the exception from the first failure is re-raised."""
+    by_name = {step.name: step for step in steps}
+    assert len(by_name) == len(steps), "step names must be unique"
+    for step in steps:
+        for dependency in step.depends_on:
+            assert (
+                dependency in by_name
+            ), f"{step.name} depends on unknown step {dependency}"
+
+    results = {}
+    pending = list(steps)
+    running = {}
+    failure = None
+    output_lock = threading.Lock()
+
+    def output(msg):
+        with output_lock:
+            output_callback(msg)
+
+    def run(step):
+        output(f"[{step.name}] started")
+        start = time.time()
+        value = step.callback()
+        output(f"[{step.name}] finished in {time.time() - start:.1f} seconds")
+        return value
+
+    with ThreadPoolExecutor(max_workers=max(len(steps), 1)) as executor:
+        while True:
+            if failure is None:
+                ready = [
+                    step
+                    for step in pending
+                    if all(dependency in results for dependency in step.depends_on)
+                ]
+                for step in ready:
+                    pending.remove(step)
+                    running[executor.submit(run, step)] = step
+
+            if len(running) == 0:
+                break
+
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                try:
+                    results[step.name] = future.result()
+                except Exception as ex:
+                    output(f"[{step.name}] failed: {ex}")
+                    if failure is None:
+                        failure = ex
+
+    if failure is not None:
+        raise failure
+
+    assert len(pending) == 0, f"steps with unsatisfiable dependencies: {pending}"
+    return results
@@ -1,8 +1,10 @@
 import os
 from .config import CONTAINER_SSHD_PORT, get_tunnel_status_dir, LONG_OPERATION_TIMEOUT
-from .gcp import gcloud_in_background, _check_procs
+from .gcp import gcloud_in_background, _check_procs, _make_command, log_info
 import socket
 import signal
+import subprocess
+import threading
 
 
 def is_pid_valid(pid):
@@ -38,9 +40,96 @@ def is_port_listening(port):
     return True
 
 
-def read_pid(name: str):
+def measure_ssh_banner_latency(port: int, timeout: float = 10):
+    "Returns how many seconds it took for whatever is listening on the local port to greet us like sshd does (ie: the tunnel reaches a running sshd), or None if it didn't"
+    start = time.perf_counter()
+    try:
+        with socket.create_connection(("localhost", port), timeout=timeout) as s:
+            banner = _read_ssh_banner(s)
+    except OSError:
+        return None
+    if not banner.startswith(b"SSH-"):
+        return None
+    return time.perf_counter() - start
+
+
+def _read_ssh_banner(s: socket.socket):
+    "Returns at least the first few bytes the server sends, or fewer if it hangs up first"
+    banner = b""
+    while len(banner) < 4:
+        data = s.recv(255)
+        if data == b"":
+            break
+        banner += data
+    return banner
+
+
+def probe_ssh_banner(port: int, timeout: float = 10):
+    "Returns True if whatever is listening on the local port greets us like sshd does (ie: the tunnel reaches a running sshd)"
+    return measure_ssh_banner_latency(port, timeout) is not None
+
+
+def splice_stdio_to_local_port(
+    port: int, timeout: float = 10, stdin_fd: int = 0, stdout_fd: int = 1
+):
+    """Connect this process's stdin and stdout to sshd through the tunnel already listening on the local port
+    (ie: for use as an ssh ProxyCommand without starting another gcloud). Returns None without having
+    written anything if the tunnel doesn't greet us like sshd does, otherwise 0 once the connection closes.
+    """
+    try:
+        s = socket.create_connection(("localhost", port), timeout=timeout)
+    except OSError:
+        return None
+
+    with s:
+        try:
+            banner = _read_ssh_banner(s)
+        except OSError:
+            return None
+        if not banner.startswith(b"SSH-"):
+            return None
+        s.settimeout(None)
+        _write_fully(stdout_fd, banner)
+
+        def copy_stdin():
+            try:
+                while True:
+                    data = os.read(stdin_fd, 65536)
+                    if data == b"":
+                        break
+                    s.sendall(data)
+                s.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+        # (a daemon thread, as it may still be waiting on stdin when sshd hangs up)
+        threading.Thread(target=copy_stdin, daemon=True).start()
+        while True:
+            try:
+                data = s.recv(65536)
+            except OSError:
+                break
+            if data == b"":
+                break
+            _write_fully(stdout_fd, data)
+    return 0
+
+
+def _write_fully(fd: int, data: bytes):
+    while len(data) > 0:
+        data = data[os.write(fd, data) :]
+
+
+def _get_tunnel_file(name: str, remote_port: int, extension: str):
     tunnel_status_dir = get_tunnel_status_dir(create_if_missing=True)
-    tunnel_pid_file = os.path.join(tunnel_status_dir, f"{name}.pid")
+    if remote_port == CONTAINER_SSHD_PORT:
+        return os.path.join(tunnel_status_dir, f"{name}.{extension}")
+    # a tunnel for one of the instance's forwarded_ports
+    return os.path.join(tunnel_status_dir, f"{name}.{remote_port}.{extension}")
+
+
+def read_pid(name: str, remote_port: int = CONTAINER_SSHD_PORT):
+    tunnel_pid_file = _get_tunnel_file(name, remote_port, "pid")
 
     if os.path.exists(tunnel_pid_file):
         with open(tunnel_pid_file, "rt") as fd:
@@ -48,29 +137,49 @@ def read_pid(name: str):
     return None
 
 
-def delete_pid(name: str):
-    tunnel_status_dir = get_tunnel_status_dir(create_if_missing=True)
-    tunnel_pid_file = os.path.join(tunnel_status_dir, f"{name}.pid")
+def delete_pid(name: str, remote_port: int = CONTAINER_SSHD_PORT):
+    tunnel_pid_file = _get_tunnel_file(name, remote_port, "pid")
 
     if os.path.exists(tunnel_pid_file):
         os.unlink(tunnel_pid_file)
 
 
-def is_tunnel_running(name: str):
-    pid = read_pid(name)
-    return pid is not None and is_pid_valid(pid)
+def get_process_command(pid):
+    "returns the command line of the process with the given PID (or an empty string if there is no such process)"
+    proc = subprocess.run(
+        ["ps", "-ww", "-o", "command=", "-p", str(pid)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        stdin=subprocess.DEVNULL,
+    )
+    return proc.stdout.decode("utf8")
+
+
+def is_tunnel_process(pid):
+    "returns True if the process with the given PID is a tunnel (and not some other process which has been given the PID of a tunnel which exited)"
+    return "start-iap-tunnel" in get_process_command(pid)
 
 
-def start_tunnel(name: str, zone: str, project: str, local_port: int):
+def is_tunnel_running(name: str, remote_port: int = CONTAINER_SSHD_PORT):
+    pid = read_pid(name, remote_port)
+    return pid is not None and is_pid_valid(pid) and is_tunnel_process(pid)
+
+
+def start_tunnel(
+    name: str,
+    zone: str,
+    project: str,
+    local_port: int,
+    max_attempts: int = 10,
+    remote_port: int = CONTAINER_SSHD_PORT,
+):
     assert is_port_free(
         local_port
     ), f"Cannot start tunnel because port {local_port} is already in use. (execute 'lsof -i tcp:{local_port}' to see which process is using it')"
     print(f"Starting tunnel on local port {local_port}...")
 
-    tunnel_status_dir = get_tunnel_status_dir(create_if_missing=True)
-
-    tunnel_log = os.path.join(tunnel_status_dir, f"{name}.log")
-    tunnel_pid = os.path.join(tunnel_status_dir, f"{name}.pid")
+    tunnel_log = _get_tunnel_file(name, remote_port, "log")
+    tunnel_pid = _get_tunnel_file(name, remote_port, "pid")
 
     def attempt_start():
         proc = gcloud_in_background(
@@ -78,7 +187,7 @@ def start_tunnel(name: str, zone: str, project: str, local_port: int):
                 "compute",
                 "start-iap-tunnel",
                 name,
-                CONTAINER_SSHD_PORT,
+                remote_port,
                 f"--local-host-port=localhost:{local_port}",
                 f"--zone={zone}",
                 f"--project={project}",
@@ -93,14 +202,36 @@ def start_tunnel(name: str, zone: str, project: str, local_port: int):
         with open(tunnel_pid, "wt") as fd:
             fd.write(str(proc.pid))
 
-    retry_on_exception(attempt_start, UnexpectedTermination)
+    retry_on_exception(attempt_start, UnexpectedTermination, max_attempts=max_attempts)
     print(f"Tunnel on port {local_port} started.")
+    if remote_port != CONTAINER_SSHD_PORT:
+        print(f"Port {remote_port} on {name} is available at localhost:{local_port}")
+        return
     print("You should now be able to execute the following to connect to the instance:")
     print("")
     print(f"  ssh {name}")
     print("")
 
 
+def run_tunnel_on_stdio(name: str, zone: str, project: str):
+    """Connect this process's stdin and stdout to sshd on the instance through IAP (ie: for use as an ssh
+    ProxyCommand). gcloud reads and writes the inherited file descriptors itself, so nothing is copied
+    through this process. Returns gcloud's exit code once the connection closes."""
+    cmd = _make_command(
+        [
+            "compute",
+            "start-iap-tunnel",
+            name,
+            CONTAINER_SSHD_PORT,
+            "--listen-on-stdin",
+            f"--zone={zone}",
+            f"--project={project}",
+        ]
+    )
+    log_info(f"Running with stdio: {cmd}")
+    return subprocess.call(cmd)
+
+
 verbose = False
 
 
@@ -149,11 +280,7 @@ MAX_PROCESS_TERM_TIME = 10
 import time
 
 
-def stop_tunnel(name: str):
-    pid = read_pid(name)
-    if pid is None:
-        return
-    print(f"Stopping tunnel (by terminating pid={pid})")
+def terminate_tunnel_process(pid):
     os.kill(pid, signal.SIGTERM)
 
     start_time = time.time()
@@ -166,3 +293,14 @@ def stop_tunnel(name: str):
         assert (
             elapsed < MAX_PROCESS_TERM_TIME
         ), f"Giving up waiting for tunnel process (pid: {pid}) to terminate after {elapsed} seconds"
+
+
+def stop_tunnel(name: str, remote_port: int = CONTAINER_SSHD_PORT):
+    pid = read_pid(name, remote_port)
+    if pid is None:
+        return
+    print(f"Stopping tunnel (by terminating pid={pid})")
+    if is_pid_valid(pid) and is_tunnel_process(pid):
+        terminate_tunnel_process(pid)
+    # without a pid file, the watchdog stops looking after the tunnel
+    delete_pid(name, remote_port)
@@ -3,5 +3,10 @@ set -ex
 
 pyright
 
-pytest
+# run tests across all cores when pytest-xdist is available
+if python -c "import xdist" 2>/dev/null ; then
+  pytest -n auto
+else
+  pytest
+fi
 
@@ -1,7 +1,15 @@
+import socket
+from contextlib import contextmanager
 import pytest
 from .hermitcrab.gcloud_vcr import setup_vcr, teardown_vcr;
 from hermitcrab import config
 from hermitcrab import ssh
+from hermitcrab.config import InstanceConfig, get_instance_config, write_instance_config
+from hermitcrab.main import main
+
+# the simulator's default project and zone, which instances are created in unless a test says otherwise
+ZONE = "us-central1-a"
+PROJECT = "sim-project"
 
 def pytest_addoption(parser):
     parser.addoption(
@@ -27,3 +35,82 @@ def tmphomedir(tmpdir, monkeypatch, vcr):
         tmpdir.join("ssh").join("id_rsa.pub").write("ssh-rsa boguskey\n")
         monkeypatch.setattr(ssh, "get_ssh_dir", lambda: str(tmpdir.join("ssh")))
     
+
+@pytest.fixture(scope="function")
+def gce_sim(tmpdir, monkeypatch):
+    "A simulated GCE control plane which hermit's gcloud and REST calls are routed to. Time is virtual."
+    import time
+    from .hermitcrab import gce_sim as sim_module
+
+    sim = sim_module.SimulatedGCE(clock=sim_module.FakeClock())
+    sim.default_project = PROJECT
+    sim.default_zone = ZONE
+    tmpdir.join("bin").mkdir()
+    sim_module.install(monkeypatch, sim, fake_gcloud_dir=str(tmpdir.join("bin")))
+    monkeypatch.setattr(time, "time", sim.clock.time)
+    monkeypatch.setattr(time, "sleep", sim.clock.sleep)
+    monkeypatch.setattr("os.getlogin", lambda: "tester")
+    yield sim
+
+@pytest.fixture(scope="function")
+def sim_homedir(tmpdir, monkeypatch, gce_sim):
+    tmpdir.join("config").mkdir()
+    monkeypatch.setattr(config, "get_home_config_dir", lambda: str(tmpdir.join("config")))
+    tmpdir.join("ssh").mkdir()
+    tmpdir.join("ssh").join("id_rsa.pub").write("ssh-rsa boguskey\n")
+    monkeypatch.setattr(ssh, "get_ssh_dir", lambda: str(tmpdir.join("ssh")))
+
+def _free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("localhost", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+@pytest.fixture(scope="function")
+def free_port():
+    "Returns a function which picks an unused local port (rather than the default, so tests running in parallel don't collide)"
+    return _free_port
+
+@pytest.fixture(scope="function")
+def make_instance_config():
+    "Returns a function which makes an InstanceConfig for the simulator's default project and zone. Keyword arguments override the defaults."
+    def make(name="dev", **kwargs):
+        return InstanceConfig(
+            name=name,
+            zone=kwargs.pop("zone", ZONE),
+            project=kwargs.pop("project", PROJECT),
+            machine_type=kwargs.pop("machine_type", "n2-standard-2"),
+            docker_image=kwargs.pop("docker_image", "us-central1-docker.pkg.dev/sim-project/docker/dev-env:v1"),
+            pd_name=kwargs.pop("pd_name", f"{name}-pd"),
+            local_port=kwargs.pop("local_port", None) or _free_port(),
+            service_account=kwargs.pop("service_account", "sa@sim-project.iam.gserviceaccount.com"),
+            boot_disk_size_in_gb=kwargs.pop("boot_disk_size_in_gb", 50),
+            **kwargs,
+        )
+    return make
+
+@pytest.fixture(scope="function")
+def sim_instance(sim_homedir, gce_sim, make_instance_config):
+    "Returns a function which writes an instance's config, and adds the disk, service account and docker image it needs to the simulator"
+    def add(name="dev", **kwargs):
+        instance_config = make_instance_config(name, **kwargs)
+        gce_sim.add_disk(instance_config.pd_name, instance_config.zone, instance_config.project)
+        gce_sim.add_service_account(instance_config.service_account)
+        gce_sim.add_docker_image(instance_config.docker_image)
+        write_instance_config(instance_config)
+        return instance_config
+    return add
+
+@pytest.fixture(scope="function")
+def instance_up(sim_homedir, gce_sim):
+    """Returns a context manager which runs 'hermit up' for an instance and yields its config (which reflects
+    any move to another zone), and runs 'hermit down' on the way out even if the test failed"""
+    @contextmanager
+    def up(name="dev", up_options=(), down_options=()):
+        main(["up", name, *up_options])
+        try:
+            yield get_instance_config(name)
+        finally:
+            main(["down", name, *down_options])
+    return up
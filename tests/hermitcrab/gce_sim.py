@@ -0,0 +1,1330 @@
+# A deterministic, simulated GCE control plane for exercising hermit without network access.
+#
+# The same simulation can be reached three ways:
+#   1. In-process: `install(monkeypatch, sim)` replaces the gcloud wrappers in hermitcrab.gcp
+#   2. As a subprocess: `install_fake_gcloud(path_dir, state_file)` writes a `gcloud` executable which
+#      loads the simulation from state_file, runs the command and saves the state back.
+#   3. Via REST: `install(...)` also routes `requests.get`/`requests.post` made by hermitcrab.gcp to
+#      `SimulatedGCE.handle_request`.
+#
+# Unlike gcloud_vcr, there is no expected order of calls: every call is answered from the current
+# state of the simulation, so concurrent or reordered calls are fine.
+#
+# Time is taken from a clock object. `FakeClock` only moves forward when something sleeps, which makes
+# state transitions (ie: STAGING -> RUNNING after a configurable delay) happen instantly but in a
+# deterministic order.
+
+import base64
+import fcntl
+import hashlib
+import io
+import json
+import os
+import re
+import shlex
+import sys
+import tarfile
+import threading
+import time
+import yaml
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_DELAYS = {
+    "disk_create": 2.0,
+    "snapshot_create": 60.0,
+    "instance_create": 20.0,
+    "instance_start": 15.0,
+    "instance_resume": 5.0,
+    "instance_stop": 10.0,
+    "instance_suspend": 10.0,
+    "instance_delete": 10.0,
+    # time from RUNNING until sshd in the container is listening
+    "boot": 30.0,
+    # time before IAM grants take effect
+    "iam_propagation": 30.0,
+    "api_enable": 5.0,
+}
+
+DEFAULT_ACCOUNT = "tester@example.com"
+
+# the files an image needs to work with hermit
+DEFAULT_IMAGE_FILES = {
+    "etc/passwd": "root:x:0:0:root:/root:/bin/bash\nubuntu:x:2000:2000::/home/ubuntu:/bin/bash\n",
+    "usr/sbin/sshd": "",
+}
+
+# keep a reference to the real implementation, since tests replace time.sleep with FakeClock.sleep
+_real_sleep = time.sleep
+
+
+class RealClock:
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        _real_sleep(seconds)
+
+
+class FakeClock:
+    """Virtual time which advances by however long callers sleep for. Each sleep also yields for a
+    moment of real time so that loops waiting on real processes (ie: the tunnel) can make progress.
+    """
+
+    def __init__(self, now=1_000_000.0, real_sleep=0.005):
+        self.now = now
+        self.real_sleep = real_sleep
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.now += seconds
+        _real_sleep(min(seconds, self.real_sleep))
+
+
+class CommandFailed(Exception):
+    def __init__(self, message, returncode=1):
+        super().__init__(message)
+        self.message = message
+        self.returncode = returncode
+
+
+# flags which hermit passes with the value as the next argument (ie: "--project", "x")
+_SEPARATE_VALUE_FLAGS = {
+    "--project",
+    "--zone",
+    "--command",
+    "--member",
+    "--role",
+    "--display-name",
+}
+
+
+def parse_args(args: List[str]) -> Tuple[List[str], Dict[str, List[str]]]:
+    "Split gcloud arguments into positional words and a dict of flag -> values"
+    positional = []
+    flags = {}
+    i = 0
+    while i < len(args):
+        arg = str(args[i])
+        if arg.startswith("--"):
+            if "=" in arg:
+                name, value = arg.split("=", 1)
+            elif arg in _SEPARATE_VALUE_FLAGS and i + 1 < len(args):
+                name, value = arg, str(args[i + 1])
+                i += 1
+            else:
+                name, value = arg, ""
+            flags.setdefault(name, []).append(value)
+        else:
+            positional.append(arg)
+        i += 1
+    return positional, flags
+
+
+def _flag(flags, name, default=None):
+    values = flags.get(name)
+    if values is None:
+        return default
+    return values[-1]
+
+
+def _parse_filter_name(flags):
+    value = _flag(flags, "--filter", "")
+    m = re.match("^name=(.+)$", value)
+    if m:
+        return m.group(1)
+    return None
+
+
+def _basename(url):
+    return url.split("/")[-1]
+
+
+def _parse_firewall_rules(rules):
+    "Parses --rules (ie: tcp:22,tcp:80) the way GCE reports them, with the ports of each protocol grouped"
+    allowed = []
+    for rule in rules.split(","):
+        protocol, port = rule.split(":")
+        for entry in allowed:
+            if entry["IPProtocol"] == protocol:
+                entry["ports"].append(port)
+                break
+        else:
+            allowed.append({"IPProtocol": protocol, "ports": [port]})
+    return allowed
+
+
+def _make_layer(files):
+    "Returns a gzipped tarball of files (path -> contents). A contents of None writes a whiteout for the path"
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for path, contents in files.items():
+            if contents is None:
+                dirname, basename = os.path.split(path)
+                path = os.path.join(dirname, ".wh." + basename)
+                contents = ""
+            data = contents.encode("utf8")
+            info = tarfile.TarInfo("./" + path)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def _digest(data: bytes):
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+BOOT_LOG = [
+    # (fraction of the boot delay, line)
+    (0.0, "Starting cloudinit bootcmd..."),
+    (0.0, "Boot stage bootcmd-start reached at 6.20 seconds"),
+    (0.1, "Starting check filesystem /dev/disk/by-id/google-{pd_name}"),
+    (0.2, "/dev/sdb: clean, 11/3276800 files, 254349/13107200 blocks"),
+    (0.3, "Finished checking filesystem /dev/disk/by-id/google-{pd_name}"),
+    (0.35, "Mounting /dev/disk/by-id/google-{pd_name} as /mnt/disks/{pd_name}"),
+    (0.4, "Boot stage home-mounted reached at 8.05 seconds"),
+    (0.4, "Finished hermit VM setup"),
+    (0.45, "Boot stage setup-start reached at 11.30 seconds"),
+    (0.5, "Boot stage docker-ready reached at 12.10 seconds"),
+    (0.5, "Boot stage services-started reached at 12.40 seconds"),
+    (0.5, "v1: Pulling from {image_path}"),
+    (0.9, "Status: Downloaded newer image for {docker_image}"),
+    (0.9, "Pulled {docker_image} in 12 seconds"),
+    (1.0, "Server listening on 0.0.0.0 port 3022."),
+]
+
+FORMAT_LOG = [
+    (0.05, "Creating filesystem on blank disk /dev/disk/by-id/google-{pd_name}"),
+    (
+        0.1,
+        "Finished creating filesystem on /dev/disk/by-id/google-{pd_name} in 3 seconds",
+    ),
+]
+
+UNFORMATTED_DISK_LOG = [
+    (0.0, "Starting cloudinit bootcmd..."),
+    (0.1, "Starting check filesystem /dev/disk/by-id/google-{pd_name}"),
+    (
+        0.2,
+        "The superblock could not be read or does not describe a valid ext2/ext3/ext4",
+    ),
+]
+
+
+class SimulatedGCE:
+    def __init__(self, clock=None, delays=None, account=DEFAULT_ACCOUNT):
+        self.clock = clock if clock is not None else FakeClock()
+        self.delays = dict(DEFAULT_DELAYS)
+        if delays:
+            self.delays.update(delays)
+        self.account = account
+        self.lock = threading.RLock()
+
+        self.default_project: Optional[str] = None
+        self.default_zone: Optional[str] = None
+        # keyed by "project/zone/name"
+        self.instances = {}
+        self.disks = {}
+        # keyed by "project/name"
+        self.firewall_rules = {}
+        self.service_accounts = {}
+        self.snapshots = {}
+        self.resource_policies = {}
+        self.machine_types = [
+            "e2-standard-2",
+            "n1-standard-1",
+            "n2-standard-2",
+            "n2-standard-8",
+            "n2-highmem-16",
+        ]
+        self.enabled_apis = {}
+        self.networks = {}
+        # list of {"resource": ..., "member": ..., "role": ..., "effective_at": ...}
+        self.iam_bindings = []
+        self.operations = []
+        # zones where instances can't currently be created or started
+        self.exhausted_zones = []
+        # docker image name -> manifest body
+        self.docker_images = {}
+        # digest -> base64 encoded content of the layers of the docker images
+        self.blobs = {}
+        # Artifact Registry repositories, keyed by "project/location/name"
+        self.repositories = {}
+        # every command received, as a list of args
+        self.calls = []
+
+    # --- persistence, used when running as a subprocess ---
+
+    _PERSISTED = [
+        "default_project",
+        "default_zone",
+        "instances",
+        "disks",
+        "firewall_rules",
+        "service_accounts",
+        "snapshots",
+        "resource_policies",
+        "machine_types",
+        "enabled_apis",
+        "networks",
+        "iam_bindings",
+        "operations",
+        "exhausted_zones",
+        "docker_images",
+        "blobs",
+        "repositories",
+        "calls",
+        "delays",
+        "account",
+    ]
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self._PERSISTED}
+
+    @classmethod
+    def from_dict(cls, value, clock=None):
+        sim = cls(clock=clock)
+        for name in cls._PERSISTED:
+            if name in value:
+                setattr(sim, name, value[name])
+        return sim
+
+    # --- helpers for setting up scenarios ---
+
+    def add_instance(self, name, zone, project, status="RUNNING", **properties):
+        instance = self._new_instance(name, zone, project, properties)
+        instance["transitions"] = [[self.clock.time(), status]]
+        if status in ["RUNNING", "SUSPENDED"]:
+            # treat it as having already booted
+            instance["booted_at"] = self.clock.time() - self.delays["boot"]
+        self.instances[self._key(project, zone, name)] = instance
+        return instance
+
+    def add_disk(self, name, zone, project, size_gb=200, formatted=True):
+        self.disks[self._key(project, zone, name)] = {
+            "name": name,
+            "zone": zone,
+            "project": project,
+            "sizeGb": str(size_gb),
+            "type": "pd-standard",
+            "formatted": formatted,
+            "users": [],
+            "resourcePolicies": [],
+        }
+
+    def add_service_account(self, email):
+        "Add a service account which the current account can already impersonate"
+        self.service_accounts[email] = {"email": email, "project": email.split("@")[1]}
+        self.iam_bindings.append(
+            {
+                "resource": email,
+                "member": f"user:{self.account}",
+                "role": "roles/iam.serviceAccountTokenCreator",
+                "effective_at": self.clock.time(),
+            }
+        )
+
+    def add_docker_image(self, docker_image, manifest=None, layers=None):
+        """layers is a list (bottom layer first) of dicts of path -> contents, where None means the layer
+        deletes the path. By default, the image has what hermit needs."""
+        if manifest is None:
+            if layers is None:
+                layers = [DEFAULT_IMAGE_FILES]
+            layer_descriptors = []
+            for files in layers:
+                blob = _make_layer(files)
+                self.blobs[_digest(blob)] = base64.b64encode(blob).decode("utf8")
+                layer_descriptors.append(
+                    {
+                        "mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip",
+                        "digest": _digest(blob),
+                        "size": len(blob),
+                    }
+                )
+            config = json.dumps(
+                {"rootfs": {"diff_ids": [x["digest"] for x in layer_descriptors]}}
+            ).encode("utf8")
+            manifest = {
+                "schemaVersion": 2,
+                "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+                "config": {"digest": _digest(config)},
+                "layers": layer_descriptors,
+            }
+        self.docker_images[docker_image] = manifest
+
+    def preempt(self, name, zone, project):
+        "Simulate the VM being preempted"
+        with self.lock:
+            instance = self._get_instance(project, zone, name)
+            self._transition(instance, "TERMINATED")
+            self._record_operation("compute.instances.preempted", project, zone, name)
+
+    def instance_status(self, name, zone, project):
+        instance = self.instances.get(self._key(project, zone, name))
+        if instance is None:
+            return None
+        return self._status(instance)
+
+    # --- internals ---
+
+    def _key(self, *parts):
+        return "/".join(parts)
+
+    def _new_instance(self, name, zone, project, properties):
+        instance = {
+            "name": name,
+            "zone": f"https://www.googleapis.com/compute/v1/projects/{project}/zones/{zone}",
+            "project": project,
+            "machineType": f"https://www.googleapis.com/compute/v1/projects/{project}/zones/{zone}/machineTypes/{properties.get('machine_type', 'n2-standard-2')}",
+            "user_data": properties.get("user_data", ""),
+            "disks": properties.get("disks", []),
+            "scheduling": properties.get("scheduling", {}),
+            "metadata": properties.get("metadata", {}),
+            "networkInterfaces": [{"networkIP": f"10.128.0.{len(self.instances) + 2}"}],
+            "booted_at": None,
+            "shutdown_on_boot": False,
+        }
+        return instance
+
+    def _get_instance(self, project, zone, name):
+        instance = self.instances.get(self._key(project, zone, name))
+        if instance is None:
+            raise CommandFailed(
+                f"ERROR: (gcloud.compute.instances) Could not fetch resource:\n - The resource 'projects/{project}/zones/{zone}/instances/{name}' was not found"
+            )
+        return instance
+
+    def _status(self, instance):
+        now = self.clock.time()
+        status = None
+        for at, s in instance["transitions"]:
+            if at <= now:
+                status = s
+        return status
+
+    def _transition(self, instance, status, delay=0.0):
+        instance["transitions"].append([self.clock.time() + delay, status])
+
+    def _record_operation(self, operation_type, project, zone, target):
+        self.operations.append(
+            {
+                "operationType": operation_type,
+                "targetLink": f"https://www.googleapis.com/compute/v1/projects/{project}/zones/{zone}/instances/{target}",
+                "insertTime": time.strftime(
+                    "%Y-%m-%dT%H:%M:%S.000-00:00", time.gmtime(self.clock.time())
+                ),
+                "status": "DONE",
+                "zone": zone,
+            }
+        )
+
+    def _check_capacity(self, command, project, zone):
+        if zone in self.exhausted_zones:
+            raise CommandFailed(
+                f"ERROR: (gcloud.compute.instances.{command}) Could not fetch resource:\n - The zone 'projects/{project}/zones/{zone}' does not have enough resources available to fulfill the request.  Try a different zone, or try again later."
+            )
+
+    def _wait(self, delay_name):
+        "Long running operations block until they are done, like gcloud does"
+        delay = self.delays[delay_name]
+        # release the lock while waiting so other callers can proceed concurrently
+        self.lock.release()
+        try:
+            self.clock.sleep(delay)
+        finally:
+            self.lock.acquire()
+
+    def _boot(self, instance):
+        "Record that the instance has started booting (with the boot log revealed over time)"
+        instance["booted_at"] = self.clock.time()
+        instance["formatted_on_boot"] = False
+        for disk in instance["disks"]:
+            if disk.get("format_on_boot") and not self.disks[disk["key"]]["formatted"]:
+                self.disks[disk["key"]]["formatted"] = True
+                instance["formatted_on_boot"] = True
+        if instance["shutdown_on_boot"]:
+            self._transition(instance, "STOPPING", self.delays["boot"])
+            self._transition(
+                instance,
+                "TERMINATED",
+                self.delays["boot"] + self.delays["instance_stop"],
+            )
+
+    def _boot_log(self, instance):
+        if instance["booted_at"] is None:
+            return ""
+        elapsed = self.clock.time() - instance["booted_at"]
+        disk = (
+            self.disks.get(instance["disks"][0]["key"], {}) if instance["disks"] else {}
+        )
+        pd_name = disk.get("name", "")
+        docker_image = instance["metadata"].get("docker_image", "")
+        if not disk.get("formatted", True):
+            template = UNFORMATTED_DISK_LOG
+        elif instance.get("formatted_on_boot"):
+            template = BOOT_LOG[:1] + FORMAT_LOG + BOOT_LOG[1:]
+        else:
+            template = BOOT_LOG
+        lines = []
+        for fraction, line in template:
+            if elapsed >= fraction * self.delays["boot"]:
+                lines.append(
+                    line.format(
+                        pd_name=pd_name,
+                        docker_image=docker_image,
+                        image_path=docker_image.split(":")[0],
+                    )
+                )
+        lines.extend(instance.get("log_lines", []))
+        return "".join([line + "\n" for line in lines])
+
+    # --- the gcloud command line interface ---
+
+    def run_gcloud(self, args: List[str]) -> Tuple[int, str, str]:
+        "Returns (returncode, stdout, stderr) just like running gcloud would"
+        args = [str(x) for x in args]
+        with self.lock:
+            self.calls.append(args)
+            positional, flags = parse_args(args)
+            try:
+                stdout = self._dispatch(positional, flags)
+            except CommandFailed as ex:
+                return ex.returncode, "", ex.message
+            if stdout is None:
+                stdout = ""
+            elif not isinstance(stdout, str):
+                stdout = json.dumps(stdout)
+            return 0, stdout, ""
+
+    def _dispatch(self, positional, flags):
+        command = tuple(positional[:3])
+        project = _flag(flags, "--project", self.default_project)
+        zone = _flag(flags, "--zone", _flag(flags, "--zones", self.default_zone))
+
+        if tuple(positional[:2]) == ("config", "list"):
+            return {
+                "core": {"account": self.account, "project": self.default_project},
+                "compute": {"zone": self.default_zone},
+            }
+        if tuple(positional[:2]) == ("auth", "print-access-token"):
+            return {"token": "user-access-token"}
+        if tuple(positional[:2]) == ("services", "enable"):
+            self.enabled_apis.setdefault(project, []).append(positional[2])
+            self._wait("api_enable")
+            return None
+        if command == ("compute", "networks", "create"):
+            if positional[3] in self.networks.get(project, []):
+                raise CommandFailed(f"The resource '{positional[3]}' already exists")
+            self.networks.setdefault(project, []).append(positional[3])
+            return None
+        if command == ("iam", "service-accounts", "create"):
+            email = f"{positional[3]}@{project}.iam.gserviceaccount.com"
+            self.service_accounts[email] = {"email": email, "project": project}
+            return None
+        if command == ("iam", "service-accounts", "add-iam-policy-binding"):
+            return self._add_binding(positional[3], flags)
+        if tuple(positional[:2]) == ("projects", "add-iam-policy-binding"):
+            return self._add_binding(positional[2], flags)
+
+        handlers = {
+            ("compute", "instances", "list"): self._instances_list,
+            ("compute", "instances", "describe"): self._instances_describe,
+            ("compute", "instances", "create"): self._instances_create,
+            ("compute", "instances", "start"): self._instances_start,
+            ("compute", "instances", "resume"): self._instances_resume,
+            (
+                "compute",
+                "instances",
+                "set-machine-type",
+            ): self._instances_set_machine_type,
+            ("compute", "machine-types", "list"): self._machine_types_list,
+            ("compute", "instances", "stop"): self._instances_stop,
+            ("compute", "instances", "suspend"): self._instances_suspend,
+            ("compute", "instances", "delete"): self._instances_delete,
+            (
+                "compute",
+                "instances",
+                "get-guest-attributes",
+            ): self._instances_get_guest_attributes,
+            ("compute", "instances", "add-metadata"): self._instances_add_metadata,
+            (
+                "compute",
+                "instances",
+                "get-serial-port-output",
+            ): self._instances_serial_output,
+            ("compute", "disks", "list"): self._disks_list,
+            ("compute", "disks", "create"): self._disks_create,
+            ("compute", "disks", "delete"): self._disks_delete,
+            (
+                "compute",
+                "disks",
+                "add-resource-policies",
+            ): self._disks_add_resource_policies,
+            ("compute", "disks", "resize"): self._disks_resize,
+            ("compute", "snapshots", "create"): self._snapshots_create,
+            ("compute", "snapshots", "delete"): self._snapshots_delete,
+            ("compute", "resource-policies", "create"): self._resource_policies_create,
+            ("compute", "firewall-rules", "list"): self._firewall_list,
+            ("compute", "firewall-rules", "create"): self._firewall_create,
+            ("compute", "firewall-rules", "update"): self._firewall_update,
+            ("compute", "operations", "list"): self._operations_list,
+            ("artifacts", "repositories", "list"): self._repositories_list,
+            ("artifacts", "repositories", "create"): self._repositories_create,
+        }
+        if command in handlers:
+            return handlers[command](positional, flags, project, zone)
+        if tuple(positional[:2]) == ("compute", "ssh"):
+            return self._ssh(positional, flags, project, zone)
+
+        raise CommandFailed(f"gce_sim does not know how to handle: {positional}")
+
+    def _add_binding(self, resource, flags):
+        self.iam_bindings.append(
+            {
+                "resource": resource,
+                "member": _flag(flags, "--member"),
+                "role": _flag(flags, "--role"),
+                "effective_at": self.clock.time() + self.delays["iam_propagation"],
+            }
+        )
+        return None
+
+    def _has_binding(self, resource, member, role):
+        now = self.clock.time()
+        for binding in self.iam_bindings:
+            if (
+                binding["resource"] == resource
+                and binding["member"] == member
+                and binding["role"] == role
+                and binding["effective_at"] <= now
+            ):
+                return True
+        return False
+
+    def _public_instance(self, instance):
+        value = {
+            k: v
+            for k, v in instance.items()
+            if k
+            not in [
+                "transitions",
+                "booted_at",
+                "user_data",
+                "shutdown_on_boot",
+                "metadata",
+            ]
+        }
+        value["status"] = self._status(instance)
+        value["disks"] = [
+            {"deviceName": d["name"], "source": d["name"]} for d in instance["disks"]
+        ]
+        return value
+
+    def _instances_list(self, positional, flags, project, zone):
+        name = _parse_filter_name(flags)
+        result = []
+        for instance in self.instances.values():
+            if instance["project"] != project or _basename(instance["zone"]) != zone:
+                continue
+            if name is not None and instance["name"] != name:
+                continue
+            result.append(self._public_instance(instance))
+        return result
+
+    def _instances_describe(self, positional, flags, project, zone):
+        return self._public_instance(self._get_instance(project, zone, positional[3]))
+
+    def _instances_create(self, positional, flags, project, zone):
+        name = positional[3]
+        key = self._key(project, zone, name)
+        if key in self.instances:
+            raise CommandFailed(
+                f"ERROR: (gcloud.compute.instances.create) Could not fetch resource:\n - The resource 'projects/{project}/zones/{zone}/instances/{name}' already exists"
+            )
+
+        self._check_capacity("create", project, zone)
+
+        user_data = ""
+        metadata_from_file = _flag(flags, "--metadata-from-file", "")
+        if metadata_from_file.startswith("user-data="):
+            with open(metadata_from_file[len("user-data=") :], "rt") as fd:
+                user_data = fd.read()
+
+        cloud_config = {}
+        if user_data != "":
+            cloud_config = yaml.safe_load(user_data)
+        bootcmd = [str(x) for x in cloud_config.get("bootcmd", [])]
+
+        disks = []
+        for disk_spec in flags.get("--disk", []):
+            disk_props = dict([x.split("=", 1) for x in disk_spec.split(",")])
+            disk_key = self._key(project, zone, disk_props["name"])
+            if disk_key not in self.disks:
+                raise CommandFailed(
+                    f"The resource 'projects/{project}/zones/{zone}/disks/{disk_props['name']}' was not found"
+                )
+            disk = self.disks[disk_key]
+            if len(disk["users"]) > 0:
+                raise CommandFailed(
+                    f"The disk resource '{disk_props['name']}' is already being used by '{disk['users'][0]}'"
+                )
+            disks.append(
+                {
+                    "name": disk_props["name"],
+                    "key": disk_key,
+                    "format_on_boot": any(
+                        re.search(
+                            f"mkfs.*(/dev/sdb|google-{re.escape(disk_props['name'])})",
+                            command,
+                        )
+                        for command in bootcmd
+                    ),
+                }
+            )
+
+        metadata = {}
+        for item in flags.get("--metadata", []):
+            metadata.update(dict([x.split("=", 1) for x in item.split(",")]))
+
+        docker_image = ""
+        for written_file in cloud_config.get("write_files", []):
+            m = re.search(
+                "docker run .* (\\S+) /usr/sbin/sshd", written_file.get("content", "")
+            )
+            if m:
+                docker_image = m.group(1)
+
+        instance = self._new_instance(
+            name,
+            zone,
+            project,
+            {
+                "machine_type": _flag(flags, "--machine-type", "n1-standard-1"),
+                "user_data": user_data,
+                "disks": disks,
+                "metadata": {"docker_image": docker_image, **metadata},
+                "scheduling": {
+                    "provisioningModel": _flag(
+                        flags, "--provisioning-model", "STANDARD"
+                    ),
+                    "instanceTerminationAction": _flag(
+                        flags, "--instance-termination-action"
+                    ),
+                },
+            },
+        )
+        instance["shutdown_on_boot"] = "shutdown -h now" in bootcmd
+        instance["transitions"] = [[self.clock.time(), "PROVISIONING"]]
+        self.instances[key] = instance
+        for disk in disks:
+            self.disks[disk["key"]]["users"].append(name)
+
+        self._record_operation("compute.instances.insert", project, zone, name)
+        self._wait("instance_create")
+        self._transition(instance, "RUNNING")
+        self._boot(instance)
+        return None
+
+    def _instances_start(self, positional, flags, project, zone):
+        instance = self._get_instance(project, zone, positional[3])
+        status = self._status(instance)
+        if status != "TERMINATED":
+            raise CommandFailed(
+                f"The instance '{positional[3]}' is not in TERMINATED state (status: {status})"
+            )
+        self._check_capacity("start", project, zone)
+        self._record_operation("compute.instances.start", project, zone, positional[3])
+        self._transition(instance, "STAGING")
+        self._wait("instance_start")
+        self._transition(instance, "RUNNING")
+        self._boot(instance)
+        return None
+
+    def _instances_set_machine_type(self, positional, flags, project, zone):
+        instance = self._get_instance(project, zone, positional[3])
+        status = self._status(instance)
+        if status != "TERMINATED":
+            raise CommandFailed(
+                f"The resource 'projects/{project}/zones/{zone}/instances/{positional[3]}' is not ready (status: {status}). The instance must be stopped to change its machine type"
+            )
+        machine_type = _flag(flags, "--machine-type")
+        if machine_type not in self.machine_types:
+            raise CommandFailed(
+                f"Invalid value for field 'machineType': '{machine_type}'"
+            )
+        instance["machineType"] = (
+            f"https://www.googleapis.com/compute/v1/projects/{project}/zones/{zone}/machineTypes/{machine_type}"
+        )
+        return None
+
+    def _machine_types_list(self, positional, flags, project, zone):
+        return [{"name": name, "zone": zone} for name in self.machine_types]
+
+    def _instances_resume(self, positional, flags, project, zone):
+        instance = self._get_instance(project, zone, positional[3])
+        status = self._status(instance)
+        if status != "SUSPENDED":
+            raise CommandFailed(
+                f"The instance '{positional[3]}' is not in SUSPENDED state (status: {status})"
+            )
+        self._record_operation("compute.instances.resume", project, zone, positional[3])
+        self._wait("instance_resume")
+        # resuming doesn't re-run boot, so the boot log stays as it was
+        self._transition(instance, "RUNNING")
+        return None
+
+    def _instances_stop(self, positional, flags, project, zone):
+        instance = self._get_instance(project, zone, positional[3])
+        self._record_operation("compute.instances.stop", project, zone, positional[3])
+        self._transition(instance, "STOPPING")
+        self._wait("instance_stop")
+        self._transition(instance, "TERMINATED")
+        return None
+
+    def _instances_suspend(self, positional, flags, project, zone):
+        instance = self._get_instance(project, zone, positional[3])
+        self._record_operation(
+            "compute.instances.suspend", project, zone, positional[3]
+        )
+        self._transition(instance, "SUSPENDING")
+        self._wait("instance_suspend")
+        self._transition(instance, "SUSPENDED")
+        return None
+
+    def _instances_delete(self, positional, flags, project, zone):
+        key = self._key(project, zone, positional[3])
+        instance = self._get_instance(project, zone, positional[3])
+        self._record_operation("compute.instances.delete", project, zone, positional[3])
+        self._transition(instance, "STOPPING")
+        self._wait("instance_delete")
+        for disk in instance["disks"]:
+            users = self.disks[disk["key"]]["users"]
+            if positional[3] in users:
+                users.remove(positional[3])
+        del self.instances[key]
+        return None
+
+    def _instances_serial_output(self, positional, flags, project, zone):
+        return self._boot_log(self._get_instance(project, zone, positional[3]))
+
+    def _disks_list(self, positional, flags, project, zone):
+        name = _parse_filter_name(flags)
+        return [
+            {k: v for k, v in disk.items() if k not in ["formatted"]}
+            for disk in self.disks.values()
+            if disk["project"] == project
+            and disk["zone"] == zone
+            and (name is None or disk["name"] == name)
+        ]
+
+    def _disks_create(self, positional, flags, project, zone):
+        name = positional[3]
+        key = self._key(project, zone, name)
+        if key in self.disks:
+            raise CommandFailed(f"The resource '{name}' already exists")
+        # a disk created from a snapshot or another disk gets a copy of its filesystem
+        source = None
+        source_snapshot = _flag(flags, "--source-snapshot")
+        if source_snapshot is not None:
+            source = self.snapshots.get(self._key(project, source_snapshot))
+            if source is None:
+                raise CommandFailed(
+                    f"The resource 'projects/{project}/global/snapshots/{source_snapshot}' was not found"
+                )
+        source_disk = _flag(flags, "--source-disk")
+        if source_disk is not None:
+            m = re.match("^projects/([^/]+)/zones/([^/]+)/disks/([^/]+)$", source_disk)
+            source_key = (
+                self._key(*m.groups()) if m else self._key(project, zone, source_disk)
+            )
+            source = self.disks.get(source_key)
+            if source is None:
+                raise CommandFailed(f"The resource '{source_disk}' was not found")
+
+        size = _flag(flags, "--size")
+        if size is None:
+            size = source["sizeGb"] if source is not None else "500"
+        self.disks[key] = {
+            "name": name,
+            "zone": zone,
+            "project": project,
+            "sizeGb": str(size),
+            "type": _flag(flags, "--type", "pd-standard"),
+            "formatted": source["formatted"] if source is not None else False,
+            "users": [],
+            "resourcePolicies": [],
+        }
+        self._wait("disk_create")
+        return None
+
+    def _disks_resize(self, positional, flags, project, zone):
+        key = self._key(project, zone, positional[3])
+        if key not in self.disks:
+            raise CommandFailed(f"The resource '{positional[3]}' was not found")
+        size = _flag(flags, "--size")
+        if size is None:
+            raise CommandFailed(
+                "ERROR: (gcloud.compute.disks.resize) argument --size: Must be specified."
+            )
+        size = int(size)
+        if size < int(self.disks[key]["sizeGb"]):
+            raise CommandFailed(
+                f"Invalid value for field 'sizeGb': '{size}'. New disk size must be larger than the existing size"
+            )
+        self.disks[key]["sizeGb"] = str(size)
+        return None
+
+    def _disks_add_resource_policies(self, positional, flags, project, zone):
+        key = self._key(project, zone, positional[3])
+        if key not in self.disks:
+            raise CommandFailed(f"The resource '{positional[3]}' was not found")
+        policy = _flag(flags, "--resource-policies")
+        if self._key(project, policy) not in self.resource_policies:
+            raise CommandFailed(f"The resource policy '{policy}' was not found")
+        self.disks[key].setdefault("resourcePolicies", []).append(policy)
+        return None
+
+    def _snapshots_create(self, positional, flags, project, zone):
+        name = positional[3]
+        if self._key(project, name) in self.snapshots:
+            raise CommandFailed(f"The resource '{name}' already exists")
+        source_zone = _flag(flags, "--source-disk-zone", zone)
+        source_disk = _flag(flags, "--source-disk")
+        disk = self.disks.get(self._key(project, source_zone, source_disk))
+        if disk is None:
+            raise CommandFailed(f"The resource '{source_disk}' was not found")
+        self.snapshots[self._key(project, name)] = {
+            "name": name,
+            "sourceDisk": source_disk,
+            "diskSizeGb": disk["sizeGb"],
+            "sizeGb": disk["sizeGb"],
+            "formatted": disk["formatted"],
+        }
+        self._wait("snapshot_create")
+        return None
+
+    def _snapshots_delete(self, positional, flags, project, zone):
+        key = self._key(project, positional[3])
+        if key not in self.snapshots:
+            raise CommandFailed(f"The resource '{positional[3]}' was not found")
+        del self.snapshots[key]
+        return None
+
+    def _resource_policies_create(self, positional, flags, project, zone):
+        # ie: compute resource-policies create snapshot-schedule NAME ...
+        name = positional[4]
+        self.resource_policies[self._key(project, name)] = {
+            "name": name,
+            "kind": positional[3],
+            "region": _flag(flags, "--region"),
+            "flags": {k: v[-1] for k, v in flags.items()},
+        }
+        return None
+
+    def _disks_delete(self, positional, flags, project, zone):
+        key = self._key(project, zone, positional[3])
+        if key not in self.disks:
+            raise CommandFailed(f"The resource '{positional[3]}' was not found")
+        if len(self.disks[key]["users"]) > 0:
+            raise CommandFailed(
+                f"The disk resource '{positional[3]}' is already being used by '{self.disks[key]['users'][0]}'"
+            )
+        del self.disks[key]
+        return None
+
+    def _firewall_list(self, positional, flags, project, zone):
+        name = _parse_filter_name(flags)
+        return [
+            rule
+            for key, rule in self.firewall_rules.items()
+            if key.startswith(project + "/") and (name is None or rule["name"] == name)
+        ]
+
+    def _firewall_create(self, positional, flags, project, zone):
+        name = positional[3]
+        self.firewall_rules[self._key(project, name)] = {
+            "name": name,
+            "allowed": _parse_firewall_rules(_flag(flags, "--rules", "")),
+            "direction": _flag(flags, "--direction", "INGRESS"),
+            "disabled": False,
+            "sourceRanges": _flag(flags, "--source-ranges", "").split(","),
+        }
+        return None
+
+    def _firewall_update(self, positional, flags, project, zone):
+        rule = self.firewall_rules.get(self._key(project, positional[3]))
+        if rule is None:
+            raise CommandFailed(
+                f"ERROR: (gcloud.compute.firewall-rules.update) Could not fetch resource:\n - The resource 'projects/{project}/global/firewalls/{positional[3]}' was not found"
+            )
+        source_ranges = _flag(flags, "--source-ranges")
+        if source_ranges is not None:
+            rule["sourceRanges"] = source_ranges.split(",")
+        rules = _flag(flags, "--rules")
+        if rules is not None:
+            rule["allowed"] = _parse_firewall_rules(rules)
+        return None
+
+    def _operations_list(self, positional, flags, project, zone):
+        return [
+            op
+            for op in self.operations
+            if op["targetLink"].startswith(
+                f"https://www.googleapis.com/compute/v1/projects/{project}/"
+            )
+        ]
+
+    def _repositories_list(self, positional, flags, project, zone):
+        location = _flag(flags, "--location")
+        name = _parse_filter_name(flags)
+        return [
+            repository
+            for key, repository in self.repositories.items()
+            if key.startswith(f"{project}/{location}/")
+            and (name is None or repository["name"] == name)
+        ]
+
+    def _repositories_create(self, positional, flags, project, zone):
+        location = _flag(flags, "--location")
+        name = positional[3]
+        key = self._key(project, location, name)
+        if key in self.repositories:
+            raise CommandFailed(
+                f"ALREADY_EXISTS: the repository already exists: projects/{project}/locations/{location}/repositories/{name}"
+            )
+        repository = {
+            "name": f"projects/{project}/locations/{location}/repositories/{name}",
+            "format": _flag(flags, "--repository-format", "").upper(),
+            "mode": "STANDARD_REPOSITORY",
+        }
+        if _flag(flags, "--mode") == "remote-repository":
+            upstream = _flag(flags, "--remote-docker-repo")
+            repository["mode"] = "REMOTE_REPOSITORY"
+            if upstream == "DOCKER-HUB":
+                docker_repository = {"publicRepository": "DOCKER_HUB"}
+            else:
+                docker_repository = {"customRepository": {"uri": upstream}}
+            repository["remoteRepositoryConfig"] = {
+                "dockerRepository": docker_repository
+            }
+        self.repositories[key] = repository
+        return None
+
+    def _resolve_docker_image(self, host, path, tag):
+        "Returns the manifest of the image, following remote repositories to their upstream"
+        m = re.match("^([a-z0-9-]+)-docker\\.pkg\\.dev$", host)
+        parts = path.split("/", 2)
+        if m and len(parts) == 3:
+            repository = self.repositories.get(
+                self._key(parts[0], m.group(1), parts[1])
+            )
+            if repository is not None and repository["mode"] == "REMOTE_REPOSITORY":
+                upstream = repository["remoteRepositoryConfig"]["dockerRepository"]
+                if "customRepository" in upstream:
+                    upstream_name = upstream["customRepository"]["uri"][
+                        len("https://") :
+                    ]
+                else:
+                    upstream_name = "docker.io"
+                return self.docker_images.get(f"{upstream_name}/{parts[2]}:{tag}")
+        return self.docker_images.get(f"{host}/{path}:{tag}")
+
+    def _ssh(self, positional, flags, project, zone):
+        instance = self.instances.get(self._key(project, zone, positional[2]))
+        if instance is None or self._status(instance) != "RUNNING":
+            raise CommandFailed(
+                "ssh: connect to host compute.internal port 22: Connection refused",
+                returncode=255,
+            )
+        command = _flag(flags, "--command", "")
+        if command == "cat /var/log/hermit.log":
+            return self._boot_log(instance)
+        if command == "sudo shutdown now":
+            self._transition(instance, "STOPPING")
+            self._transition(instance, "TERMINATED", self.delays["instance_stop"])
+            return None
+        m = re.search('Refresh (\\S+) started: (\\S+) -> ([^\\s"]+)', command)
+        if m:
+            self._refresh_image(instance, *m.groups())
+            return None
+        # anything else is accepted and recorded in self.calls
+        return None
+
+    def _refresh_image(self, instance, refresh_id, current_image, new_image):
+        "'hermit refresh-image' swapping the container over to another image"
+        instance["metadata"]["docker_image"] = new_image
+        instance.setdefault("log_lines", []).extend(
+            [
+                f"Refresh {refresh_id} started: {current_image} -> {new_image}",
+                f"Refresh {refresh_id} pulled {new_image} in 9 seconds",
+                f"Refresh {refresh_id} finished (exit code 0)",
+            ]
+        )
+
+    def _has_agent(self, instance):
+        return (
+            instance["metadata"].get("enable-guest-attributes") == "TRUE"
+            and "hermit_agent.py" in instance["user_data"]
+        )
+
+    def _instances_get_guest_attributes(self, positional, flags, project, zone):
+        instance = self._get_instance(project, zone, positional[3])
+        if not self._has_agent(instance):
+            raise CommandFailed(
+                "ERROR: (gcloud.compute.instances.get-guest-attributes) Guest attributes endpoint access is disabled."
+            )
+        log = self._boot_log(instance)
+        # the agent is started by hermit-setup.sh
+        if self._status(instance) != "RUNNING" or "Boot stage setup-start" not in log:
+            raise CommandFailed(
+                "ERROR: (gcloud.compute.instances.get-guest-attributes) The resource 'hermit/' was not found"
+            )
+        metrics = {
+            "load_average": 0.5,
+            "memory_used_percent": 35,
+            "uptime_seconds": round(self.clock.time() - instance["booted_at"]),
+            "idle_seconds": 120,
+        }
+        return [
+            {"namespace": "hermit", "key": "log", "value": log},
+            {"namespace": "hermit", "key": "metrics", "value": json.dumps(metrics)},
+        ]
+
+    def _instances_add_metadata(self, positional, flags, project, zone):
+        instance = self._get_instance(project, zone, positional[3])
+        values = {}
+        for item in flags.get("--metadata-from-file", []):
+            key, path = item.split("=", 1)
+            with open(path, "rt") as fd:
+                values[key] = fd.read()
+        instance["metadata"].update(values)
+        self._record_operation(
+            "compute.instances.setMetadata", project, zone, positional[3]
+        )
+
+        command = values.get("hermit-command")
+        if (
+            command is None
+            or not self._has_agent(instance)
+            or self._status(instance) != "RUNNING"
+        ):
+            return None
+        # carry out the command like the agent on the instance would
+        command = json.loads(command)
+        if command["action"] == "shutdown":
+            self._transition(instance, "STOPPING")
+            self._transition(instance, "TERMINATED", self.delays["instance_stop"])
+        elif command["action"] == "refresh-image":
+            self._refresh_image(
+                instance, command["id"], command["current_image"], command["new_image"]
+            )
+        return None
+
+    # --- the REST interface ---
+
+    def handle_request(
+        self, method: str, url: str, headers=None, data=None
+    ) -> Tuple[int, object]:
+        "Returns (status_code, json body) for the REST calls hermit makes. Blobs are returned as bytes."
+        with self.lock:
+            m = re.match(
+                "^https://iamcredentials.googleapis.com/v1/projects/-/serviceAccounts/([^:]+):generateAccessToken$",
+                url,
+            )
+            if m and method == "POST":
+                service_account = m.group(1)
+                if not self._has_binding(
+                    service_account,
+                    f"user:{self.account}",
+                    "roles/iam.serviceAccountTokenCreator",
+                ):
+                    return 403, {"error": {"code": 403}}
+                return 200, {"accessToken": f"token-for-{service_account}"}
+
+            m = re.match("^https://([^/:]+)(?::\\d+)?/v2/(.+)/manifests/(.+)$", url)
+            if m and method == "GET":
+                host, path, tag = m.groups()
+                manifest = self._resolve_docker_image(host, path, tag)
+                if manifest is None:
+                    return 404, {"errors": [{"code": "MANIFEST_UNKNOWN"}]}
+                return 200, manifest
+
+            m = re.match("^https://([^/:]+)(?::\\d+)?/v2/(.+)/blobs/(.+)$", url)
+            if m and method == "GET":
+                blob = self.blobs.get(m.group(3))
+                if blob is None:
+                    return 404, {"errors": [{"code": "BLOB_UNKNOWN"}]}
+                return 200, base64.b64decode(blob)
+
+            m = re.match(
+                "^https://compute.googleapis.com/compute/v1/projects/([^/]+)/zones/([^/]+)/instances/([^/]+)$",
+                url,
+            )
+            if m and method == "GET":
+                project, zone, name = m.groups()
+                instance = self.instances.get(self._key(project, zone, name))
+                if instance is None:
+                    return 404, {"error": {"code": 404}}
+                return 200, self._public_instance(instance)
+
+            return 404, {"error": {"code": 404, "message": f"gce_sim: no route {url}"}}
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+        if isinstance(body, bytes):
+            self.content = body
+        else:
+            self.content = json.dumps(body).encode("utf8")
+        self.raw = io.BytesIO(self.content)
+        self.headers = {}
+
+    def close(self):
+        pass
+
+    def json(self):
+        return self._body
+
+
+def install(monkeypatch, sim: SimulatedGCE, fake_gcloud_dir: Optional[str] = None):
+    """Route hermit's gcloud wrappers and REST calls into the simulation. Background commands
+    (ie: start-iap-tunnel) still need a real process, so if fake_gcloud_dir is provided, a fake gcloud is
+    written there and used for those."""
+    from hermitcrab import gcp
+    import requests
+
+    def _run(args):
+        return sim.run_gcloud([str(x) for x in args])
+
+    def gcloud(args, timeout=10):
+        gcp.log_info(f"Executing (simulated): {args}")
+        returncode, stdout, stderr = _run(args)
+        if returncode != 0:
+            raise gcp.GCloudError(
+                f"Executing {args} failed (return code: {returncode}). Output: {stdout}{stderr}"
+            )
+
+    def gcloud_capturing_output(args, ignore_error=False, retries_on_timeout=0):
+        returncode, stdout, stderr = _run(args)
+        if not ignore_error:
+            assert (
+                returncode == 0
+            ), f"Executing {args} failed (return code: {returncode}). Stderr: {stderr}"
+        return stdout, stderr
+
+    def gcloud_capturing_json_output(args):
+        returncode, stdout, stderr = _run(args)
+        assert (
+            returncode == 0
+        ), f"Executing {args} failed (return code: {returncode}). Output: {stderr}"
+        return json.loads(stdout)
+
+    monkeypatch.setattr(gcp, "gcloud", gcloud)
+    monkeypatch.setattr(gcp, "gcloud_capturing_output", gcloud_capturing_output)
+    monkeypatch.setattr(
+        gcp, "gcloud_capturing_json_output", gcloud_capturing_json_output
+    )
+
+    if fake_gcloud_dir is not None:
+        state_file = os.path.join(fake_gcloud_dir, "gce_sim_state.json")
+        install_fake_gcloud(fake_gcloud_dir, state_file)
+        monkeypatch.setenv(
+            "PATH", fake_gcloud_dir + os.pathsep + os.environ.get("PATH", "")
+        )
+
+    def _request(method):
+        def request(url, headers=None, data=None, **kwargs):
+            return FakeResponse(*sim.handle_request(method, url, headers, data))
+
+        return request
+
+    monkeypatch.setattr(requests, "get", _request("GET"))
+    monkeypatch.setattr(requests, "post", _request("POST"))
+
+    # the watchdog is a separate process, which would run outside of the simulation
+    from hermitcrab.command import watchdog
+
+    monkeypatch.setattr(watchdog, "start_watchdog", lambda: None)
+
+
+def install_fake_gcloud(path_dir: str, state_file: str):
+    "Write an executable named gcloud into path_dir which runs commands against the simulation stored in state_file"
+    repo_dir = os.path.dirname(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+    gcloud_path = os.path.join(path_dir, "gcloud")
+    with open(gcloud_path, "wt") as fd:
+        fd.write(
+            f"#!/bin/sh\n"
+            f"export HERMIT_GCE_SIM_STATE={shlex.quote(state_file)}\n"
+            f'cd {shlex.quote(repo_dir)} && exec {shlex.quote(sys.executable)} -m tests.hermitcrab.gce_sim "$@"\n'
+        )
+    os.chmod(gcloud_path, 0o755)
+    return gcloud_path
+
+
+def save_state(sim: SimulatedGCE, state_file: str):
+    with open(state_file, "wt") as fd:
+        json.dump(sim.to_dict(), fd)
+
+
+def _serve_tunnel(args):
+    "Pretend to be start-iap-tunnel: listen on the local port and greet each connection like sshd would"
+    import socket
+    import signal
+
+    _, flags = parse_args(args)
+    local_host_port = _flag(flags, "--local-host-port")
+    assert local_host_port is not None
+    host, port = local_host_port.rsplit(":", 1)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, int(port)))
+    server.listen(16)
+    print(f"Listening on port [{port}].", flush=True)
+    while True:
+        conn, _ = server.accept()
+        try:
+            conn.sendall(b"SSH-2.0-OpenSSH_gce_sim\r\n")
+            # like sshd, wait for the client to hang up, so that the port isn't left in TIME_WAIT when we exit
+            conn.settimeout(5)
+            while conn.recv(255) != b"":
+                pass
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+
+def main(args):
+    positional, _ = parse_args(args)
+    if tuple(positional[:2]) == ("compute", "start-iap-tunnel"):
+        _serve_tunnel(args)
+        return 0
+
+    state_file = os.environ["HERMIT_GCE_SIM_STATE"]
+    # hold an exclusive lock for the whole command so concurrent gcloud processes see a consistent state
+    with open(state_file + ".lock", "wt") as lock_fd:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        if os.path.exists(state_file):
+            with open(state_file, "rt") as fd:
+                sim = SimulatedGCE.from_dict(json.load(fd), clock=RealClock())
+        else:
+            sim = SimulatedGCE(clock=RealClock())
+        returncode, stdout, stderr = sim.run_gcloud(args)
+        save_state(sim, state_file)
+
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
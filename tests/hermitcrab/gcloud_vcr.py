@@ -6,11 +6,15 @@ import json
 
 from dataclasses import dataclass
 import time
+import threading
+import contextlib
 from functools import wraps
 
 from hermitcrab import tunnel
 from hermitcrab import gcp
+from hermitcrab import image_check
 import hermitcrab.command.create_service_account
+from hermitcrab.command import watchdog
 import os
 
 
@@ -55,6 +59,9 @@ def _rewrite_metadata_param(args):
                 content = re.sub("'ssh-rsa [^']+'", "'ssh-rsa X'", content)
 
             new_args.append(f"{arg[:len(prefix)]}<{content}>")
+        elif arg.startswith("--metadata-from-file=hermit-command="):
+            # the command file has a random name, and carries a random ID
+            new_args.append("--metadata-from-file=hermit-command=MASKED")
         else:
             new_args.append(arg)
     return new_args
@@ -93,20 +100,10 @@ def make_playback_wrapper(f, vcr):
     def wrapper(*args, **kwargs):
         function_name = _function_name
 
-        next_fn, next_parameters, next_result = vcr.recording[vcr.current_call]
-        vcr.current_call += 1
-
         parameters = _simplify_struct({"args": list(args), "kwargs": kwargs})
         function_name, parameters = vcr.rewrite_call(function_name, parameters)
 
-        if next_fn != function_name:
-            raise PlaybackError(
-                f"Got a call to {function_name} when expecting a call to {next_fn}. This could be due to either non-determinism in test, or the recorded cassette is stale. Rerun test with --no-playback to re-record cassette."
-            )
-        if parameters != next_parameters:
-            raise PlaybackError(
-                f"Call to {function_name} had different parameters than expected. Expected: \n{json.dumps(next_parameters, indent=2)}\nActual call:\n{json.dumps(parameters, indent=2)}\n This could be due to either non-determinism in test, or the recorded cassette is stale. Rerun test with --no-playback to re-record cassette."
-            )
+        next_result = vcr.consume(function_name, parameters)
 
         if isinstance(next_result, Raised):
             raise next_result.raised
@@ -117,6 +114,11 @@ def make_playback_wrapper(f, vcr):
     return wrapper
 
 
+def _call_key(function_name, parameters):
+    "A normalized key for a call so that equivalent calls index to the same recorded entries"
+    return json.dumps([function_name, parameters], sort_keys=True)
+
+
 def _simplify_struct(x):
     if isinstance(x, dict):
         return {k: _simplify_struct(v) for k, v in x.items()}
@@ -134,22 +136,53 @@ def _simplify_struct(x):
 
 
 class VCR:
-    def __init__(self, mode):
+    def __init__(self, mode, ordered=True):
         self.mode = mode
+        # list of (function, parameters, result, concurrency group or None)
         self.recording = []
-        self.current_call = 0
         self.rewrite_call_info_callbacks = []
+        # if False, recorded calls can be consumed in any order during playback. If True, only
+        # calls within the same concurrency group can be consumed out of order.
+        self.ordered = ordered
+
+        self.current_group = None
+        self._group_count = 0
+        self.lock = threading.Lock()
+
+        # playback state
+        self.index = {}
+        self.used = set()
+        self.unmatched = []
 
     def rewrite_call(self, function, parameters):
         for callbacks in self.rewrite_call_info_callbacks:
             function, parameters = callbacks(function, parameters)
         return function, parameters
 
+    @contextlib.contextmanager
+    def concurrency_group(self, name=None):
+        """Calls made within this block (from any thread) may be played back in any order relative
+        to one another. The grouping is stored in the cassette when recording."""
+        with self.lock:
+            assert self.current_group is None, "concurrency groups cannot be nested"
+            self._group_count += 1
+            if name is None:
+                name = f"group-{self._group_count}"
+            self.current_group = name
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.current_group = None
+
     def record(self, function, parameters, result):
         operation = _simplify_struct([function, parameters, result.as_dict()])
         assert isinstance(operation, list)
         operation[0], operation[1] = self.rewrite_call(operation[0], operation[1])
-        self.recording.append(operation)
+        with self.lock:
+            if self.current_group is not None:
+                operation.append({"group": self.current_group})
+            self.recording.append(operation)
 
     def write_recording(self, cassette_name):
         with open(cassette_name, "wt") as fd:
@@ -157,16 +190,92 @@ class VCR:
 
     def read_recording(self, cassette_name):
         with open(cassette_name, "rt") as fd:
-            r = json.load(fd)
+            self.load_recording(json.load(fd))
 
+    def load_recording(self, recording):
         self.recording = []
-        for fn, params, result in r:
+        self.index = {}
+        self.used = set()
+        self.unmatched = []
+        for i, entry in enumerate(recording):
+            fn, params, result = entry[:3]
+            group = entry[3].get("group") if len(entry) > 3 else None
             if "returned" in result:
                 result = Returned(result["returned"])
             else:
                 assert "raised" in result
                 result = Raised(result["raised"])
-            self.recording.append((fn, params, result))
+            self.recording.append((fn, params, result, group))
+            self.index.setdefault(_call_key(fn, params), []).append(i)
+
+    def _first_unused(self):
+        for i in range(len(self.recording)):
+            if i not in self.used:
+                return i
+        return None
+
+    def _is_reachable(self, position):
+        "True if the entry at position can be played back given the entries which have not been played yet"
+        if not self.ordered:
+            return True
+        group = self.recording[position][3]
+        for i in range(position):
+            if i in self.used:
+                continue
+            # an earlier entry is still pending, which is only okay if both belong to the same group
+            if group is None or self.recording[i][3] != group:
+                return False
+        return True
+
+    def consume(self, function_name, parameters):
+        "Find the recorded entry matching this call, mark it as used and return its result"
+        with self.lock:
+            candidates = [
+                i
+                for i in self.index.get(_call_key(function_name, parameters), [])
+                if i not in self.used
+            ]
+            for i in candidates:
+                if self._is_reachable(i):
+                    self.used.add(i)
+                    return self.recording[i][2]
+
+            self.unmatched.append((function_name, parameters))
+            expected = self._first_unused()
+
+        if expected is None:
+            raise PlaybackError(
+                f"Got a call to {function_name} after all recorded calls were played back. Actual call:\n{json.dumps(parameters, indent=2)}\n This could be due to either non-determinism in test, or the recorded cassette is stale. Rerun test with --no-playback to re-record cassette."
+            )
+
+        next_fn, next_parameters, _, _ = self.recording[expected]
+        if len(candidates) > 0:
+            problem = f"Call to {function_name} was recorded, but later than where playback is (positions {candidates}, next expected position {expected})"
+        elif next_fn != function_name:
+            problem = (
+                f"Got a call to {function_name} when expecting a call to {next_fn}"
+            )
+        else:
+            problem = f"Call to {function_name} had different parameters than expected"
+        raise PlaybackError(
+            f"{problem}. Expected: \n{json.dumps([next_fn, next_parameters], indent=2)}\nActual call:\n{json.dumps(parameters, indent=2)}\n This could be due to either non-determinism in test, or the recorded cassette is stale. Rerun test with --no-playback to re-record cassette."
+        )
+
+    def get_unused(self):
+        return [
+            self.recording[i][:2]
+            for i in range(len(self.recording))
+            if i not in self.used
+        ]
+
+    def report(self):
+        "Describe any calls which didn't match the cassette and recorded calls which were never made"
+        lines = []
+        for function_name, parameters in self.unmatched:
+            lines.append(f"unmatched call: {_call_key(function_name, parameters)}")
+        for function_name, parameters in self.get_unused():
+            lines.append(f"unused recording: {_call_key(function_name, parameters)}")
+        return "\n".join(lines)
 
     def is_recording(self):
         return self.mode == RECORDING
@@ -195,13 +304,23 @@ def setup_vcr(monkeypatch, request, mode=None):
     monkeypatch.setattr(
         hermitcrab.command.create_service_account,
         "get_or_create_default_service_account",
-        lambda project: "hermit-nrqacuv537@broad-achilles.iam.gserviceaccount.com",
+        lambda project, enable=True: "hermit-nrqacuv537@broad-achilles.iam.gserviceaccount.com",
+    )
+
+    monkeypatch.setattr(
+        hermitcrab.command.create_service_account,
+        "has_default_service_account",
+        lambda project: True,
     )
 
     # and that os.getlogin always reports the same thing
     monkeypatch.setattr(os, "getlogin", lambda: "hermit-test")
 
-    cassette_name = f"cassettes/{test_name}.json"
+    # resolve relative to the repo root rather than the working directory so that xdist workers
+    # find the same cassettes
+    cassette_name = os.path.join(
+        str(request.config.rootpath), "cassettes", f"{test_name}.json"
+    )
     vcr = VCR(mode)
     vcr.rewrite_call_info_callbacks.append(_rewrite_call_info)
 
@@ -233,6 +352,15 @@ def setup_vcr(monkeypatch, request, mode=None):
     monkeypatch.setattr(
         gcp, "has_access_to_docker_image", lambda service_account, docker_image: True
     )
+    # the watchdog runs in the background, so its calls can't be recorded
+    monkeypatch.setattr(watchdog, "start_watchdog", lambda: None)
+    monkeypatch.setattr(
+        image_check,
+        "check_docker_image",
+        lambda service_account, docker_image: gcp.DockerImageManifest(
+            gcp.parse_docker_image_name(docker_image), "", {}, "sha256:" + "0" * 64
+        ),
+    )
 
     return vcr, cassette_name
 
@@ -240,3 +368,10 @@ def setup_vcr(monkeypatch, request, mode=None):
 def teardown_vcr(vcr, cassette_name):
     if vcr.is_recording():
         vcr.write_recording(cassette_name)
+    elif len(vcr.unmatched) == 0:
+        # an unmatched call has already failed the test, so only complain about leftovers if everything else went fine
+        unused = vcr.get_unused()
+        if len(unused) > 0:
+            raise PlaybackError(
+                f"{len(unused)} recorded calls in {cassette_name} were never made:\n{vcr.report()}\nRerun test with --no-playback to re-record cassette."
+            )
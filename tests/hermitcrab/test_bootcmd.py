@@ -0,0 +1,160 @@
+import json
+import shutil
+import subprocess
+
+import pytest
+
+from hermitcrab.command import up
+from hermitcrab.config import InstanceConfig
+
+
+def _config(**kwargs):
+    return InstanceConfig(
+        name="dev",
+        zone="us-central1-a",
+        project="sim-project",
+        machine_type="n2-standard-2",
+        docker_image="us-central1-docker.pkg.dev/sim-project/docker/dev-env:v1",
+        pd_name="dev-pd",
+        local_port=3022,
+        service_account="sa@sim-project.iam.gserviceaccount.com",
+        boot_disk_size_in_gb=50,
+        **kwargs,
+    )
+
+
+def _matching(commands, text):
+    return [command for command in commands if text in command]
+
+
+@pytest.mark.parametrize("local_ssd_count", [0, 1, 4])
+def test_tmp_layout(local_ssd_count):
+    bootcmd = up._create_bootcmd(_config(local_ssd_count=local_ssd_count))
+
+    if local_ssd_count == 0:
+        assert "mount --bind /var/tmp /tmp" in bootcmd
+        assert _matching(bootcmd, "local-ssd") == []
+    else:
+        assert "mount --bind /var/tmp /tmp" not in bootcmd
+        assert "mount --bind /mnt/disks/local-ssd/tmp /tmp" in bootcmd
+        assert _matching(bootcmd, "mount -o noatime,discard") != []
+
+    mdadm = _matching(bootcmd, "mdadm")
+    if local_ssd_count > 1:
+        assert len(mdadm) == 1
+        assert "--chunk=256" in mdadm[0]
+        assert f"--raid-devices={local_ssd_count}" in mdadm[0]
+    else:
+        assert mdadm == []
+
+
+def test_scratch_filesystem():
+    bootcmd = up._create_bootcmd(_config(local_ssd_count=1))
+    assert _matching(bootcmd, "mkfs.ext4 -F -E lazy_itable_init=1") != []
+
+    bootcmd = up._create_bootcmd(_config(local_ssd_count=1, scratch_filesystem="xfs"))
+    assert _matching(bootcmd, "mkfs.xfs -f -K") != []
+
+
+def test_docker_and_scratch_mounts_on_local_ssd(monkeypatch):
+    monkeypatch.setattr(up, "get_pub_key", lambda: "ssh-rsa boguskey")
+    config = _config(
+        local_ssd_count=2, docker_on_local_ssd=True, scratch_mounts=["/scratch"]
+    )
+
+    cloud_config = up._create_cloud_config(config, config.docker_image)
+    files = {f["path"]: f["content"] for f in cloud_config["write_files"]}
+
+    daemon_config = json.loads(files["/etc/docker/daemon.json"])
+    assert daemon_config["data-root"] == "/mnt/disks/local-ssd/docker"
+    assert daemon_config["live-restore"] == False
+    assert (
+        "-v /mnt/disks/local-ssd/mounts/scratch:/scratch"
+        in files["/etc/systemd/system/container-sshd.service"]
+    )
+    assert "mkdir -p /mnt/disks/local-ssd/docker" in cloud_config["bootcmd"]
+
+    # without the options, docker keeps its data on the boot disk
+    daemon_config = json.loads(up._docker_daemon_config(_config()))
+    assert "data-root" not in daemon_config
+
+
+@pytest.mark.parametrize("fsck_interval_days", [0, 30])
+def test_fsck_only_when_needed(fsck_interval_days):
+    bootcmd = up._create_bootcmd(_config(fsck_interval_days=fsck_interval_days))
+
+    (check,) = _matching(bootcmd, "fsck -C 1")
+    assert "tune2fs -l /dev/disk/by-id/google-dev-pd" in check
+    assert f"[ $days -ge {fsck_interval_days} ]" in check
+
+
+@pytest.mark.skipif(shutil.which("bash") is None, reason="requires bash")
+def test_setup_script_is_valid_bash(monkeypatch, tmpdir):
+    monkeypatch.setattr(up, "get_pub_key", lambda: "ssh-rsa boguskey")
+    config = _config(local_ssd_count=1)
+    cloud_config = up._create_cloud_config(config, config.docker_image)
+    files = {f["path"]: f["content"] for f in cloud_config["write_files"]}
+
+    script = tmpdir.join("hermit-setup.sh")
+    script.write(files["/home/cloudservice/hermit-setup.sh"])
+    subprocess.check_call(["bash", "-n", str(script)])
+
+    pull_image = tmpdir.join("pull-image.sh")
+    pull_image.write(files["/home/cloudservice/pull-image.sh"])
+    subprocess.check_call(["bash", "-n", str(pull_image)])
+
+    bootcmd = tmpdir.join("bootcmd.sh")
+    bootcmd.write("\n".join(cloud_config["bootcmd"]))
+    subprocess.check_call(["bash", "-n", str(bootcmd)])
+
+
+def test_pull_tuning_in_daemon_config():
+    daemon_config = json.loads(
+        up._docker_daemon_config(
+            _config(
+                max_concurrent_downloads=10,
+                registry_mirrors=["https://mirror.gcr.io"],
+                containerd_snapshotter=True,
+            )
+        )
+    )
+    assert daemon_config["max-concurrent-downloads"] == 10
+    assert daemon_config["registry-mirrors"] == ["https://mirror.gcr.io"]
+    assert daemon_config["features"] == {"containerd-snapshotter": True}
+    assert "storage-driver" not in daemon_config
+
+    daemon_config = json.loads(up._docker_daemon_config(_config()))
+    assert "max-concurrent-downloads" not in daemon_config
+    assert daemon_config["storage-driver"] == "overlay2"
+
+
+@pytest.mark.skipif(shutil.which("bash") is None, reason="requires bash")
+def test_format_if_blank_skips_missing_device(tmpdir):
+    # blkid also exits with 2 when the device doesn't exist, which mustn't be mistaken for a blank disk
+    bin_dir = tmpdir.mkdir("bin")
+    for command, body in [
+        ("blkid", "exit 2"),
+        ("mkfs", f"touch {tmpdir}/mkfs-ran"),
+        ("sleep", "true"),
+    ]:
+        script = bin_dir.join(command)
+        script.write(f"#!/bin/sh\n{body}\n")
+        script.chmod(0o755)
+
+    subprocess.check_call(
+        ["bash", "-c", up._format_if_blank(str(tmpdir.join("missing")))],
+        env={"PATH": f"{bin_dir}:/usr/bin:/bin"},
+    )
+    assert not tmpdir.join("mkfs-ran").exists()
+
+
+def test_pull_image_script_fails_when_pull_fails(tmpdir):
+    docker = tmpdir.join("docker")
+    # 'image inspect' doesn't find the image, and then the pull fails
+    docker.write("#!/bin/sh\nexit 1\n")
+    docker.chmod(0o755)
+    script = up._pull_image_script("dev-env:v1").replace("/usr/bin/docker", str(docker))
+
+    result = subprocess.run(["bash", "-c", script], capture_output=True, text=True)
+    assert result.returncode != 0
+    assert "Pulled" not in result.stdout
@@ -0,0 +1,61 @@
+from hermitcrab.config import InstanceConfig, write_instance_config, get_instance_config
+from hermitcrab.main import main
+from ..conftest import PROJECT, ZONE
+
+
+def _setup_source(gce_sim):
+    gce_sim.add_disk("src-pd", ZONE, PROJECT, size_gb=500)
+    write_instance_config(
+        InstanceConfig(
+            name="src",
+            zone=ZONE,
+            project=PROJECT,
+            machine_type="n2-standard-2",
+            docker_image="us-central1-docker.pkg.dev/sim-project/docker/dev-env:v1",
+            pd_name="src-pd",
+            local_port=3022,
+            service_account="sa@sim-project.iam.gserviceaccount.com",
+            boot_disk_size_in_gb=50,
+        )
+    )
+
+
+def test_clone_from_disk(sim_homedir, gce_sim):
+    _setup_source(gce_sim)
+
+    main(["clone", "src", "copy"])
+
+    config = get_instance_config("copy")
+    assert config.pd_name == "copy-pd"
+    assert config.local_port == 3023
+    assert config.docker_image == get_instance_config("src").docker_image
+
+    disk = gce_sim.disks[f"{PROJECT}/{ZONE}/copy-pd"]
+    assert disk["formatted"]
+    assert disk["sizeGb"] == "500"
+    # no instance was needed to format the copy
+    assert gce_sim.instances == {}
+
+
+def test_clone_from_snapshot(sim_homedir, gce_sim):
+    _setup_source(gce_sim)
+
+    main(["snapshot", "src", "--snapshot-name", "src-snap"])
+    assert f"{PROJECT}/src-snap" in gce_sim.snapshots
+
+    main(["clone", "src", "copy", "--snapshot", "src-snap", "--pd-name", "other-pd"])
+    assert get_instance_config("copy").pd_name == "other-pd"
+    assert gce_sim.disks[f"{PROJECT}/{ZONE}/other-pd"]["formatted"]
+
+
+def test_snapshot_schedule(sim_homedir, gce_sim):
+    _setup_source(gce_sim)
+
+    main(["snapshot", "src", "--schedule", "daily", "--retention-days", "7"])
+
+    policy = gce_sim.resource_policies[f"{PROJECT}/src-pd-daily-snapshots"]
+    assert policy["region"] == "us-central1"
+    assert policy["flags"]["--max-retention-days"] == "7"
+    assert gce_sim.disks[f"{PROJECT}/{ZONE}/src-pd"]["resourcePolicies"] == [
+        "src-pd-daily-snapshots"
+    ]
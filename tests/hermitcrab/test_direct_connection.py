@@ -0,0 +1,34 @@
+from hermitcrab.command.create import DIRECT_FIREWALL_RULE
+from hermitcrab.config import read_instance_state
+from hermitcrab.ssh import get_ssh_config_path
+from ..conftest import PROJECT
+
+
+def _direct_rule(gce_sim):
+    return gce_sim.firewall_rules.get(f"{PROJECT}/{DIRECT_FIREWALL_RULE}")
+
+
+def test_direct_connection(gce_sim, sim_instance, instance_up):
+    sim_instance("dev", connection_mode="direct", direct_source_ranges=["10.8.0.0/16"])
+    sim_instance(
+        "other", connection_mode="direct", direct_source_ranges=["10.9.0.0/16"]
+    )
+
+    with instance_up("dev"):
+        assert _direct_rule(gce_sim)["sourceRanges"] == ["10.8.0.0/16"]
+
+        internal_ip = read_instance_state("dev").get("internal_ip")
+        ssh_config = open(get_ssh_config_path()).read()
+        # the direct path is tried first, and the Host block's ProxyCommand is the fallback
+        direct_block = f'Match originalhost dev exec "nc -z -w 1 {internal_ip} 3022"\n   Hostname {internal_ip}\n   Port 3022\n   ProxyCommand none\n'
+        assert direct_block in ssh_config
+        assert ssh_config.index(direct_block) < ssh_config.index("Host dev\n")
+        # other hasn't been up yet, so its internal IP isn't known
+        assert "Match originalhost other" not in ssh_config
+
+        with instance_up("other"):
+            # the rule is shared, so it allows both ranges
+            assert _direct_rule(gce_sim)["sourceRanges"] == [
+                "10.8.0.0/16",
+                "10.9.0.0/16",
+            ]
@@ -1,22 +1,32 @@
 from hermitcrab.main import main
 
+DOCKER_IMAGE = "us-central1-docker.pkg.dev/depmap-omics/docker/hermit-dev-env:v1"
 
-def test_end_to_end(vcr, tmphomedir):
-    main(
-        [
-            "create",
-            "--project",
-            "broad-achilles",
-            "--zone",
-            "us-central1-a",
-            "hermit-demo",
-            "--disk-size",
-            "50",
-            "us-central1-docker.pkg.dev/depmap-omics/docker/hermit-dev-env:v1",
-            "--boot-disk-size",
-            "55",
-        ]
+
+def test_end_to_end(gce_sim, sim_homedir, vcr):
+    # (when re-recording with --no-playback, the calls are answered by the simulator rather than GCP)
+    gce_sim.add_service_account(
+        "hermit-nrqacuv537@broad-achilles.iam.gserviceaccount.com"
     )
+    gce_sim.add_docker_image(DOCKER_IMAGE)
+
+    # create runs independent steps concurrently
+    with vcr.concurrency_group("create"):
+        main(
+            [
+                "create",
+                "--project",
+                "broad-achilles",
+                "--zone",
+                "us-central1-a",
+                "hermit-demo",
+                "--disk-size",
+                "50",
+                DOCKER_IMAGE,
+                "--boot-disk-size",
+                "55",
+            ]
+        )
     main(["status"])
     main(["up", "hermit-demo"])
     main(["status"])
@@ -0,0 +1,64 @@
+from hermitcrab.command import up
+from hermitcrab.config import get_instance_config
+from hermitcrab.deploy_scripts.hermit_agent import parse_bytes_transmitted
+from hermitcrab.main import main
+from hermitcrab.tunnel import is_tunnel_running, probe_ssh_banner
+
+DOCKER_IMAGE = "us-central1-docker.pkg.dev/sim-project/docker/dev-env:v1"
+
+IPTABLES_OUTPUT = """Chain CONTAINER_SSH (1 references)
+    pkts      bytes target     prot opt in     out     source               destination
+     120    10240            tcp  --  *      *       0.0.0.0/0            0.0.0.0/0            tcp dpt:3022 flags:0x08/0x08
+      30     2048            tcp  --  *      *       0.0.0.0/0            0.0.0.0/0            tcp dpt:8888 flags:0x08/0x08
+"""
+
+
+def test_parse_bytes_transmitted():
+    assert parse_bytes_transmitted(IPTABLES_OUTPUT, ["3022"]) == 10240
+    assert parse_bytes_transmitted(IPTABLES_OUTPUT, ["3022", "8888"]) == 10240 + 2048
+    assert parse_bytes_transmitted(IPTABLES_OUTPUT, ["3022", "8787"]) is None
+
+
+def test_forwarded_ports(sim_homedir, gce_sim, free_port, instance_up, monkeypatch):
+    gce_sim.add_docker_image(DOCKER_IMAGE)
+    local_port = free_port()
+
+    main(
+        [
+            "create",
+            "dev",
+            DOCKER_IMAGE,
+            "--local-port",
+            str(local_port),
+            "--forward-port",
+            "8888",
+            "--forward-port",
+            "8787",
+        ]
+    )
+    config = get_instance_config("dev")
+    assert config.forwarded_ports == {"8888": local_port + 1, "8787": local_port + 2}
+    (rule,) = gce_sim.firewall_rules.values()
+    assert rule["allowed"] == [{"IPProtocol": "tcp", "ports": ["3022", "8888", "8787"]}]
+
+    monkeypatch.setattr(up, "get_pub_key", lambda: "ssh-rsa boguskey")
+    cloud_config = up._create_cloud_config(config, config.docker_image)
+    files = {f["path"]: f["content"] for f in cloud_config["write_files"]}
+    # traffic to the forwarded ports counts as activity, but like for sshd, only packets carrying data
+    for port in ["3022", "8888"]:
+        assert (
+            f"iptables -A CONTAINER_SSH -p tcp --dport {port} --tcp-flags PSH PSH\n"
+            in files["/home/cloudservice/setup_firewall"]
+        )
+    for port in ["8888", "8787"]:
+        assert (
+            f"--forwarded-port {port}"
+            in files["/etc/systemd/system/hermit-agent.service"]
+        )
+
+    with instance_up():
+        for remote_port, forwarded_local_port in config.forwarded_ports.items():
+            assert is_tunnel_running("dev", int(remote_port))
+            # (the simulated tunnels all answer like sshd)
+            assert probe_ssh_banner(forwarded_local_port)
+    assert not is_tunnel_running("dev", 8888)
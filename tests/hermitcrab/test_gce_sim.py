@@ -0,0 +1,195 @@
+import json
+import os
+import threading
+
+from hermitcrab import gcp
+from hermitcrab.main import main
+from hermitcrab.config import get_instance_config
+
+from .gce_sim import SimulatedGCE, FakeClock, install_fake_gcloud, save_state
+
+DOCKER_IMAGE = "us-central1-docker.pkg.dev/sim-project/docker/dev-env:v1"
+
+
+def test_instance_transitions():
+    sim = SimulatedGCE(clock=FakeClock(real_sleep=0))
+    sim.add_disk("pd", "zone-a", "proj")
+
+    start = sim.clock.time()
+    returncode, _, _ = sim.run_gcloud(
+        [
+            "compute",
+            "instances",
+            "create",
+            "vm",
+            "--zone=zone-a",
+            "--project=proj",
+            "--disk=name=pd,device-name=pd,auto-delete=no",
+        ]
+    )
+    assert returncode == 0
+    assert sim.clock.time() - start == sim.delays["instance_create"]
+    assert sim.instance_status("vm", "zone-a", "proj") == "RUNNING"
+
+    # the disk is attached, so can't be deleted
+    returncode, _, stderr = sim.run_gcloud(
+        ["compute", "disks", "delete", "pd", "--zone=zone-a", "--project=proj"]
+    )
+    assert returncode == 1
+    assert "already being used" in stderr
+
+    sim.run_gcloud(
+        ["compute", "instances", "suspend", "vm", "--zone=zone-a", "--project=proj"]
+    )
+    assert sim.instance_status("vm", "zone-a", "proj") == "SUSPENDED"
+
+    # a shutdown requested over ssh completes asynchronously
+    sim.run_gcloud(
+        ["compute", "instances", "resume", "vm", "--zone=zone-a", "--project=proj"]
+    )
+    sim.run_gcloud(
+        [
+            "compute",
+            "ssh",
+            "vm",
+            "--zone=zone-a",
+            "--project=proj",
+            "--command",
+            "sudo shutdown now",
+        ]
+    )
+    assert sim.instance_status("vm", "zone-a", "proj") == "STOPPING"
+    sim.clock.sleep(sim.delays["instance_stop"])
+    assert sim.instance_status("vm", "zone-a", "proj") == "TERMINATED"
+
+    operation_types = [op["operationType"] for op in sim.operations]
+    assert operation_types == [
+        "compute.instances.insert",
+        "compute.instances.suspend",
+        "compute.instances.resume",
+    ]
+
+
+def test_boot_log_revealed_over_time():
+    sim = SimulatedGCE(clock=FakeClock(real_sleep=0))
+    sim.add_disk("pd", "zone-a", "proj", formatted=False)
+    sim.run_gcloud(
+        [
+            "compute",
+            "instances",
+            "create",
+            "vm",
+            "--zone=zone-a",
+            "--project=proj",
+            "--disk=name=pd,device-name=pd,auto-delete=no",
+        ]
+    )
+    ssh = [
+        "compute",
+        "ssh",
+        "vm",
+        "--zone",
+        "zone-a",
+        "--project",
+        "proj",
+        "--command",
+        "cat /var/log/hermit.log",
+    ]
+    _, stdout, _ = sim.run_gcloud(ssh)
+    assert stdout == "Starting cloudinit bootcmd...\n"
+
+    sim.clock.sleep(sim.delays["boot"])
+    _, stdout, _ = sim.run_gcloud(ssh)
+    assert "superblock could not be read" in stdout
+
+
+def test_concurrent_calls_are_order_independent():
+    sim = SimulatedGCE(clock=FakeClock(real_sleep=0))
+    for i in range(10):
+        sim.add_instance(f"vm{i}", "zone-a", "proj", status="SUSPENDED")
+
+    def resume(i):
+        sim.run_gcloud(
+            [
+                "compute",
+                "instances",
+                "resume",
+                f"vm{i}",
+                "--zone=zone-a",
+                "--project=proj",
+            ]
+        )
+
+    threads = [threading.Thread(target=resume, args=(i,)) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for i in range(10):
+        assert sim.instance_status(f"vm{i}", "zone-a", "proj") == "RUNNING"
+
+
+def test_fake_gcloud_subprocess(tmpdir, monkeypatch):
+    sim = SimulatedGCE()
+    sim.add_instance("vm", "zone-a", "proj", status="SUSPENDED")
+    state_file = str(tmpdir.join("state.json"))
+    save_state(sim, state_file)
+    install_fake_gcloud(str(tmpdir), state_file)
+    monkeypatch.setenv("PATH", str(tmpdir) + os.pathsep + os.environ["PATH"])
+
+    assert gcp.get_instance_status("vm", "zone-a", "proj") == "SUSPENDED"
+    assert (
+        gcp.get_instance_status("missing", "zone-a", "proj", one_or_none=True) is None
+    )
+
+    # state written by one gcloud invocation is seen by the next
+    with open(state_file, "rt") as fd:
+        state = json.load(fd)
+    assert len(state["calls"]) == 2
+
+
+def test_end_to_end_against_simulator(sim_homedir, gce_sim, free_port):
+    gce_sim.add_docker_image(DOCKER_IMAGE)
+
+    main(
+        [
+            "create",
+            "dev",
+            DOCKER_IMAGE,
+            "--disk-size",
+            "50",
+            "--local-port",
+            str(free_port()),
+        ]
+    )
+    instance_config = get_instance_config("dev")
+    assert instance_config.format_strategy == "lazy"
+    disk = gce_sim.disks[f"sim-project/us-central1-a/{instance_config.pd_name}"]
+    # no instance was needed to create the disk, the first boot formats it
+    assert not disk["formatted"]
+    assert gce_sim.instances == {}
+
+    main(["up", "dev"])
+    assert disk["formatted"]
+    assert gce_sim.instance_status("dev", "us-central1-a", "sim-project") == "RUNNING"
+    main(["status"])
+
+    main(["down", "dev"])
+    assert gce_sim.instance_status("dev", "us-central1-a", "sim-project") is None
+
+    main(["delete", "-f", "dev"])
+    assert gce_sim.disks == {}
+
+
+def test_create_with_vm_format_strategy(sim_homedir, gce_sim):
+    gce_sim.add_docker_image(DOCKER_IMAGE)
+
+    main(["create", "dev", DOCKER_IMAGE, "--format-strategy", "vm"])
+    instance_config = get_instance_config("dev")
+    assert instance_config.format_strategy == "vm"
+    assert gce_sim.disks[f"sim-project/us-central1-a/{instance_config.pd_name}"][
+        "formatted"
+    ]
+    # the temporary instance used to format the disk is gone
+    assert gce_sim.instances == {}
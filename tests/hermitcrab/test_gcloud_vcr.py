@@ -0,0 +1,142 @@
+import os
+import threading
+
+import pytest
+
+from .gcloud_vcr import (
+    VCR,
+    PLAYBACK,
+    RECORDING,
+    PlaybackError,
+    Returned,
+    make_playback_wrapper,
+    make_recording_wrapper,
+    teardown_vcr,
+)
+
+END_TO_END_CASSETTE = os.path.join(
+    os.path.dirname(__file__), "..", "..", "cassettes", "test_end_to_end.json"
+)
+
+
+def gcloud_capturing_json_output(args):
+    return {"status": args[-1]}
+
+
+def _record(calls, groups=()):
+    "Record calls, where calls listed in the same tuple within groups are made inside a concurrency group"
+    vcr = VCR(RECORDING)
+    wrapped = make_recording_wrapper(gcloud_capturing_json_output, vcr.record)
+    for call in calls:
+        if isinstance(call, tuple):
+            with vcr.concurrency_group():
+                for args in call:
+                    wrapped(args)
+        else:
+            wrapped(call)
+    return vcr.recording
+
+
+def _playback(recording, ordered=True):
+    vcr = VCR(PLAYBACK, ordered=ordered)
+    vcr.load_recording(recording)
+    return vcr, make_playback_wrapper(gcloud_capturing_json_output, vcr)
+
+
+def test_playback_in_order():
+    vcr, wrapped = _playback(_record([["a"], ["b"]]))
+    assert wrapped(["a"]) == {"status": "a"}
+    assert wrapped(["b"]) == {"status": "b"}
+    assert vcr.get_unused() == []
+
+
+def test_out_of_order_call_is_rejected():
+    vcr, wrapped = _playback(_record([["a"], ["b"]]))
+    with pytest.raises(PlaybackError, match="later than where playback is"):
+        wrapped(["b"])
+    assert "unmatched call" in vcr.report()
+
+
+def test_unordered_playback():
+    vcr, wrapped = _playback(_record([["a"], ["b"]]), ordered=False)
+    assert wrapped(["b"]) == {"status": "b"}
+    assert wrapped(["a"]) == {"status": "a"}
+
+
+def test_concurrency_group_allows_any_order_within_group():
+    recording = _record([["first"], (["x"], ["y"], ["z"]), ["last"]])
+    assert [entry[3] for entry in recording[1:4]] == [{"group": "group-1"}] * 3
+
+    vcr, wrapped = _playback(recording)
+    wrapped(["first"])
+    # calls outside the group still have to wait their turn
+    with pytest.raises(PlaybackError):
+        wrapped(["last"])
+
+    vcr, wrapped = _playback(recording)
+    wrapped(["first"])
+    threads = [threading.Thread(target=wrapped, args=([x],)) for x in ["z", "x", "y"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wrapped(["last"])
+    assert vcr.get_unused() == []
+
+
+def test_repeated_calls_consumed_in_recorded_order():
+    recording = _record([["a"], ["a"]])
+    recording[1][2] = Returned("second").as_dict()
+    vcr, wrapped = _playback(recording)
+    assert wrapped(["a"]) == {"status": "a"}
+    assert wrapped(["a"]) == "second"
+    with pytest.raises(PlaybackError, match="after all recorded calls"):
+        wrapped(["a"])
+
+
+def test_unused_recordings_are_reported():
+    vcr, wrapped = _playback(_record([["a"], ["b"]]))
+    wrapped(["a"])
+    assert vcr.get_unused() == [
+        ("gcloud_capturing_json_output", {"args": [["b"]], "kwargs": {}})
+    ]
+    assert "unused recording" in vcr.report()
+
+
+def test_teardown_fails_on_unused_recordings_only_when_nothing_else_failed():
+    vcr, wrapped = _playback(_record([["a"], ["b"]]))
+    wrapped(["a"])
+    with pytest.raises(PlaybackError, match="1 recorded calls"):
+        teardown_vcr(vcr, "cassette.json")
+
+    vcr, wrapped = _playback(_record([["a"], ["b"]]))
+    with pytest.raises(PlaybackError):
+        wrapped(["c"])
+    # the unmatched call already failed the test
+    teardown_vcr(vcr, "cassette.json")
+
+
+def test_end_to_end_cassette_plays_back_create_group_in_any_order():
+    vcr = VCR(PLAYBACK)
+    vcr.read_recording(END_TO_END_CASSETTE)
+    in_group = [i for i, entry in enumerate(vcr.recording) if entry[3] == "create"]
+    assert len(in_group) > 1
+    assert in_group == list(range(in_group[0], in_group[-1] + 1))
+
+    for i in range(in_group[0]):
+        vcr.consume(*vcr.recording[i][:2])
+    for i in reversed(in_group):
+        assert vcr.consume(*vcr.recording[i][:2]) is vcr.recording[i][2]
+    for i in range(in_group[-1] + 1, len(vcr.recording)):
+        vcr.consume(*vcr.recording[i][:2])
+    assert vcr.get_unused() == []
+
+
+def test_end_to_end_cassette_needs_whole_create_group_before_moving_on():
+    vcr = VCR(PLAYBACK)
+    vcr.read_recording(END_TO_END_CASSETTE)
+    in_group = [i for i, entry in enumerate(vcr.recording) if entry[3] == "create"]
+    for i in range(in_group[-1]):
+        vcr.consume(*vcr.recording[i][:2])
+    with pytest.raises(PlaybackError, match="later than where playback is"):
+        vcr.consume(*vcr.recording[in_group[-1] + 1][:2])
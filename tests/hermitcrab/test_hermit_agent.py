@@ -0,0 +1,182 @@
+import urllib.error
+
+import pytest
+
+from hermitcrab.deploy_scripts import hermit_agent
+from hermitcrab.deploy_scripts.hermit_agent import (
+    COMMAND_EXPIRY,
+    GUEST_ATTRIBUTE_VALUE_LIMIT,
+    CommandRunner,
+    MIN_LOG_ATTRIBUTE_LIMIT,
+    IdleMonitor,
+    is_pending,
+    parse_bytes_transmitted,
+    parse_command,
+    publish,
+    read_log_tail,
+    read_metrics,
+)
+from hermitcrab.main import main
+from ..conftest import PROJECT, ZONE
+
+MEMINFO = """MemTotal:       16000000 kB
+MemFree:         2000000 kB
+MemAvailable:   12000000 kB
+Buffers:          100000 kB
+"""
+
+
+def _iptables_output(sshd_bytes):
+    return f"""Chain CONTAINER_SSH (1 references)
+    pkts      bytes target     prot opt in     out     source               destination
+     120 {sshd_bytes:>10}            tcp  --  *      *       0.0.0.0/0            0.0.0.0/0            tcp dpt:3022 flags:0x08/0x08
+"""
+
+
+def test_read_metrics(tmpdir):
+    tmpdir.join("loadavg").write("0.52 0.40 0.31 2/345 6789\n")
+    tmpdir.join("uptime").write("3600.25 7000.10\n")
+    tmpdir.join("meminfo").write(MEMINFO)
+    assert read_metrics(str(tmpdir)) == {
+        "load_average": 0.52,
+        "memory_used_percent": 25,
+        "uptime_seconds": 3600,
+    }
+
+
+def test_idle_monitor():
+    monitor = IdleMonitor(now=0)
+
+    def observe(sshd_bytes, now, busy=False):
+        return monitor.observe(
+            parse_bytes_transmitted(_iptables_output(sshd_bytes), ["3022"]), busy, now
+        )
+
+    # the first poll
+    assert observe(10000, 60)
+    # only the watchdog's probes, which the firewall rule doesn't count
+    assert not observe(10000, 120)
+    assert monitor.get_idle_seconds(180) == 120
+    assert observe(50000, 180)
+    assert monitor.get_idle_seconds(180) == 0
+    # a 'hermit stage' copy in progress, with no traffic
+    assert observe(50000, 240, busy=True)
+    assert monitor.get_idle_seconds(300) == 60
+
+
+def test_read_log_tail(tmpdir):
+    log_path = tmpdir.join("hermit.log")
+    assert read_log_tail(str(log_path)) == ""
+    log_path.write("first line\nsecond line\nthird line\n")
+    assert read_log_tail(str(log_path)) == "first line\nsecond line\nthird line\n"
+    # only whole lines from the end
+    assert read_log_tail(str(log_path), limit=20) == "third line\n"
+
+    # a long log, with bytes which aren't utf8, still fits in a guest attribute
+    log_path.write_binary(b"".join(b"line %d \xff\xfe\xfd\n" % i for i in range(10000)))
+    tail = read_log_tail(str(log_path))
+    assert 0 < len(tail.encode("utf8")) <= GUEST_ATTRIBUTE_VALUE_LIMIT
+    assert tail.startswith("line ")
+    assert tail.endswith("line 9999 \ufffd\ufffd\ufffd\n")
+
+
+class StopPublishing(Exception):
+    pass
+
+
+class RejectingMetadataServer:
+    "Rejects log values larger than max_size with a 4xx, like the metadata server does"
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.attempts = []
+
+    def put_guest_attribute(self, key, value):
+        if key != "log":
+            return
+        self.attempts.append(len(value.encode("utf8")))
+        if len(value.encode("utf8")) > self.max_size:
+            raise urllib.error.HTTPError("url", 400, "Bad Request", {}, None)  # type: ignore
+
+
+def _publish_for(rounds, metadata, log_path, proc_dir, monkeypatch):
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == rounds:
+            raise StopPublishing()
+
+    monkeypatch.setattr(hermit_agent.time, "sleep", sleep)
+    with pytest.raises(StopPublishing):
+        publish(metadata, log_path, IdleMonitor(0), proc_dir)
+
+
+def test_publish_shortens_rejected_log(tmpdir, monkeypatch):
+    log_path = tmpdir.join("hermit.log")
+    log_path.write("".join(f"line {i}\n" for i in range(10000)))
+    tmpdir.join("loadavg").write("0.52 0.40 0.31 2/345 6789\n")
+    tmpdir.join("uptime").write("3600.25 7000.10\n")
+    tmpdir.join("meminfo").write(MEMINFO)
+
+    metadata = RejectingMetadataServer(max_size=1500)
+    _publish_for(10, metadata, str(log_path), str(tmpdir), monkeypatch)
+    # it's not sent again once it was accepted
+    assert len(metadata.attempts) == 3
+    assert metadata.attempts[-1] <= 1500
+
+    # if even the shortest tail is rejected, it gives up until the log changes
+    metadata = RejectingMetadataServer(max_size=10)
+    _publish_for(10, metadata, str(log_path), str(tmpdir), monkeypatch)
+    assert len(metadata.attempts) == 4
+    assert metadata.attempts[-1] <= MIN_LOG_ATTRIBUTE_LIMIT
+
+
+def test_commands(tmpdir, monkeypatch):
+    monkeypatch.setattr(hermit_agent, "_shutdown", lambda: None)
+    runner = CommandRunner(
+        str(tmpdir.join("hermit.log")), str(tmpdir.join("state", "commands.json"))
+    )
+    assert parse_command("") is None
+    assert parse_command('{"id": "abc"}') is None
+    command = parse_command('{"id": "abc", "action": "shutdown"}')
+    assert command is not None
+    assert command["action"] == "shutdown"
+
+    # (the VM's clock may be nowhere near the one on the machine which sent the command)
+    now = 1000.0
+    assert runner.get_first_seen("abc", now) == now
+    assert runner.get_first_seen("abc", now + 60) == now
+    assert is_pending(command, runner.get_handled_ids(), now, now + 60)
+    # left in the metadata for too long
+    assert not is_pending(command, set(), now, now + COMMAND_EXPIRY)
+
+    runner.run(command)
+    # already carried out, even if the agent is restarted or the VM rebooted since
+    runner = CommandRunner(runner.log_path, runner.commands_path)
+    assert runner.get_handled_ids() == {"abc"}
+    assert not is_pending(command, runner.get_handled_ids(), now, now + 60)
+
+
+def test_up_and_down_through_agent(gce_sim, sim_instance, instance_up, capsys):
+    sim_instance()
+
+    def _calls(prefix):
+        return [call for call in gce_sim.calls if call[: len(prefix)] == prefix]
+
+    with instance_up():
+        # once the agent started, the boot log was read from its guest attributes instead of over ssh
+        assert len(_calls(["compute", "instances", "get-guest-attributes"])) > 0
+        ssh_polls = len(_calls(["compute", "ssh"]))
+
+        capsys.readouterr()
+        main(["status", "dev"])
+        assert (
+            "Load: load 0.50, 35% of memory used, idle for 2 minutes"
+            in capsys.readouterr().out
+        )
+
+    # the graceful shutdown was requested through the agent
+    assert len(_calls(["compute", "instances", "add-metadata"])) == 1
+    assert len(_calls(["compute", "ssh"])) == ssh_polls
+    assert gce_sim.instance_status("dev", ZONE, PROJECT) is None
@@ -0,0 +1,84 @@
+import io
+import os
+
+import pytest
+
+from hermitcrab.config import config_exists, get_image_check_cache_dir
+from hermitcrab.image_check import (
+    scan_layer,
+    get_problems,
+    InvalidDockerImage,
+    PASSWD_PATH,
+    SSHD_PATH,
+)
+from hermitcrab.main import main
+from .gce_sim import _make_layer, DEFAULT_IMAGE_FILES
+from ..conftest import PROJECT, ZONE
+
+DOCKER_IMAGE = "us-central1-docker.pkg.dev/sim-project/docker/dev-env:v1"
+
+PASSWD = DEFAULT_IMAGE_FILES[PASSWD_PATH]
+
+
+def _scan(files, unresolved=[PASSWD_PATH, SSHD_PATH]):
+    return scan_layer(io.BytesIO(_make_layer(files)), unresolved)
+
+
+def test_scan_layer():
+    assert _scan({PASSWD_PATH: PASSWD, "etc/hosts": ""}) == {
+        PASSWD_PATH: PASSWD.encode("utf8")
+    }
+    # deleted by a whiteout
+    assert _scan({SSHD_PATH: None}) == {SSHD_PATH: None}
+    # deleted because a parent directory was deleted
+    assert _scan({"usr/sbin": None}) == {SSHD_PATH: None}
+    # only looks for what's asked for
+    assert _scan({PASSWD_PATH: PASSWD}, unresolved=[SSHD_PATH]) == {}
+
+
+def test_get_problems():
+    assert get_problems({PASSWD_PATH: PASSWD.encode("utf8"), SSHD_PATH: b""}) == []
+
+    problems = get_problems(
+        {PASSWD_PATH: b"ubuntu:x:1000:1000::/home/ubuntu:/bin/sh\n"}
+    )
+    assert len(problems) == 2
+    assert "/usr/sbin/sshd does not exist" in problems[0]
+    assert "uid 1000" in problems[1]
+
+    assert get_problems(
+        {PASSWD_PATH: b"root:x:0:0::/root:/bin/sh\n", SSHD_PATH: b""}
+    ) == ['there is no user named "ubuntu" in /etc/passwd']
+
+
+def test_up_refuses_image_without_sshd(gce_sim, sim_instance):
+    sim_instance()
+    # sshd was installed, and then removed by a later layer
+    gce_sim.add_docker_image(
+        DOCKER_IMAGE, layers=[DEFAULT_IMAGE_FILES, {SSHD_PATH: None}]
+    )
+
+    with pytest.raises(InvalidDockerImage, match="/usr/sbin/sshd does not exist"):
+        main(["up", "dev"])
+    assert gce_sim.instance_status("dev", ZONE, PROJECT) is None
+
+    # the result is cached, so the layers aren't needed the second time
+    assert len(os.listdir(get_image_check_cache_dir())) == 1
+    gce_sim.blobs.clear()
+    with pytest.raises(InvalidDockerImage):
+        main(["up", "dev"])
+
+
+def test_create_refuses_image_with_wrong_uid(sim_homedir, gce_sim, free_port, capsys):
+    gce_sim.add_docker_image(
+        DOCKER_IMAGE,
+        layers=[
+            DEFAULT_IMAGE_FILES,
+            {PASSWD_PATH: "ubuntu:x:1000:1000::/home/ubuntu:/bin/bash\n"},
+        ],
+    )
+
+    main(["create", "dev", DOCKER_IMAGE, "--local-port", str(free_port())])
+    assert "must have uid 2000" in capsys.readouterr().out
+    assert not config_exists("dev")
+    assert gce_sim.disks == {}
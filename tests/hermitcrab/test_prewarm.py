@@ -0,0 +1,74 @@
+import socket
+import time
+
+import pytest
+
+from hermitcrab.command.prewarm import is_prewarm_time
+from hermitcrab.main import main
+from hermitcrab.tunnel import probe_ssh_banner
+from ..conftest import PROJECT, ZONE
+
+
+@pytest.mark.parametrize(
+    "working_day_start,now,expected",
+    [
+        # 2026-10-19 is a Monday
+        ("09:00", "2026-10-19 08:50", True),
+        ("09:00", "2026-10-19 08:40", False),
+        ("09:00", "2026-10-19 09:00", False),
+        # saturday
+        ("09:00", "2026-10-24 08:50", False),
+        # the window for monday's start begins on sunday evening
+        ("00:05", "2026-10-18 23:55", True),
+        ("00:05", "2026-10-19 23:55", True),
+        ("00:05", "2026-10-23 23:55", False),
+        (None, "2026-10-19 08:50", False),
+    ],
+)
+def test_is_prewarm_time(make_instance_config, working_day_start, now, expected):
+    config = make_instance_config(
+        warm_standby=True, working_day_start=working_day_start
+    )
+    now = time.strptime(now, "%Y-%m-%d %H:%M")
+    assert is_prewarm_time(config, now, 15) == expected
+
+
+def _log_polls(gce_sim):
+    return len(
+        [
+            call
+            for call in gce_sim.calls
+            if (call[:2] == ["compute", "ssh"] and "cat /var/log/hermit.log" in call)
+            or call[:3] == ["compute", "instances", "get-guest-attributes"]
+        ]
+    )
+
+
+def test_warm_standby(gce_sim, sim_instance, instance_up):
+    sim_instance(warm_standby=True)
+
+    main(["up", "dev"])
+    main(["down", "dev"])
+    assert gce_sim.instance_status("dev", ZONE, PROJECT) == "SUSPENDED"
+
+    main(["prewarm", "--now"])
+    assert gce_sim.instance_status("dev", ZONE, PROJECT) == "RUNNING"
+
+    polls = _log_polls(gce_sim)
+    with instance_up(down_options=["--delete"]):
+        # sshd answered through the tunnel, so there was no need to poll the boot log
+        assert _log_polls(gce_sim) == polls
+    assert gce_sim.instance_status("dev", ZONE, PROJECT) is None
+
+
+def test_probe_ssh_banner():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("localhost", 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+    try:
+        # connections are accepted (by the OS) but nothing is sent, like a tunnel to an instance without sshd
+        assert not probe_ssh_banner(port, timeout=0.5)
+    finally:
+        server.close()
+    assert not probe_ssh_banner(port, timeout=0.5)
@@ -0,0 +1,89 @@
+import time
+
+from hermitcrab import tunnel
+from hermitcrab.config import read_instance_state
+from hermitcrab.main import main
+from hermitcrab.ssh import get_ssh_config_path
+from ..conftest import PROJECT, ZONE
+
+
+def _setup(sim_instance, monkeypatch):
+    sim_instance(suspend_on_idle_timeout=30)
+
+    # record the connections instead of piping this process's stdio to gcloud
+    connections = []
+
+    def run_tunnel_on_stdio(name, zone, project):
+        connections.append((name, zone, project))
+        return 0
+
+    monkeypatch.setattr(tunnel, "run_tunnel_on_stdio", run_tunnel_on_stdio)
+    return connections
+
+
+def _status_checks(gce_sim):
+    return len(
+        [call for call in gce_sim.calls if call[:3] == ["compute", "instances", "list"]]
+    )
+
+
+def test_proxy_resumes_suspended_instance(
+    gce_sim, sim_instance, instance_up, monkeypatch, capsys
+):
+    connections = _setup(sim_instance, monkeypatch)
+
+    with instance_up():
+        assert "ProxyCommand" in open(get_ssh_config_path()).read()
+        gce_sim.run_gcloud(["compute", "instances", "suspend", "dev", f"--zone={ZONE}"])
+        # long enough that the idle monitor could have suspended it
+        time.sleep(30 * 60)
+
+        capsys.readouterr()
+        assert main(["proxy", "dev"]) == 0
+        captured = capsys.readouterr()
+        # stdout belongs to ssh, so progress is reported on stderr
+        assert captured.out == ""
+        assert "Resuming" in captured.err
+        assert gce_sim.instance_status("dev", ZONE, PROJECT) == "RUNNING"
+        assert connections == [("dev", ZONE, PROJECT)]
+
+
+def test_proxy_skips_status_check_for_recently_seen_instance(
+    gce_sim, sim_instance, instance_up, monkeypatch
+):
+    connections = _setup(sim_instance, monkeypatch)
+
+    with instance_up():
+        checks = _status_checks(gce_sim)
+        main(["proxy", "dev"])
+        assert _status_checks(gce_sim) == checks
+        assert read_instance_state("dev").get("last_seen_running") == time.time()
+
+        # when the local tunnel doesn't answer, it checks the instance and connects over IAP instead
+        monkeypatch.setattr(tunnel, "splice_stdio_to_local_port", lambda port: None)
+        main(["proxy", "dev"])
+        assert _status_checks(gce_sim) == checks + 1
+        assert len(connections) == 1
+
+        # a failed connection means it should check next time
+        monkeypatch.setattr(tunnel, "run_tunnel_on_stdio", lambda *args: 255)
+        assert main(["proxy", "dev"]) == 255
+        assert read_instance_state("dev").get("last_seen_running") is None
+        monkeypatch.setattr(tunnel, "run_tunnel_on_stdio", lambda *args: 0)
+        main(["proxy", "dev"])
+        assert _status_checks(gce_sim) == checks + 3
+
+
+def test_proxy_uses_running_tunnel(
+    gce_sim, sim_instance, instance_up, monkeypatch, capfd
+):
+    connections = _setup(sim_instance, monkeypatch)
+
+    with instance_up():
+        calls = len(gce_sim.calls)
+        capfd.readouterr()
+        assert main(["proxy", "dev"]) == 0
+        # sshd's greeting came through the tunnel started by 'hermit up'
+        assert capfd.readouterr().out.startswith("SSH-2.0-OpenSSH_gce_sim")
+        assert connections == []
+        assert len(gce_sim.calls) == calls
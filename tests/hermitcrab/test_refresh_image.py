@@ -0,0 +1,75 @@
+import json
+
+from hermitcrab import gcp
+from hermitcrab.command.refresh_image import (
+    CONTAINER_IMAGE_FILES,
+    get_refresh_status_from_log,
+)
+from hermitcrab.config import read_instance_state
+from hermitcrab.main import main
+from ..conftest import PROJECT, ZONE
+from .gce_sim import DEFAULT_IMAGE_FILES
+
+DOCKER_IMAGE = "us-central1-docker.pkg.dev/sim-project/docker/dev-env:latest"
+
+
+def test_pin_docker_image_name():
+    assert (
+        gcp.pin_docker_image_name(DOCKER_IMAGE, "sha256:abc")
+        == "us-central1-docker.pkg.dev/sim-project/docker/dev-env@sha256:abc"
+    )
+    assert gcp.pin_docker_image_name("ubuntu", "sha256:abc") == "ubuntu@sha256:abc"
+    # the port of the registry isn't a tag
+    assert (
+        gcp.pin_docker_image_name("localhost:5000/dev-env", "sha256:abc")
+        == "localhost:5000/dev-env@sha256:abc"
+    )
+
+
+def test_get_refresh_status_from_log():
+    log = """Server listening on 0.0.0.0 port 3022.
+Refresh abc started: dev-env@sha256:1 -> dev-env@sha256:2
+Refresh abc pulled dev-env@sha256:2 in 9 seconds
+"""
+    assert get_refresh_status_from_log(log, "abc") == (
+        None,
+        [
+            "Refresh abc started: dev-env@sha256:1 -> dev-env@sha256:2",
+            "Refresh abc pulled dev-env@sha256:2 in 9 seconds",
+        ],
+    )
+    exit_code, status = get_refresh_status_from_log(
+        log + "Refresh abc finished (exit code 0)\n", "abc"
+    )
+    assert exit_code == 0
+    assert get_refresh_status_from_log(log, "other") == (None, [])
+
+
+def test_refresh_image(gce_sim, sim_instance, instance_up, capsys):
+    sim_instance(docker_image=DOCKER_IMAGE)
+
+    with instance_up():
+        instance = gce_sim.instances[f"{PROJECT}/{ZONE}/dev"]
+        first_image = instance["metadata"].get("docker_image")
+        assert "@sha256:" in first_image
+        assert read_instance_state("dev").get("docker_image") == first_image
+
+        capsys.readouterr()
+        main(["refresh-image", "dev"])
+        assert "already running the latest version" in capsys.readouterr().out
+
+        # push a new version of the image under the same tag
+        gce_sim.add_docker_image(
+            DOCKER_IMAGE, layers=[DEFAULT_IMAGE_FILES, {"usr/local/bin/new-tool": ""}]
+        )
+        main(["up", "dev"])
+        assert "has been updated since dev was started" in capsys.readouterr().out
+
+        main(["refresh-image", "dev"])
+        # the agent is told which files to update
+        command = json.loads(instance["metadata"]["hermit-command"])
+        assert command["files"] == CONTAINER_IMAGE_FILES
+        second_image = instance["metadata"].get("docker_image")
+        assert second_image != first_image
+        assert read_instance_state("dev").get("docker_image") == second_image
+        assert gce_sim.instance_status("dev", ZONE, PROJECT) == "RUNNING"
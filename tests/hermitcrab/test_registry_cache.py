@@ -0,0 +1,96 @@
+import pytest
+
+from hermitcrab import gcp
+from hermitcrab.errors import UserError
+from hermitcrab.main import main
+from hermitcrab.registry_cache import get_cached_docker_image
+from ..conftest import PROJECT
+
+ZONE = "us-east1-b"
+SERVICE_ACCOUNT = "sa@sim-project.iam.gserviceaccount.com"
+DOCKER_IMAGE = "us-central1-docker.pkg.dev/images-project/docker/dev-env:v1"
+CACHED_DOCKER_IMAGE = "us-east1-docker.pkg.dev/sim-project/hermit-cache/dev-env:v1"
+
+
+def test_cached_docker_image_names():
+    assert (
+        get_cached_docker_image(DOCKER_IMAGE, "hermit-cache", ZONE, PROJECT)
+        == CACHED_DOCKER_IMAGE
+    )
+    # no cache configured
+    assert get_cached_docker_image(DOCKER_IMAGE, None, ZONE, PROJECT) == DOCKER_IMAGE
+    # already hosted in the instance's region
+    assert (
+        get_cached_docker_image(DOCKER_IMAGE, "hermit-cache", "us-central1-a", PROJECT)
+        == DOCKER_IMAGE
+    )
+    assert (
+        get_cached_docker_image("ubuntu:22.04", "hermit-cache", ZONE, PROJECT)
+        == "us-east1-docker.pkg.dev/sim-project/hermit-cache/library/ubuntu:22.04"
+    )
+    with pytest.raises(UserError):
+        get_cached_docker_image("quay.io/org/dev-env:v1", "hermit-cache", ZONE, PROJECT)
+
+
+def test_grant_instructions_include_registry_cache():
+    instructions = gcp.get_grant_instructions(
+        SERVICE_ACCOUNT, DOCKER_IMAGE, CACHED_DOCKER_IMAGE
+    )
+    assert "add-iam-policy-binding hermit-cache" in instructions
+    assert "--location=us-east1" in instructions
+    # the cache's service agent needs to read the upstream repository
+    assert "gcp-sa-artifactregistry.iam.gserviceaccount.com" in instructions
+    assert "--project='images-project'" in instructions
+
+
+def _repository_creations(gce_sim):
+    return [
+        call
+        for call in gce_sim.calls
+        if call[:3] == ["artifacts", "repositories", "create"]
+    ]
+
+
+def test_up_pulls_through_registry_cache(gce_sim, sim_instance, instance_up):
+    sim_instance(zone=ZONE, docker_image=DOCKER_IMAGE, registry_cache="hermit-cache")
+
+    with instance_up():
+        repository = gce_sim.repositories[f"{PROJECT}/us-east1/hermit-cache"]
+        assert repository["mode"] == "REMOTE_REPOSITORY"
+        assert repository["remoteRepositoryConfig"]["dockerRepository"] == {
+            "customRepository": {
+                "uri": "https://us-central1-docker.pkg.dev/images-project/docker"
+            }
+        }
+
+        instance = gce_sim.instances[f"{PROJECT}/{ZONE}/dev"]
+        # pinned to the version of the image which was current at 'hermit up'
+        assert instance["metadata"]["docker_image"].startswith(
+            CACHED_DOCKER_IMAGE[: -len(":v1")] + "@sha256:"
+        )
+        assert "--registries us-east1-docker.pkg.dev" in instance["user_data"]
+
+    # the second time, the cache is known to exist
+    with instance_up():
+        assert len(_repository_creations(gce_sim)) == 1
+
+
+def test_existing_repository_with_other_upstream(gce_sim, sim_instance):
+    sim_instance(zone=ZONE, docker_image=DOCKER_IMAGE, registry_cache="hermit-cache")
+    gce_sim.run_gcloud(
+        [
+            "artifacts",
+            "repositories",
+            "create",
+            "hermit-cache",
+            "--repository-format=docker",
+            "--mode=remote-repository",
+            "--remote-docker-repo=DOCKER-HUB",
+            "--location=us-east1",
+            f"--project={PROJECT}",
+        ]
+    )
+
+    with pytest.raises(UserError, match="is not a cache of"):
+        main(["up", "dev"])
+    assert gce_sim.instance_status("dev", ZONE, PROJECT) is None
@@ -0,0 +1,45 @@
+import pytest
+
+from hermitcrab.config import get_instance_config
+from hermitcrab.errors import UserError
+from hermitcrab.main import main
+from ..conftest import PROJECT, ZONE
+
+
+def _setup(gce_sim, sim_instance, status=None):
+    sim_instance()
+    if status is not None:
+        gce_sim.add_instance(
+            "dev", ZONE, PROJECT, status=status, machine_type="n2-standard-2"
+        )
+
+
+def _machine_type(gce_sim):
+    return gce_sim.instances[f"{PROJECT}/{ZONE}/dev"]["machineType"].split("/")[-1]
+
+
+def _count_calls(gce_sim, prefix):
+    return len([call for call in gce_sim.calls if call[: len(prefix)] == prefix])
+
+
+def test_reshape_validates_and_caches_machine_types(gce_sim, sim_instance):
+    _setup(gce_sim, sim_instance)
+
+    with pytest.raises(UserError):
+        main(["reshape", "dev", "n2-standard-1000"])
+
+    main(["reshape", "dev", "n2-standard-8"])
+    assert get_instance_config("dev").machine_type == "n2-standard-8"
+
+    # the list of machine types was only fetched once
+    assert _count_calls(gce_sim, ["compute", "machine-types", "list"]) == 1
+
+
+@pytest.mark.parametrize("status", ["TERMINATED", "SUSPENDED"])
+def test_up_applies_new_machine_type(gce_sim, sim_instance, instance_up, status):
+    _setup(gce_sim, sim_instance, status=status)
+
+    main(["reshape", "dev", "n2-highmem-16"])
+    with instance_up():
+        assert _machine_type(gce_sim) == "n2-highmem-16"
+        assert gce_sim.instance_status("dev", ZONE, PROJECT) == "RUNNING"
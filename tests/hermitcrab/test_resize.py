@@ -0,0 +1,112 @@
+import pytest
+
+from hermitcrab.config import InstanceConfig, write_instance_config, get_instance_config
+from hermitcrab.errors import UserError
+from hermitcrab.main import main
+from ..conftest import PROJECT, ZONE
+
+
+def _setup(gce_sim, status=None, **kwargs):
+    gce_sim.add_disk("dev-pd", ZONE, PROJECT, size_gb=200)
+    if status is not None:
+        gce_sim.add_instance("dev", ZONE, PROJECT, status=status)
+    write_instance_config(
+        InstanceConfig(
+            name="dev",
+            zone=ZONE,
+            project=PROJECT,
+            machine_type="n2-standard-2",
+            docker_image="us-central1-docker.pkg.dev/sim-project/docker/dev-env:v1",
+            pd_name="dev-pd",
+            local_port=3022,
+            service_account="sa@sim-project.iam.gserviceaccount.com",
+            boot_disk_size_in_gb=50,
+            disk_size_in_gb=200,
+            disk_type=kwargs.pop("disk_type", "pd-standard"),
+            **kwargs,
+        )
+    )
+
+
+def _resize2fs_calls(gce_sim):
+    return [call for call in gce_sim.calls if "resize2fs" in " ".join(call)]
+
+
+def test_resize_offline(sim_homedir, gce_sim):
+    _setup(gce_sim)
+
+    main(["resize", "dev", "300"])
+
+    assert gce_sim.disks[f"{PROJECT}/{ZONE}/dev-pd"]["sizeGb"] == "300"
+    assert get_instance_config("dev").disk_size_in_gb == 300
+    # the filesystem gets grown on the next boot instead
+    assert _resize2fs_calls(gce_sim) == []
+
+
+def test_resize_running(sim_homedir, gce_sim):
+    _setup(gce_sim, status="RUNNING")
+
+    main(["resize", "dev", "300"])
+
+    assert gce_sim.disks[f"{PROJECT}/{ZONE}/dev-pd"]["sizeGb"] == "300"
+    assert len(_resize2fs_calls(gce_sim)) == 1
+
+
+def test_cannot_shrink(sim_homedir, gce_sim):
+    _setup(gce_sim)
+
+    with pytest.raises(UserError):
+        main(["resize", "dev", "100"])
+
+
+def test_migrate_disk_type(sim_homedir, gce_sim):
+    _setup(gce_sim)
+
+    main(["resize", "dev", "--disk-type", "pd-ssd"])
+
+    config = get_instance_config("dev")
+    assert config.pd_name == "dev-pd-ssd"
+    assert config.disk_type == "pd-ssd"
+    assert config.disk_size_in_gb == 200
+    new_disk = gce_sim.disks[f"{PROJECT}/{ZONE}/dev-pd-ssd"]
+    assert new_disk["type"] == "pd-ssd"
+    assert new_disk["formatted"]
+    # the original is left in place until the user deletes it
+    assert f"{PROJECT}/{ZONE}/dev-pd" in gce_sim.disks
+
+
+def test_migrate_disk_type_requires_offline(sim_homedir, gce_sim):
+    _setup(gce_sim, status="SUSPENDED")
+
+    with pytest.raises(UserError, match="'hermit down dev'"):
+        main(["resize", "dev", "--disk-type", "pd-ssd"])
+
+
+def test_migrate_disk_type_of_warm_standby(sim_homedir, gce_sim):
+    _setup(gce_sim, status="SUSPENDED", warm_standby=True)
+
+    # a plain 'hermit down' would only suspend it
+    with pytest.raises(UserError, match="'hermit down --delete dev'"):
+        main(["resize", "dev", "--disk-type", "pd-ssd"])
+
+
+def test_same_disk_type(sim_homedir, gce_sim, capsys):
+    _setup(gce_sim)
+
+    main(["resize", "dev", "--disk-type", "pd-standard"])
+
+    assert "dev-pd is already pd-standard" in capsys.readouterr().out
+    assert get_instance_config("dev").pd_name == "dev-pd"
+
+
+def test_same_disk_type_of_old_config(sim_homedir, gce_sim, capsys):
+    # configs written by older versions of hermit don't record the type
+    _setup(gce_sim, disk_type=None)
+
+    main(["resize", "dev", "--disk-type", "pd-standard"])
+
+    assert "dev-pd is already pd-standard" in capsys.readouterr().out
+    assert gce_sim.snapshots == {}
+    config = get_instance_config("dev")
+    assert config.pd_name == "dev-pd"
+    assert config.disk_type == "pd-standard"
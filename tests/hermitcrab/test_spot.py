@@ -0,0 +1,25 @@
+from hermitcrab.main import main
+from ..conftest import PROJECT, ZONE
+
+
+def test_spot_instance_restarted_after_preemption(
+    gce_sim, sim_instance, instance_up, capsys
+):
+    sim_instance(provisioning_model="SPOT")
+
+    with instance_up():
+        instance = gce_sim.instances[f"{PROJECT}/{ZONE}/dev"]
+        assert instance["scheduling"] == {
+            "provisioningModel": "SPOT",
+            "instanceTerminationAction": "STOP",
+        }
+        assert "--watch-preemption" in instance["user_data"]
+
+        gce_sim.preempt("dev", ZONE, PROJECT)
+        capsys.readouterr()
+        main(["status", "dev"])
+        assert "preempted 1 time(s) recently" in capsys.readouterr().out
+
+        main(["up", "dev"])
+        assert "has been preempted 1 time(s)" in capsys.readouterr().out
+        assert gce_sim.instance_status("dev", ZONE, PROJECT) == "RUNNING"
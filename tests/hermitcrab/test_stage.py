@@ -0,0 +1,39 @@
+import pytest
+from hermitcrab.command.stage import get_host_path, get_stage_status_from_log
+from hermitcrab.errors import UserError
+
+
+def test_get_host_path():
+    assert get_host_path("x-pd", "data") == "/mnt/disks/x-pd/home/ubuntu/data"
+    assert get_host_path("x-pd", "/home/ubuntu/data") == (
+        "/mnt/disks/x-pd/home/ubuntu/data"
+    )
+    assert get_host_path("x-pd", "/home/ubuntu") == "/mnt/disks/x-pd/home/ubuntu"
+    assert get_host_path("x-pd", "/tmp/scratch") == "/tmp/scratch"
+    with pytest.raises(UserError):
+        get_host_path("x-pd", "/etc")
+
+
+def test_get_stage_status_from_log():
+    log = """Starting cloudinit bootcmd...
+Server listening on 0.0.0.0 port 3022.
+Staging abc started: gs://bucket/data -> /mnt/disks/x-pd/home/ubuntu/data
+Copying gs://bucket/data/a.bam to file:///mnt/disks/x-pd/home/ubuntu/data/a.bam
+\rCompleted files 1/4 | 1.0GiB/4.0GiB | 250.0MiB/s\rCompleted files 3/4 | 3.1GiB/4.0GiB | 310.2MiB/s
+"""
+    assert get_stage_status_from_log(log, "abc") == (
+        None,
+        [
+            "Staging abc started: gs://bucket/data -> /mnt/disks/x-pd/home/ubuntu/data",
+            "Completed files 3/4 | 3.1GiB/4.0GiB | 310.2MiB/s",
+        ],
+    )
+
+    exit_code, status = get_stage_status_from_log(
+        log + "\nStaging abc finished (exit code 0)\n", "abc"
+    )
+    assert exit_code == 0
+    assert status[-1] == "Staging abc finished (exit code 0)"
+
+    # a different staging operation shouldn't be reported
+    assert get_stage_status_from_log(log, "other") == (None, [])
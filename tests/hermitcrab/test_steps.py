@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+from hermitcrab.steps import Step, run_steps
+
+
+def test_dependencies_run_in_order():
+    order = []
+
+    def record(name):
+        def callback():
+            order.append(name)
+            return name.upper()
+
+        return callback
+
+    results = run_steps(
+        [
+            Step("c", record("c"), ["b"]),
+            Step("b", record("b"), ["a"]),
+            Step("a", record("a")),
+        ],
+        output_callback=lambda msg: None,
+    )
+    assert order == ["a", "b", "c"]
+    assert results == {"a": "A", "b": "B", "c": "C"}
+
+
+def test_independent_steps_overlap():
+    # each step waits for the other to start, which only succeeds if they run concurrently
+    a_started = threading.Event()
+    b_started = threading.Event()
+
+    def a():
+        a_started.set()
+        assert b_started.wait(timeout=10)
+
+    def b():
+        b_started.set()
+        assert a_started.wait(timeout=10)
+
+    run_steps([Step("a", a), Step("b", b)], output_callback=lambda msg: None)
+
+
+def test_failure_stops_dependents():
+    ran = []
+
+    def fail():
+        raise ValueError("bad")
+
+    messages = []
+    with pytest.raises(ValueError, match="bad"):
+        run_steps(
+            [
+                Step("fail", fail),
+                Step("after", lambda: ran.append("after"), ["fail"]),
+            ],
+            output_callback=messages.append,
+        )
+    assert ran == []
+    assert "[fail] failed: bad" in messages
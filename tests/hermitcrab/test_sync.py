@@ -0,0 +1,75 @@
+import time
+
+import pytest
+
+from hermitcrab.command import sync
+from hermitcrab.command.sync import parse_rsync_dry_run, plan_transfer, FileToSync
+from hermitcrab.errors import UserError
+from ..conftest import PROJECT, ZONE
+
+
+def test_parse_rsync_dry_run():
+    output = """created directory data
+4096 ./
+4096 sub/
+12 a.txt
+3000000 sub/b.bin
+"""
+    assert parse_rsync_dry_run(output) == [
+        FileToSync("a.txt", 12),
+        FileToSync("sub/b.bin", 3000000),
+    ]
+
+
+def test_plan_transfer():
+    files = [FileToSync(f"small{i}", 10) for i in range(5)] + [
+        FileToSync("big1", 1000),
+        FileToSync("big2", 800),
+        FileToSync("big3", 300),
+    ]
+
+    plan = plan_transfer(files, stream_count=2, small_file_size=100, tar_batch_size=25)
+
+    assert [len(batch) for batch in plan.tar_batches] == [3, 2]
+    # largest files are spread out so each stream moves about the same amount of data
+    assert [[f.path for f in stream] for stream in plan.rsync_streams] == [
+        ["big1"],
+        ["big2", "big3"],
+    ]
+
+    # if there are fewer large files than streams, empty streams are dropped
+    plan = plan_transfer(files, stream_count=8, small_file_size=100, tar_batch_size=25)
+    assert len(plan.rsync_streams) == 3
+
+
+def test_tar_pipe_with_many_warnings(tmpdir, monkeypatch):
+    # an "ssh" which runs the command locally
+    fake_ssh = tmpdir.join("ssh")
+    fake_ssh.write('#!/bin/sh\nshift\nexec sh -c "$1"\n')
+    fake_ssh.chmod(0o755)
+    monkeypatch.setattr(sync, "SSH_COMMAND", [str(fake_ssh)])
+    src = tmpdir.mkdir("src")
+    src.join("a.txt").write("a")
+    dst = tmpdir.join("dst")
+
+    # far more warnings from tar than fit in a pipe's buffer
+    files = [FileToSync("a.txt", 1)] + [
+        FileToSync(f"missing-file-{i:05}", 1) for i in range(5000)
+    ]
+    with pytest.raises(UserError, match="missing-file-04999"):
+        sync._tar_pipe("dev", (False, str(src)), (True, str(dst)), files)
+    assert dst.join("a.txt").read() == "a"
+
+
+def test_sync_resumes_suspended_instance(
+    gce_sim, sim_instance, instance_up, monkeypatch
+):
+    sim_instance(suspend_on_idle_timeout=30)
+    with instance_up():
+        gce_sim.run_gcloud(["compute", "instances", "suspend", "dev", f"--zone={ZONE}"])
+        time.sleep(30 * 60)
+
+        # nothing to transfer, so no ssh connections are made
+        monkeypatch.setattr(sync, "_rsync", lambda *args: "")
+        sync.sync("dev", "local-dir", ":remote-dir", 4, 1024, 100, False, False)
+        assert gce_sim.instance_status("dev", ZONE, PROJECT) == "RUNNING"
@@ -208,6 +208,72 @@ def test_fsck_progress_from_log():
     ) == hermitcrab.command.up.get_status_from_log("".join(fsck_log_messages))
 
 
+def test_fsck_decision_from_log():
+    skipped_log = """Starting cloudinit bootcmd...
+Skipped checking filesystem /dev/disk/by-id/google-dev-pd (cleanly unmounted and last checked 3 days ago)
+Mounting /dev/disk/by-id/google-dev-pd as /mnt/disks/dev-pd
+Skipping the filesystem check saved about 95 seconds
+"""
+    assert (
+        False,
+        [
+            "Skipped checking filesystem (cleanly unmounted and last checked 3 days ago)",
+            "Skipping the filesystem check saved about 95 seconds",
+        ],
+    ) == hermitcrab.command.up.get_status_from_log(skipped_log)
+
+    checked_log = """Starting cloudinit bootcmd...
+Starting check filesystem /dev/disk/by-id/google-dev-pd (last full check was 31 days ago)
+fsck from util-linux 2.38.1
+Finished checking filesystem /dev/disk/by-id/google-dev-pd in 95 seconds
+"""
+    assert (
+        False,
+        [
+            "Starting check filesystem (last full check was 31 days ago)",
+            "Finished checking filesystem in 95 seconds",
+        ],
+    ) == hermitcrab.command.up.get_status_from_log(checked_log)
+
+
+def test_pull_duration_from_log():
+    log = """v1: Pulling from sim-project/docker/dev-env
+Status: Downloaded newer image for us-central1-docker.pkg.dev/sim-project/docker/dev-env:v1
+Pulled us-central1-docker.pkg.dev/sim-project/docker/dev-env:v1 in 42 seconds
+"""
+    assert (
+        False,
+        [
+            "Pulling from sim-project/docker/dev-env",
+            "Status: Downloaded newer image for us-central1-docker.pkg.dev/sim-project/docker/dev-env:v1",
+            "Pulled us-central1-docker.pkg.dev/sim-project/docker/dev-env:v1 in 42 seconds",
+        ],
+    ) == hermitcrab.command.up.get_status_from_log(log)
+
+
+def test_boot_profile_from_log():
+    log = """Starting cloudinit bootcmd...
+Boot stage bootcmd-start reached at 6.20 seconds
+Boot stage home-mounted reached at 8.05 seconds
+Server listening on 0.0.0.0 port 3022.
+Boot stage sshd-listening reached at 30.75 seconds
+"""
+    assert [
+        ("bootcmd-start", 6.2),
+        ("home-mounted", 8.05),
+        ("sshd-listening", 30.75),
+    ] == hermitcrab.command.up.get_boot_profile(log)
+
+    lines = []
+    hermitcrab.command.up.print_boot_profile(log, output_callback=lines.append)
+    assert lines == [
+        "Boot profile (seconds since the kernel started):",
+        "       6.2 bootcmd-start",
+        "       8.1 home-mounted (+1.9)",
+        "      30.8 sshd-listening (+22.7)",
+    ]
+
+
 missing_filesystem_log_msgs = [
     """Starting cloudinit bootcmd...
 Starting check filesystem /dev/disk/by-id/google-temp-3
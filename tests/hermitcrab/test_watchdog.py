@@ -0,0 +1,130 @@
+import os
+import signal
+import threading
+import time
+
+from hermitcrab import gcp
+from hermitcrab.command import watchdog
+from hermitcrab.command.watchdog import (
+    TunnelWatch,
+    check_tunnel,
+    describe_tunnel_health,
+    read_tunnel_health,
+    get_backoff,
+    get_watched_names,
+    MAX_BACKOFF,
+)
+from hermitcrab.config import (
+    read_instance_state,
+    update_instance_state,
+)
+from hermitcrab.deploy_scripts.hermit_agent import is_activity
+from hermitcrab.main import main
+from hermitcrab.tunnel import read_pid, is_pid_valid, probe_ssh_banner
+from ..conftest import ZONE
+
+
+def test_get_backoff():
+    assert [get_backoff(failures) for failures in [1, 2, 3]] == [5, 10, 20]
+    assert get_backoff(100) == MAX_BACKOFF
+
+
+def test_is_activity():
+    # the first poll
+    assert is_activity(None, 100)
+    # the watchdog's probes carry no data, so aren't counted by the firewall rule
+    assert not is_activity(100, 100)
+    # a quiet interactive session still sends keepalives
+    assert is_activity(100, 196)
+
+
+def _kill_tunnel(name):
+    pid = read_pid(name)
+    assert pid is not None
+    os.kill(pid, signal.SIGKILL)
+    while is_pid_valid(pid):
+        # reap it
+        gcp._check_procs()
+        time.sleep(0.1)
+
+
+def test_watchdog_restarts_dead_tunnel(
+    gce_sim, sim_instance, instance_up, monkeypatch, capsys
+):
+    watchdog_starts = []
+    monkeypatch.setattr(
+        watchdog, "start_watchdog", lambda: watchdog_starts.append(True)
+    )
+    sim_instance()
+
+    main(["up", "dev", "--no-watchdog"])
+    assert watchdog_starts == []
+    with instance_up() as config:
+        assert watchdog_starts == [True]
+        assert get_watched_names() == ["dev"]
+        watch = TunnelWatch()
+        assert check_tunnel(config, watch, time.time())["status"] == "ok"
+
+        first_pid = read_pid("dev")
+        _kill_tunnel("dev")
+        health = check_tunnel(config, watch, time.time())
+        assert health["status"] == "restarted"
+        assert read_pid("dev") != first_pid
+        assert probe_ssh_banner(config.local_port)
+
+        # the restarted tunnel is healthy again
+        health = check_tunnel(config, watch, time.time())
+        assert health == read_tunnel_health("dev")
+        assert health["status"] == "ok"
+        assert health["restarts"] == 1
+        assert "restarted 1 time(s)" in describe_tunnel_health(health, time.time())
+
+        capsys.readouterr()
+        main(["status", "dev"])
+        assert "Tunnel: ok" in capsys.readouterr().out
+    # so the watchdog would exit
+    assert get_watched_names() == []
+
+
+def test_watchdog_leaves_tunnel_to_suspended_instance(
+    gce_sim, sim_instance, instance_up
+):
+    sim_instance()
+
+    with instance_up() as config:
+        watch = TunnelWatch()
+        gce_sim.run_gcloud(["compute", "instances", "suspend", "dev", f"--zone={ZONE}"])
+        dead_pid = read_pid("dev")
+        _kill_tunnel("dev")
+
+        now = time.time()
+        health = check_tunnel(config, watch, now)
+        assert health["status"] == "stopped"
+        assert read_pid("dev") == dead_pid
+        assert read_instance_state("dev").get("last_seen_running") is None
+        assert "isn't running" in describe_tunnel_health(health, now)
+        # GCE isn't asked again on each probe
+        status_checks = len(gce_sim.calls)
+        assert check_tunnel(config, watch, now + 15)["status"] == "stopped"
+        assert len(gce_sim.calls) == status_checks
+
+        # once it's running again, the tunnel is restarted
+        gce_sim.run_gcloud(["compute", "instances", "resume", "dev", f"--zone={ZONE}"])
+        health = check_tunnel(config, watch, now + MAX_BACKOFF)
+        assert health["status"] == "restarted"
+        assert health["restarts"] == 1
+        assert probe_ssh_banner(config.local_port)
+
+
+def test_concurrent_state_updates(sim_homedir):
+    # ie: 'hermit proxy' recording last_seen_running while 'hermit up' records the image
+    def update(key):
+        for i in range(50):
+            update_instance_state("dev", **{key: i})
+
+    threads = [threading.Thread(target=update, args=(key,)) for key in ["a", "b", "c"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert read_instance_state("dev") == {"a": 49, "b": 49, "c": 49}
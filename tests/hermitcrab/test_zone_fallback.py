@@ -0,0 +1,81 @@
+import pytest
+
+from hermitcrab.config import get_instance_config, read_instance_state
+from hermitcrab.errors import UserError
+from hermitcrab.main import main
+from ..conftest import PROJECT, ZONE
+
+FALLBACK_ZONE = "us-east1-b"
+
+
+def _create_attempts(gce_sim, zone):
+    return len(
+        [
+            call
+            for call in gce_sim.calls
+            if call[:3] == ["compute", "instances", "create"]
+            and f"--zone={zone}" in call
+        ]
+    )
+
+
+def test_up_moves_to_fallback_zone(gce_sim, sim_instance, instance_up):
+    gce_sim.exhausted_zones.append(ZONE)
+    sim_instance("dev", fallback_zones=[FALLBACK_ZONE])
+    sim_instance("dev2", fallback_zones=[FALLBACK_ZONE])
+
+    with instance_up("dev") as config:
+        assert config.zone == FALLBACK_ZONE
+        assert config.pd_name == f"dev-pd-{FALLBACK_ZONE}"
+        assert gce_sim.instance_status("dev", FALLBACK_ZONE, PROJECT) == "RUNNING"
+        # the original disk is left alone
+        assert f"{PROJECT}/{ZONE}/dev-pd" in gce_sim.disks
+        assert _create_attempts(gce_sim, ZONE) == 1
+
+    # having just seen that the zone has no capacity, the next instance goes straight to the fallback
+    with instance_up("dev2") as config:
+        assert config.zone == FALLBACK_ZONE
+        assert _create_attempts(gce_sim, ZONE) == 1
+
+
+def test_up_without_fallback_zones(gce_sim, sim_instance):
+    gce_sim.exhausted_zones.append(ZONE)
+    sim_instance("dev", fallback_zones=[])
+
+    with pytest.raises(UserError, match="fallback_zones"):
+        main(["up", "dev"])
+    assert get_instance_config("dev").zone == ZONE
+
+
+def test_move_there_and_back(gce_sim, sim_instance):
+    # (a config written before hermit recorded the disk type)
+    sim_instance("dev", disk_type=None)
+    gce_sim.disks[f"{PROJECT}/{ZONE}/dev-pd"][
+        "type"
+    ] = f"https://www.googleapis.com/compute/v1/projects/{PROJECT}/zones/{ZONE}/diskTypes/pd-ssd"
+
+    main(["move", "dev", FALLBACK_ZONE])
+    config = get_instance_config("dev")
+    assert config.pd_name == f"dev-pd-{FALLBACK_ZONE}"
+    # the copy is the same type of disk as the original
+    assert config.disk_type == "pd-ssd"
+    assert (
+        gce_sim.disks[f"{PROJECT}/{FALLBACK_ZONE}/dev-pd-{FALLBACK_ZONE}"]["type"]
+        == "pd-ssd"
+    )
+    # the snapshot used to copy it is cleaned up
+    assert gce_sim.snapshots == {}
+
+    # moving back replaces the out of date disk it left behind, instead of making a third one
+    main(["move", "dev", ZONE])
+    config = get_instance_config("dev")
+    assert config.zone == ZONE
+    assert config.pd_name == "dev-pd"
+    assert sorted(gce_sim.disks) == [
+        f"{PROJECT}/{ZONE}/dev-pd",
+        f"{PROJECT}/{FALLBACK_ZONE}/dev-pd-{FALLBACK_ZONE}",
+    ]
+    assert gce_sim.snapshots == {}
+    assert read_instance_state("dev").get("left_behind_disks") == {
+        FALLBACK_ZONE: f"dev-pd-{FALLBACK_ZONE}"
+    }